@@ -3,14 +3,14 @@ import json
 import os
 
 # Third party libraries
-from flask import Flask
-from mongoengine import connect
+from flask import Flask, url_for
 from flask_login import LoginManager
 #from oauthlib.oauth2 import WebApplicationClient
-import certifi
 from app.utils.secrets import getSecrets
 from flask_moment import Moment
-import base64
+from app.utils.database import registerDatabase
+from app.utils.metrics import registerMetrics
+from app.utils.assets import registerAssets
 
 # Flask app setup
 app = Flask(__name__)
@@ -25,15 +25,39 @@ login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
-# Naive database setup
-connect(secrets['MONGO_DB_NAME'], host=secrets['MONGO_HOST'], tlsCAFile=certifi.where())
+# Request timing and query counting, shown at /metrics. This has to come before
+# connect() so the database connection reports its queries. See utils/metrics.py
+registerMetrics(app)
+
+# Database setup. The connection is opened on the first query, and opened again in each
+# worker process gunicorn starts. See utils/database.py
+registerDatabase(app, secrets)
 moment = Moment(app)
 
-def base64encode(img):
-    image = base64.b64encode(img)
-    image = image.decode('utf-8')
-    return image
+# Templates use this to show a user's profile picture: <img src="{{avatarUrl(user, 128)}}">
+# The picture's GridFS id is part of the url so when the picture changes the url changes
+# too, which lets browsers keep the old one for as long as they like.
+# size is how many pixels wide the page shows the picture, so the smallest copy that
+# looks good can be sent (see utils/images.py).
+def avatarUrl(user, size=128):
+    if user and user.image:
+        return url_for('avatar', userId=user.id, s=size, v=str(user.image.grid_id))
+    return url_for('static', filename='bdog.png')
+
+app.jinja_env.globals.update(avatarUrl=avatarUrl)
 
-app.jinja_env.globals.update(base64encode=base64encode)
+# Shrunk, fingerprinted static files and the static_url()/static_picture() template
+# helpers. See utils/assets.py
+registerAssets(app)
+
+# Saved copies of rendered html: {% call cached(...) %} in templates. See utils/pagecache.py
+from app.utils.pagecache import cached
+app.jinja_env.globals.update(cached=cached)
 
 from .routes import *
+from . import commands
+
+# Profiling of live requests. Only turned on by the PROFILE_MODE environment variable.
+# See utils/profiler.py
+from app.utils.profiler import registerProfiler
+registerProfiler(app)
@@ -4,21 +4,17 @@
 # fields have types like IntField, StringField etc.  This uses the Mongoengine Python Library. When 
 # you interact with the data you are creating an onject that is an instance of the class.
 
-from sys import getprofile
-from tokenize import String
-from typing import KeysView
-from xmlrpc.client import Boolean
-
-from setuptools import SetuptoolsDeprecationWarning
-from app import app
-from flask import flash
 from flask_login import UserMixin
-from mongoengine import FileField, EmailField, StringField, IntField, ReferenceField, DateTimeField, BooleanField, FloatField, CASCADE
-from flask_mongoengine import Document
+from mongoengine import FileField, EmailField, StringField, IntField, ReferenceField, DateTimeField, BooleanField, FloatField, DictField, CASCADE
+from flask_mongoengine import Document as FlaskDocument
+from app.utils.database import RoutedQuerySet
 import datetime as dt
-import jwt
-from time import time
-from bson.objectid import ObjectId
+
+# All the collections below are made from this. It is the normal flask_mongoengine
+# Document except that routes marked @readFromSecondaries can read from a secondary
+# database server. See utils/database.py
+class Document(FlaskDocument):
+    meta = {'abstract': True, 'queryset_class': RoutedQuerySet}
 
 class User(UserMixin, Document):
     createdate = DateTimeField(defaultdefault=dt.datetime.utcnow)
@@ -30,14 +26,29 @@ class User(UserMixin, Document):
     lname = StringField()
     email = EmailField()
     image = FileField()
+    # Smaller copies of image saved in GridFS, like {'128.webp': <GridFS id>}.
+    # See utils/images.py
+    avatars = DictField()
     prononuns = StringField()
     adult_fname = StringField()
     adult_lname = StringField()
     adult_email = StringField()
     consent = BooleanField(default=False)
+    # This goes up by one every time this user's sleeps change. It is used to know
+    # when a cached graph of their sleeps is out of date.
+    sleep_version = IntField(default=0)
+    # This goes up by one every time this user is changed. Worker processes use it to
+    # know when their cached copy of this user is out of date. See utils/usercache.py
+    cache_version = IntField(default=0)
 
     meta = {
-        'ordering': ['lname','fname']
+        'ordering': ['lname','fname'],
+        'indexes': [
+            # The login callback finds users by email
+            'email',
+            # The weekly digest finds the users who consented to share
+            'consent',
+        ]
     }
 
 class Sleep(Document):
@@ -49,10 +60,46 @@ class Sleep(Document):
     sleep_date = DateTimeField()
     hours = FloatField()
     minstosleep = IntField()
+    # When this sleep was saved or last changed. Sent to browsers as Last-Modified.
+    modify_date = DateTimeField(default=dt.datetime.utcnow)
 
     meta = {
-        'ordering': ['sleep_date']
+        'ordering': ['sleep_date'],
+        # Indexes let the database jump straight to the right documents instead of
+        # reading the whole collection. There is one for each way the routes search.
+        # 'flask indexes' checks that every route query uses one (see commands.py).
+        'indexes': [
+            # one user's sleeps by date (stats, graphs)
+            ('sleeper', 'sleep_date'),
+            # the /sleeps list, newest first (see pagination.py)
+            ('-sleep_date', '-id'),
+        ]
     }
+
+# One of these per user with the totals of all their sleeps. It is kept up to date every
+# time a sleep is added, changed or deleted so a user's averages can be shown by reading
+# this one document instead of every sleep they ever logged. See utils/rollups.py
+class SleepRollup(Document):
+    user = ReferenceField('User',reverse_delete_rule=CASCADE,unique=True)
+    nights = IntField(default=0)
+    # Averages are total / count. The counts are separate because any of these can be
+    # left empty on a sleep.
+    hours_total = FloatField(default=0)
+    hours_count = IntField(default=0)
+    rating_total = IntField(default=0)
+    rating_count = IntField(default=0)
+    feel_total = IntField(default=0)
+    feel_count = IntField(default=0)
+    mins_total = IntField(default=0)
+    mins_count = IntField(default=0)
+    # The same numbers for each date ('2022-11-28') and each week ('2022-W48')
+    days = DictField()
+    weeks = DictField()
+    # Nights in a row with a sleep logged. current_streak is the run that ends on streak_end.
+    current_streak = IntField(default=0)
+    longest_streak = IntField(default=0)
+    streak_end = DateTimeField()
+    modify_date = DateTimeField()
     
 class Blog(Document):
     author = ReferenceField('User',reverse_delete_rule=CASCADE) 
@@ -61,9 +108,25 @@ class Blog(Document):
     tag = StringField()
     create_date = DateTimeField(default=dt.datetime.utcnow)
     modify_date = DateTimeField()
+    # Goes up by one every time this blog or one of its comments changes. The saved
+    # copies of its html are looked up by this number, see utils/pagecache.py
+    cache_version = IntField(default=0)
 
     meta = {
-        'ordering': ['-createdate']
+        'ordering': ['-create_date'],
+        'indexes': [
+            # the /blogs list, newest first (see pagination.py)
+            ('-create_date', '-id'),
+            # searching with a tag filter
+            'tag',
+            # the words in a blog for /blogs/search. A '$' in front of a field name makes it
+            # part of a text index. Words in the subject count the most. See utils/search.py
+            {
+                'fields': ['$subject', '$tag', '$content'],
+                'default_language': 'english',
+                'weights': {'subject': 10, 'tag': 5, 'content': 1}
+            },
+        ]
     }
 
 class Comment(Document):
@@ -78,5 +141,37 @@ class Comment(Document):
     modify_date = DateTimeField()
 
     meta = {
-        'ordering': ['-createdate']
+        'ordering': ['-create_date'],
+        'indexes': [
+            # all the comments on one blog
+            ('blog', 'create_date'),
+            # the words in a comment for /blogs/search
+            '$content',
+        ]
+    }
+
+# A Job is a piece of work (like sending emails) that is done by the background worker 
+# ('flask worker') instead of while someone waits for a page. See utils/jobs.py
+class Job(Document):
+    kind = StringField(required=True)
+    payload = DictField()
+    # queued -> running -> done, or back to queued to try again, or failed
+    status = StringField(default='queued')
+    attempts = IntField(default=0)
+    max_attempts = IntField(default=5)
+    # the job won't run before this time
+    run_at = DateTimeField(default=dt.datetime.utcnow)
+    # when a worker started it. A job that has been running too long is given to another worker.
+    locked_at = DateTimeField()
+    last_error = StringField()
+    # stops the scheduler from adding the same job twice (like the digests for one week)
+    unique_key = StringField(sparse=True, unique=True)
+    create_date = DateTimeField(default=dt.datetime.utcnow)
+    modify_date = DateTimeField()
+
+    meta = {
+        'indexes': [
+            # the worker looks for the next job that is due
+            ('status', 'run_at'),
+        ]
     }
\ No newline at end of file
@@ -32,6 +32,11 @@ class SleepForm(FlaskForm):
     minstosleep = IntegerField("How many minutes did it take you to fall asleep?", validators=[NumberRange(min=0,max=180, message="Enter a number between 0 and 180.")])
     submit = SubmitField("Submit")
 
+class SleepImportForm(FlaskForm):
+    file = FileField("CSV or NDJSON file", validators=[DataRequired()])
+    format = SelectField("Format", choices=[('csv','CSV'),('ndjson','NDJSON')])
+    submit = SubmitField("Import")
+
 class BlogForm(FlaskForm):
     subject = StringField('Subject', validators=[DataRequired()])
     content = TextAreaField('Blog', validators=[DataRequired()])
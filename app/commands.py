@@ -0,0 +1,163 @@
+# These are commands you type in the terminal instead of pages you visit in the browser.
+# Flask finds them through the app object. Run them like this:
+#     flask --app main indexes
+# (older versions of Flask: set FLASK_APP=main and then run 'flask indexes')
+# https://flask.palletsprojects.com/en/2.0.x/cli/#custom-commands
+
+import click
+from bson.objectid import ObjectId
+from app import app
+from mongoengine.queryset.visitor import Q
+from pymongo import UpdateOne
+from app.classes.data import Document, User, Sleep, SleepRollup, Blog, Comment, Job
+from app.utils.pagination import olderThan
+from app.utils.sleepio import importSleeps
+from app.utils.jobs import workLoop
+from app.utils.assets import buildAssets
+from app.utils.rollups import rebuildRollup
+from app.utils.graphs import sleepsChanged
+# The job handlers register themselves when their file is imported. 'import app.utils.digest'
+# would replace the Flask app above with the app package.
+from app.utils import digest  # noqa: F401
+import datetime as dt
+
+
+def allDocuments():
+    # Every collection in data.py, so a new one gets its indexes without being added here
+    return [document for document in Document.__subclasses__() if not document._meta.get('abstract')]
+
+
+def routeQueries():
+    # One example of every query the routes (and the worker and commands) run, named after
+    # where it is run. The ids and dates don't need to exist, the database plans the query
+    # the same way. Add new queries here when you write them.
+    someId = ObjectId()
+    someDate = dt.datetime.utcnow()
+    return {
+        'load_user / avatar: User by id': User.objects(pk=someId),
+        'callback: User by email': User.objects(email='someone@ousd.org'),
+        'loadUsers: Users on a page': User.objects(id__in=[someId, ObjectId()]),
+        'import-sleeps: Users by email': User.objects(email__in=['someone@ousd.org']),
+        'digest / cohort: Users who consented': User.objects(consent=True),
+        'sleeps: first page': Sleep.objects().order_by('-sleep_date', '-id').limit(26),
+        'sleeps: next page': Sleep.objects(olderThan('sleep_date', someDate, someId)).order_by('-sleep_date', '-id').limit(26),
+        'sleepgraph / stats: one user\'s sleeps': Sleep.objects(sleeper=someId).order_by('sleep_date'),
+        'sleepSeries: one user\'s sleeps by date': Sleep.objects(sleeper=someId, sleep_date__gte=someDate, sleep_date__lte=someDate),
+        'export / analytics: cohort sleeps': Sleep.objects(sleeper__in=[someId]).order_by('sleeper', 'sleep_date'),
+        'sleep / sleeps: one user\'s rollup': SleepRollup.objects(user=someId),
+        'blogList: first page': Blog.objects().order_by('-create_date', '-id').limit(26),
+        'blogList: next page': Blog.objects(olderThan('create_date', someDate, someId)).order_by('-create_date', '-id').limit(26),
+        'blog: comments': Comment.objects(blog=someId),
+        'blogSearch: Blogs by words': Blog.objects.search_text('sleep'),
+        'blogSearch: Blogs by words and tag': Blog.objects(tag='sleep').search_text('sleep'),
+        'blogSearch: Comments by words': Comment.objects.search_text('sleep'),
+        'worker: next job due': Job.objects(
+            Q(status='queued', run_at__lte=someDate) | Q(status='running', locked_at__lt=someDate)
+        ).order_by('run_at'),
+    }
+
+
+def planStages(plan):
+    # The query plan is a tree of stages like IXSCAN (used an index) or COLLSCAN (read
+    # every document). This returns the names of all of them.
+    stages = []
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.append(plan['stage'])
+        for value in plan.values():
+            stages += planStages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            stages += planStages(value)
+    return stages
+
+
+@app.cli.command('indexes')
+@click.option('--build/--no-build', default=True, help='Create any missing indexes first.')
+def indexesCommand(build):
+    """Build the indexes and check that every route query uses one."""
+    if build:
+        for document in allDocuments():
+            document.ensure_indexes()
+            click.echo(f'Indexes ready for {document.__name__}')
+
+    failed = []
+    for name, queryset in routeQueries().items():
+        plan = queryset.explain()
+        stages = planStages(plan.get('queryPlanner', {}).get('winningPlan', plan))
+        if 'COLLSCAN' in stages:
+            failed.append(name)
+            click.echo(f'COLLSCAN  {name}')
+        else:
+            click.echo(f'ok        {name}  ({" > ".join(stages)})')
+
+    if failed:
+        raise click.ClickException(f'{len(failed)} route queries read the whole collection.')
+
+
+@app.cli.command('import-sleeps')
+@click.argument('file', type=click.File('r', encoding='utf-8'))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']), default='csv')
+@click.option('--email', help='Give every row to this user instead of using an email column.')
+def importSleepsCommand(file, fmt, email):
+    """Import a CSV or NDJSON file of sleeps (see sleepio.py)."""
+    user = None
+    if email:
+        user = User.objects(email=email).first()
+        if not user:
+            raise click.ClickException(f'No user with email {email}')
+    written, errors = importSleeps(file, fmt, user=user, allowEmails=not email)
+    for number, problem in errors:
+        click.echo(f'line {number}: {problem}')
+    click.echo(f'Imported {written} sleeps.')
+
+
+@app.cli.command('rebuild-rollups')
+@click.option('--email', help='Only rebuild this user.')
+def rebuildRollupsCommand(email):
+    """Work out every user's sleep totals again from their sleeps (see rollups.py)."""
+    users = User.objects(email=email) if email else User.objects()
+    count = 0
+    for user in users.only('id'):
+        rebuildRollup(user.id)
+        count += 1
+    if email and not count:
+        raise click.ClickException(f'No user with email {email}')
+    click.echo(f'Rebuilt {count} rollups.')
+
+
+@app.cli.command('worker')
+@click.option('--once', is_flag=True, help='Run the jobs that are due and then stop.')
+def workerCommand(once):
+    """Run background jobs like the weekly sleep digests (see jobs.py)."""
+    workLoop(once=once)
+
+
+@app.cli.command('assets')
+def assetsCommand():
+    """Shrink and fingerprint the static files into static/dist (see assets.py)."""
+    # Run before the site starts, so the old files can be deleted first
+    manifest = buildAssets(clean=True)
+    click.echo(f'Built {len(manifest)} static files.')
+
+
+@app.cli.command('backfill-sleep-dates')
+def backfillSleepDatesCommand():
+    """Give sleeps saved without a sleep_date the date they started on."""
+    # Sleeps from before sleep_date was filled in only have start and end. The graph, the
+    # stats and the totals all go by sleep_date so those sleeps were left out. Like
+    # sleepNew(), the date is the day the sleep started. Safe to run more than once.
+    collection = Sleep._get_collection()
+    operations = []
+    sleeperIds = set()
+    for sleep in collection.find({'sleep_date': None, 'start': {'$ne': None}}, {'start': 1, 'sleeper': 1}):
+        sleepDate = dt.datetime.combine(sleep['start'].date(), dt.time())
+        operations.append(UpdateOne({'_id': sleep['_id']}, {'$set': {'sleep_date': sleepDate}}))
+        sleeperIds.add(sleep.get('sleeper'))
+    for start in range(0, len(operations), 1000):
+        collection.bulk_write(operations[start:start + 1000], ordered=False)
+    # Their graphs and totals are out of date now
+    for user in User.objects(id__in=[userId for userId in sleeperIds if userId]).only('id'):
+        sleepsChanged(user)
+        rebuildRollup(user.id)
+    click.echo(f'Set sleep_date on {len(operations)} sleeps of {len(sleeperIds)} users.')
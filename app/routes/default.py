@@ -1,11 +1,26 @@
 from app import app
-from flask import render_template
+from flask import render_template, abort, Response
+from app.utils.metrics import metricsText, metricsEnabled, metricsAllowed
+from app.utils.pagecache import cachedPage
 
 # This is for rendering the home page
 @app.route('/') #ask why this isnt working
+# These pages only change when the code does, so the html is saved and reused. See utils/pagecache.py
+@cachedPage
 def index():
     return render_template('index.html')
 
 @app.route('/aboutus')
+@cachedPage
 def aboutus():
-    return render_template('aboutus.html')
\ No newline at end of file
+    return render_template('aboutus.html')
+# Numbers about how fast each page is, for a monitoring tool like Prometheus to read.
+# See utils/metrics.py
+@app.route('/metrics')
+def metrics():
+    # Turned off unless METRICS_TOKEN is set, and then only for requests that send it
+    if not metricsEnabled():
+        abort(404)
+    if not metricsAllowed():
+        abort(403)
+    return Response(metricsText(), mimetype='text/plain; version=0.0.4')
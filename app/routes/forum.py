@@ -4,11 +4,19 @@
 
 from app import app
 import mongoengine.errors
-from flask import render_template, flash, redirect, url_for
+from flask import render_template, flash, redirect, url_for, request
 from flask_login import current_user
 from app.classes.data import Blog, Comment
 from app.classes.forms import BlogForm, CommentForm
 from flask_login import login_required
+from app.utils.commenttree import buildThreads, threadPage
+from app.utils.conditional import conditionalPage, pageEtag
+from app.utils.database import readFromSecondaries
+from app.utils.loaders import loadUsers, refId
+from app.utils.pagecache import blogChanged, cachedFragment, makeKey, userKey
+from app.utils.pagination import keysetPage
+from app.utils.search import searchBlogs, searchChanged
+from app.utils.usercache import getUser
 import datetime as dt
 
 # This is the route to list all blogs
@@ -16,14 +24,36 @@ import datetime as dt
 @app.route('/blogs')
 # This means the user must be logged in to see this page
 @login_required
+# This page only reads so it can use a secondary database server. See database.py
+@readFromSecondaries
 def blogList():
-    # This retrieves all of the 'blogs' that are stored in MongoDB and places them in a
-    # mongoengine object as a list of dictionaries name 'blogs'.
-    blogs = Blog.objects()
-    # This renders (shows to the user) the blogs.html template. it also sends the blogs object 
-    # to the template as a variable named blogs.  The template uses a for loop to display
-    # each blog.
-    return render_template('blogs.html',blogs=blogs)
+    # This retrieves one page of the 'blogs' that are stored in MongoDB, newest first.
+    # keysetPage() reads the page links (?after= and ?before=) from the url. See pagination.py
+    # The list doesn't show the content of the blogs so it is left out with exclude()
+    page = keysetPage(Blog.objects().exclude('content'), 'create_date')
+    # Look up every author on this page with one query instead of one query per blog.
+    # See loaders.py
+    loadUsers(page.items, 'author')
+    # This renders (shows to the user) the blogs.html template. it also sends the blogs on 
+    # this page to the template as a variable named blogs.  The template uses a for loop to 
+    # display each blog.
+    return render_template('blogs.html',blogs=page.items,page=page)
+
+# This route searches the blogs and their comments for words. ?q= is what to search for,
+# ?tag= only shows blogs with that tag and ?page= is the page of results. See search.py
+@app.route('/blogs/search')
+@login_required
+def blogSearch():
+    query = request.args.get('q', '').strip()
+    tag = request.args.get('tag', '').strip()
+    page = request.args.get('page', 1, type=int)
+    results = []
+    pages = 1
+    if query:
+        results, pages = searchBlogs(query, tag=tag or None, page=page)
+        # Look up all the authors with one query. See loaders.py
+        loadUsers([blog for blog, score in results], 'author')
+    return render_template('blogsearch.html',query=query,tag=tag,results=results,page=page,pages=pages)
 
 # This route will get one specific blog and any comments associated with that blog.  
 # The blogID is a variable that must be passsed as a parameter to the function and 
@@ -33,7 +63,26 @@ def blogList():
 @app.route('/blog/<blogID>')
 # This route will only run if the user is logged in.
 @login_required
+# No @readFromSecondaries here: the version check has to see an edit the moment it is
+# saved, or the author could get a 304 and their page from before the edit. It is one
+# small lookup by id so the primary barely notices. See conditional.py and database.py
 def blog(blogID):
+    # ?page= picks which top level comments to show, ?thread= shows one whole thread
+    page = request.args.get('page', 1, type=int)
+    thread = request.args.get('thread')
+    # First read just the few fields that say which version of the blog this is. If the
+    # browser already has this version it gets a 304 and nothing else is looked up or
+    # rendered. cache_version also goes up when a comment changes. See utils/conditional.py
+    version = Blog.objects(id=blogID).only('author', 'create_date', 'modify_date', 'cache_version').as_pymongo().first()
+    if version:
+        # getUser() usually doesn't need the database, see usercache.py
+        author = getUser(version['author'])
+        etag = pageEtag('blog', blogID, version.get('cache_version', 0), author.cache_version, page, thread)
+        lastModified = version.get('modify_date') or version.get('create_date')
+        return conditionalPage(etag, lambda: renderBlog(blogID, page, thread), lastModified)
+    return renderBlog(blogID, page, thread)
+
+def renderBlog(blogID, page, thread):
     # retrieve the blog using the blogID
     thisBlog = Blog.objects.get(id=blogID)
     # If there are no comments the 'comments' object will have the value 'None'. Comments are 
@@ -41,9 +90,25 @@ def blog(blogID):
     # there is a field on the comment collection called 'blog' that is a reference the Blog
     # document it is related to.  You can use the blogID to get the blog and then you can use
     # the blog object (thisBlog in this case) to get all the comments.
-    theseComments = Comment.objects(blog=thisBlog)
-    # Send the blog object and the comments object to the 'blog.html' template.
-    return render_template('blog.html',blog=thisBlog,comments=theseComments)
+    # Comments can also be replies to other comments. All of them are fetched with this one
+    # query (oldest first) and put together into threads in memory, see commenttree.py
+    def renderComments():
+        theseComments = Comment.objects(blog=thisBlog).order_by('create_date')
+        # All the comment authors are looked up with one query. See loaders.py
+        theseComments = loadUsers(theseComments, 'author')
+        threads = buildThreads(theseComments)
+        # ?page=999 shows (and is labelled) the last page
+        threads, shownPage, pages = threadPage(threads, page, thread)
+        return render_template('includes/_blogcomments.html',blog=thisBlog,comments=threads,page=shownPage,pages=pages)
+    # The comments are only looked up and rendered when there isn't a saved copy for this
+    # version of the blog. The key has the user in it because only your own comments have
+    # edit and delete buttons. See utils/pagecache.py
+    key = makeKey('comments', thisBlog.id, thisBlog.cache_version, page, thread, userKey())
+    comments = cachedFragment(key, renderComments)
+    # Checking the author's id doesn't need the author to be looked up
+    isAuthor = refId(thisBlog._data.get('author')) == current_user.id
+    # Send the blog object and the comments html to the 'blog.html' template.
+    return render_template('blog.html',blog=thisBlog,comments=comments,isAuthor=isAuthor)
 
 # This route will delete a specific blog.  You can only delete the blog if you are the author.
 # <blogID> is a variable sent to this route by the user who clicked on the trash can in the 
@@ -58,17 +123,17 @@ def blogDelete(blogID):
     # check to see if the user that is making this request is the author of the blog.
     # current_user is a variable provided by the 'flask_login' library.
     if current_user == deleteBlog.author:
-        # delete the blog using the delete() method from Mongoengine
+        # delete the blog using the delete() method from Mongoengine. Its saved html
+        # doesn't need clearing because nothing asks for this blog's id any more.
         deleteBlog.delete()
+        searchChanged()
         # send a message to the user that the blog was deleted.
         flash('The Blog was deleted.')
     else:
         # if the user is not the author tell them they were denied.
         flash("You can't delete a blog you don't own.")
-    # Retrieve all of the remaining blogs so that they can be listed.
-    blogs = Blog.objects()  
     # Send the user to the list of remaining blogs.
-    return render_template('blogs.html',blogs=blogs)
+    return redirect(url_for('blogList'))
 
 # This route actually does two things depending on the state of the if statement 
 # 'if form.validate_on_submit()'. When the route is first called, the form has not 
@@ -98,12 +163,13 @@ def blogNew():
             subject = form.subject.data,
             content = form.content.data,
             tag = form.tag.data,
-            author = current_user.id,
-            # This sets the modifydate to the current datetime.
-            modify_date = dt.datetime.utcnow
+            author = current_user.id
+            # modify_date is left empty until the blog is edited so the blog page only
+            # says 'modified' for blogs that really were. create_date is set by itself.
         )
         # This is a method that saves the data to the mongoDB database.
         newBlog.save()
+        searchChanged()
 
         # Once the new blog is saved, this sends the user to that blog using redirect.
         # and url_for. Redirect is used to redirect a user to different route so that 
@@ -143,8 +209,11 @@ def blogEdit(blogID):
             subject = form.subject.data,
             content = form.content.data,
             tag = form.tag.data,
-            modify_date = dt.datetime.utcnow
+            modify_date = dt.datetime.utcnow,
+            # so the saved html of this blog isn't used any more. See utils/pagecache.py
+            inc__cache_version = 1
         )
+        searchChanged()
         # After updating the document, send the user to the updated blog using a redirect.
         return redirect(url_for('blog',blogID=blogID))
 
@@ -179,9 +248,31 @@ def commentNew(blogID):
             content = form.content.data
         )
         newComment.save()
+        searchChanged()
+        blogChanged(blogID)
         return redirect(url_for('blog',blogID=blogID))
     return render_template('commentform.html',form=form,blog=blog)
 
+# A reply is a comment that points at the comment it answers in its 'comment' field
+@app.route('/comment/reply/<commentID>', methods=['GET', 'POST'])
+@login_required
+def commentReply(commentID):
+    parentComment = Comment.objects.get(id=commentID)
+    blog = parentComment.blog
+    form = CommentForm()
+    if form.validate_on_submit():
+        newComment = Comment(
+            author = current_user.id,
+            blog = blog.id,
+            comment = parentComment.id,
+            content = form.content.data
+        )
+        newComment.save()
+        searchChanged()
+        blogChanged(blog.id)
+        return redirect(url_for('blog',blogID=blog.id))
+    return render_template('commentform.html',form=form,blog=blog)
+
 @app.route('/comment/edit/<commentID>', methods=['GET', 'POST'])
 @login_required
 def commentEdit(commentID):
@@ -194,8 +285,10 @@ def commentEdit(commentID):
     if form.validate_on_submit():
         editComment.update(
             content = form.content.data,
-            modifydate = dt.datetime.utcnow
+            modify_date = dt.datetime.utcnow
         )
+        searchChanged()
+        blogChanged(editComment.blog.id)
         return redirect(url_for('blog',blogID=editComment.blog.id))
 
     form.content.data = editComment.content
@@ -207,5 +300,7 @@ def commentEdit(commentID):
 def commentDelete(commentID): 
     deleteComment = Comment.objects.get(id=commentID)
     deleteComment.delete()
+    searchChanged()
+    blogChanged(deleteComment.blog.id)
     flash('The comments was deleted.')
     return redirect(url_for('blog',blogID=deleteComment.blog.id)) 
@@ -1,6 +1,11 @@
 
 # Python standard libraries
+import asyncio
 import json
+import re
+import threading
+import time
+import httpx
 from app import app, login_manager
 from flask import redirect, request, url_for, flash
 from flask_login import (
@@ -10,16 +15,32 @@ from flask_login import (
     logout_user,
 )
 from oauthlib.oauth2 import WebApplicationClient
-import requests
 from app.classes.data import User
+from app.utils.aio import loopResource, onLoop, submit
+from app.utils.asyncdb import findOneAndUpdate
 from app.utils.secrets import getSecrets
+from app.utils.usercache import forgetUser, getUser
 import mongoengine.errors
 
 #get all the credentials for google
 secrets = getSecrets()
 
-# OAuth2 client setup
-client = WebApplicationClient(secrets['GOOGLE_CLIENT_ID'])
+# All the calls to Google share one httpx AsyncClient. It keeps connections open
+# (keep-alive) so a login doesn't have to set up a new secure connection for every call.
+# The login still holds its worker thread while it waits on Google, see aio.py.
+# OAUTH_POOL_SIZE is how many open connections are kept per worker process.
+OAUTH_POOL_SIZE = int(secrets.get('OAUTH_POOL_SIZE', 10))
+OAUTH_TIMEOUT = float(secrets.get('OAUTH_TIMEOUT', 10))
+
+def httpClient():
+    # The client lives on the background loop with its connections, see aio.py
+    def make():
+        limits = httpx.Limits(max_connections=OAUTH_POOL_SIZE, max_keepalive_connections=OAUTH_POOL_SIZE)
+        return httpx.AsyncClient(limits=limits, timeout=OAUTH_TIMEOUT)
+    return loopResource('httpx', make)
+
+async def http(method, url, **kwargs):
+    return await onLoop(lambda: httpClient().request(method, url, **kwargs))
 
 # When a route is decorated with @login_required and fails this code is run
 # https://flask-login.readthedocs.io/en/latest/#flask_login.LoginManager.unauthorized_handler
@@ -32,24 +53,90 @@ def unauthorized():
 # https://flask-login.readthedocs.io/en/latest/#flask_login.LoginManager.user_loader
 @login_manager.user_loader
 def load_user(id):
+    # getUser() keeps recently used users in memory so this usually doesn't need the 
+    # database. See utils/usercache.py
     try:
-        return User.objects.get(pk=id)
-    except mongoengine.errors.DoesNotExist:
+        return getUser(id)
+    except (mongoengine.errors.DoesNotExist, mongoengine.errors.ValidationError):
         flash("Something strange has happened. This user doesn't exist. Please click logout.")
-        return redirect(url_for('index'))
-
-def get_google_provider_cfg():
-    return requests.get(secrets['GOOGLE_DISCOVERY_URL']).json()
+        return None
+
+# Google's discovery document (the list of login urls) almost never changes, so it is
+# kept here for as long as Google's Cache-Control header says it can be. After that, 
+# for the 'stale-while-revalidate' time, the old copy is still used while a new one
+# is fetched in the background so no login has to wait for it.
+# 'fetching' is the request to Google that is running right now, if there is one. All
+# the logins that need a new copy at the same time wait for that one request.
+providerCache = {'cfg': None, 'freshUntil': 0, 'staleUntil': 0, 'fetching': None}
+# An RLock because a fetch that is already done calls fetchDone() straight away
+providerLock = threading.RLock()
+
+def cacheLifetimes(response):
+    # Returns (max-age, stale-while-revalidate) in seconds from the Cache-Control header
+    cacheControl = response.headers.get('Cache-Control', '').lower()
+    if 'no-store' in cacheControl or 'no-cache' in cacheControl:
+        return 0, 0
+    maxAge = re.search(r'max-age=(\d+)', cacheControl)
+    swr = re.search(r'stale-while-revalidate=(\d+)', cacheControl)
+    maxAge = int(maxAge.group(1)) if maxAge else 0
+    # The Age header says how long the response already sat in a cache on the way here
+    try:
+        maxAge = max(maxAge - int(response.headers.get('Age', 0)), 0)
+    except ValueError:
+        pass
+    return maxAge, int(swr.group(1)) if swr else 0
+
+async def fetchProviderCfg():
+    response = await http('GET', secrets['GOOGLE_DISCOVERY_URL'])
+    response.raise_for_status()
+    cfg = response.json()
+    maxAge, swr = cacheLifetimes(response)
+    now = time.monotonic()
+    with providerLock:
+        providerCache['cfg'] = cfg
+        providerCache['freshUntil'] = now + maxAge
+        providerCache['staleUntil'] = now + maxAge + swr
+    return cfg
+
+def fetchDone(fetching):
+    with providerLock:
+        if providerCache['fetching'] is fetching:
+            providerCache['fetching'] = None
+
+def startFetch():
+    # Call with providerLock held. Returns the fetch that is running, or starts one.
+    if providerCache['fetching'] is None:
+        providerCache['fetching'] = submit(fetchProviderCfg)
+        providerCache['fetching'].add_done_callback(fetchDone)
+    return providerCache['fetching']
+
+async def get_google_provider_cfg():
+    now = time.monotonic()
+    with providerLock:
+        cfg = providerCache['cfg']
+        if cfg and now < providerCache['freshUntil']:
+            return cfg
+        fetching = startFetch()
+        if cfg and now < providerCache['staleUntil']:
+            # Use the old copy while the new one is fetched. If that fails the old copy
+            # is kept and the next login tries again.
+            return cfg
+    return await asyncio.wrap_future(fetching)
+
+# A new OAuth client for every login. The client remembers the token it was given, so
+# one shared client could hand one person's token to someone logging in at the same time.
+def oauthClient():
+    return WebApplicationClient(secrets['GOOGLE_CLIENT_ID'])
 
 @app.route("/login")
-def login():
+async def login():
     # Find out what URL to hit for Google login
-    google_provider_cfg = get_google_provider_cfg()
+    google_provider_cfg = await get_google_provider_cfg()
     authorization_endpoint = google_provider_cfg["authorization_endpoint"]
 
     # Use library to construct the request for login and provide
     # scopes that let you retrieve user's profile from Google
-    request_uri = client.prepare_request_uri(
+    request_uri = oauthClient().prepare_request_uri(
         authorization_endpoint,
         redirect_uri=request.base_url + "/callback",
         scope=["openid", "email", "profile"],
@@ -59,13 +146,14 @@ def login():
 
 
 @app.route("/login/callback")
-def callback():
+async def callback():
     # Get authorization code Google sent back to you
     code = request.args.get("code")
+    client = oauthClient()
 
     # Find out what URL to hit to get tokens that allow you to ask for
     # things on behalf of a user
-    google_provider_cfg = get_google_provider_cfg()
+    google_provider_cfg = await get_google_provider_cfg()
     token_endpoint = google_provider_cfg["token_endpoint"]
 
     # Prepare and send request to get tokens! Yay tokens!
@@ -75,10 +163,11 @@ def callback():
         redirect_url=request.base_url,
         code=code,
     )
-    token_response = requests.post(
+    token_response = await http(
+        'POST',
         token_url,
         headers=headers,
-        data=body,
+        content=body,
         auth=(secrets['GOOGLE_CLIENT_ID'], secrets['GOOGLE_CLIENT_SECRET']),
     )
 
@@ -90,10 +179,12 @@ def callback():
     # including their Google Profile Image and Email
     userinfo_endpoint = google_provider_cfg["userinfo_endpoint"]
     uri, headers, body = client.add_token(userinfo_endpoint)
-    userinfo_response = requests.get(uri, headers=headers, data=body)
+    userinfo_response = await http('GET', uri, headers=headers, content=body)
+    # Turn the response into a dictionary once and use that below
+    userinfo = userinfo_response.json()
 
     ### Example info that comes back from google
-    # userinfo_response.json() --> {
+    # userinfo --> {
     # 'sub': '118043475517321263044', 
     # 'name': 'STEPHEN WRIGHT', 
     # 'given_name': 'STEPHEN', 
@@ -106,51 +197,43 @@ def callback():
     # 'hd': 'ousd.org'
     # }
 
-    if userinfo_response.json().get("hd") != "ousd.org":
+    if userinfo.get("hd") != "ousd.org":
         flash("You must have an ousd.org email account to access this site.")
         return "You must have an ousd.org email account to access this site.", 400
 
     # We want to make sure their email is verified.
     # The user authenticated with Google, authorized our
     # app, and now we've verified their email through Google!
-    if userinfo_response.json().get("email_verified"):
-        gid = userinfo_response.json()["sub"]
-        gmail = userinfo_response.json()["email"]
-        gprofile_pic = userinfo_response.json()["picture"]
-        gname = userinfo_response.json()["name"]
-        gfname = userinfo_response.json()["given_name"]
-        glname = userinfo_response.json()["family_name"]
+    if userinfo.get("email_verified"):
+        gid = userinfo["sub"]
+        gmail = userinfo["email"]
+        gprofile_pic = userinfo["picture"]
+        gname = userinfo["name"]
+        gfname = userinfo["given_name"]
+        glname = userinfo["family_name"]
     else:
         return "User email not available or not verified by Google.", 400
 
-    # Get user from DB or create new user
-    try:
-        thisUser=User.objects.get(email=gmail)
-    # if the user does not exist, create them and make sure they are ousd.org
-    except mongoengine.errors.DoesNotExist:
-        if userinfo_response.json().get("hd") == "ousd.org":
-            thisUser = User(
-                gid=gid, 
-                gname=gname, 
-                email=gmail, 
-                gprofile_pic=gprofile_pic,
-                fname = gfname,
-                lname = glname
-            )
-            thisUser.save()
-            thisUser.reload()
-        else:
-            flash("You must have an ousd.org email to login to this site.")
-            return redirect(url_for('index'))
-    else:
-        thisUser.update(
-            gid=gid, 
-            gname=gname, 
-            gprofile_pic=gprofile_pic,
-            fname = gfname,
-            lname = glname
-        )
-    thisUser.reload()
+    # Get user from DB or create new user. This is one upsert instead of a find and then
+    # a save or an update: the Google fields are always set, and the rest of a new
+    # user's defaults are only written if the user is being created.
+    googleFields = dict(
+        gid=gid, 
+        gname=gname, 
+        gprofile_pic=gprofile_pic,
+        fname = gfname,
+        lname = glname
+    )
+    newUser = User(email=gmail, **googleFields).to_mongo().to_dict()
+    # cache_version goes up so other workers forget their copy of this user, see usercache.py
+    update = {
+        '$set': googleFields,
+        '$inc': {'cache_version': 1},
+        '$setOnInsert': {key: value for key, value in newUser.items()
+                         if key not in googleFields and key not in ('_id', 'cache_version')},
+    }
+    thisUser = await findOneAndUpdate(User, {'email': gmail}, update, upsert=True)
+    forgetUser(thisUser.id)
 
     # Begin user session by logging the user in
     login_user(thisUser)
@@ -1,13 +1,25 @@
 from app import app
 import mongoengine.errors
-from flask import render_template, flash, redirect, url_for
+from flask import render_template, flash, redirect, url_for, abort, Response, request, stream_with_context, jsonify
 from flask_login import current_user
 from app.classes.data import Sleep, User
-from app.classes.forms import SleepForm, ConsentForm
+from app.classes.forms import SleepForm, ConsentForm, SleepImportForm
 from flask_login import login_required
+import asyncio
 import datetime as dt
-import matplotlib.pyplot as plt
-#import numpy as np
+import io
+from app.utils.graphs import getSleepGraph, sleepsChanged, GRAPH_FORMATS
+from app.utils.conditional import conditionalPage, pageEtag
+from app.utils.database import readFromSecondaries
+from app.utils.jobs import enqueue
+from app.utils.pagecache import cachedPage
+from app.utils.loaders import loadUsers
+from app.utils.pagination import keysetPage
+from app.utils.sleepio import EXPORT_FORMATS, canExportCohort, exportRows, importSleeps
+from app.utils.usercache import getUser, userChanged
+from app.utils.series import DEFAULT_POINTS, MIN_POINTS, MAX_POINTS, parseDay, sleepSeries
+from app.utils.rollups import rollupAdd, rollupChange, rollupRemove, rollupSummary, rollupSummaryAsync
+from app.utils.sleepstats import ratingDistributions, minsToSleepPercentiles
 
 @app.route('/consent', methods=['GET', 'POST'])
 def consent():
@@ -23,6 +35,7 @@ def consent():
             adult_lname = form.adult_lname.data,
             adult_email = form.adult_email.data
         )
+        userChanged(current_user)
         return redirect(url_for('myProfile'))
 
     form.consent.process_data(current_user.consent)
@@ -32,7 +45,25 @@ def consent():
     return render_template("consentform.html", form=form)
 
 
+# This is the "Send Sleep Info" button on the profile page. The email is sent by the
+# background worker so this page doesn't have to wait for the mail server. See digest.py
+@app.route('/consent/send')
+@login_required
+def consentSend():
+    if not current_user.consent or not current_user.adult_email:
+        flash("Fill out the consent form first.")
+        return redirect(url_for('consent'))
+    # The unique key allows one email per student per day, however often the button is clicked
+    today = dt.datetime.utcnow().date().isoformat()
+    job = enqueue('weekly-digests', {'userIds': [str(current_user.id)]}, uniqueKey=f'digest-{current_user.id}-{today}')
+    if job is None:
+        flash(f"Your sleep info was already sent to {current_user.adult_email} today.")
+    else:
+        flash(f"Your sleep info for the last week will be sent to {current_user.adult_email}.")
+    return redirect(url_for('myProfile'))
+
 @app.route('/overview')
+@cachedPage
 def overview():
     return render_template('overview.html')
 
@@ -43,10 +74,11 @@ def sleepNew():
     if form.validate_on_submit():
         startDT = dt.datetime.combine(form.sleep_date.data, form.starttime.data)
         endDT = dt.datetime.combine(form.wake_date.data, form.endtime.data)
-        diff = startDT - endDT
+        diff = endDT - startDT
         hours = diff.seconds/60/60
         newSleep = Sleep(
             hours = hours,
+            sleep_date = dt.datetime.combine(form.sleep_date.data, dt.time()),
             sleeper = current_user,
             rating = form.rating.data,
             start = startDT,
@@ -55,6 +87,9 @@ def sleepNew():
             minstosleep = form.minstosleep.data,
         )
         newSleep.save()
+        sleepsChanged(current_user)
+        # Add this night to the user's totals. See utils/rollups.py
+        rollupAdd(newSleep)
         return redirect(url_for("sleep",sleepId=newSleep.id))
     
     if form.submit.data:
@@ -82,14 +117,20 @@ def sleepEdit(sleepId):
         diff = endDT - startDT
         hours = diff.seconds/60/60
 
-        editSleep.update(
+        changes = dict(
             hours = hours,
+            sleep_date = dt.datetime.combine(form.sleep_date.data, dt.time()),
             rating = form.rating.data,
             start = startDT,
             end = endDT,
             feel = form.feel.data,
-            minstosleep = form.minstosleep.data
+            minstosleep = form.minstosleep.data,
+            modify_date = dt.datetime.utcnow
         )
+        editSleep.update(**changes)
+        sleepsChanged(current_user)
+        # Swap the old values for the new ones in the user's totals. See utils/rollups.py
+        rollupChange(editSleep, changes)
         return redirect(url_for("sleep",sleepId=editSleep.id))
     
     form.sleep_date.process_data(editSleep.start.date())
@@ -105,15 +146,35 @@ def sleepEdit(sleepId):
 @login_required
 
 def sleep(sleepId):
+    # Read only who the sleep belongs to and when it changed. The page also shows the
+    # sleeper's averages, and their cache_version goes up whenever any of their sleeps
+    # change (see sleepsChanged() in graphs.py). If the browser already has this version
+    # it gets a 304 without the sleep being loaded. See utils/conditional.py
+    version = Sleep.objects(id=sleepId).only('sleeper', 'modify_date').as_pymongo().first()
+    if version:
+        sleeper = getUser(version['sleeper'])
+        etag = pageEtag('sleep', sleepId, version.get('modify_date'), sleeper.id, sleeper.cache_version)
+        return conditionalPage(etag, lambda: renderSleep(sleepId), version.get('modify_date'))
+    return renderSleep(sleepId)
+
+def renderSleep(sleepId):
     thisSleep = Sleep.objects.get(id=sleepId)
-    return render_template("sleep.html",sleep=thisSleep)
+    # The averages come from the sleeper's rollup, one small document. See rollups.py
+    summary = rollupSummary(thisSleep.sleeper)
+    return render_template("sleep.html",sleep=thisSleep,summary=summary)
 
 @app.route('/sleeps')
 @login_required
+# This page only reads so it can use a secondary database server. See database.py
+@readFromSecondaries
 
 def sleeps():
-    sleeps = Sleep.objects()
-    return render_template("sleeps.html",sleeps=sleeps)
+    # Only one page of sleeps is loaded at a time, see pagination.py
+    page = keysetPage(Sleep.objects(), 'sleep_date')
+    # Look up every sleeper on this page with one query, see loaders.py
+    loadUsers(page.items, 'sleeper')
+    summary = rollupSummary(current_user)
+    return render_template("sleeps.html",sleeps=page.items,page=page,summary=summary)
 
 @app.route('/sleep/delete/<sleepId>')
 @login_required
@@ -121,39 +182,119 @@ def sleeps():
 def sleepDelete(sleepId):
     delSleep = Sleep.objects.get(id=sleepId)
     sleepDate = delSleep.sleep_date
+    sleeper = delSleep.sleeper
     delSleep.delete()
+    sleepsChanged(sleeper)
+    rollupRemove(delSleep)
     flash(f"sleep with date {sleepDate} has been deleted.")
     return redirect(url_for('sleeps'))
 
 @app.route('/sleepgraph')
 @login_required
+@readFromSecondaries
 
-def sleepgraph():
-    sleeps = Sleep.objects()
+async def sleepgraph():
+    # NumPy is only imported when this page is first used, see analytics.py
+    from app.utils.analytics import userAnalytics
+    # The helpers get the real User, not the current_user stand-in
+    user = current_user._get_current_object()
+    # The four are independent so they run at the same time, each in a pool thread (see
+    # asyncdb.py). This request's thread still waits for all of them, so the page is as
+    # slow as the slowest one instead of all four added up, but no thread is freed.
+    summary, distributions, percentiles, analytics = await asyncio.gather(
+        rollupSummaryAsync(user),
+        ratingDistributions(user),
+        minsToSleepPercentiles(user),
+        asyncio.to_thread(userAnalytics, user),
+    )
+    # The chart is drawn by the browser from /api/sleeps/series. The picture from the
+    # route below is only shown when JavaScript is turned off.
+    return render_template('sleepgraph.html',
+        images=[url_for('sleepgraphImage',fmt='png')],
+        summary=summary,
+        distributions=distributions,
+        percentiles=percentiles,
+        analytics=analytics
+    )
 
+# The numbers for the chart on the sleep graph page, as JSON. ?from= and ?to= (like
+# 2022-11-28) pick the dates and ?points= is the most nights to send back. Long
+# histories are cut down to that many points on the server. See series.py
+@app.route('/api/sleeps/series')
+@login_required
 
-    hours = []
-    dates = []
-    colors = []
-    for sleep in sleeps:
-        hours.append(sleep.hours)
-        dates.append(sleep.start.date())   
-        if sleep.rating >=4:
-            colors.append('green')
-        elif sleep.rating == 3:
-            colors.append('yellow')
-        else:
-            colors.append('red')
-    
-    fig, ax = plt.subplots()
+def sleepSeriesApi():
+    try:
+        since = parseDay(request.args.get('from'))
+        until = parseDay(request.args.get('to'))
+    except ValueError:
+        abort(400)
+    points = min(max(request.args.get('points', DEFAULT_POINTS, type=int), MIN_POINTS), MAX_POINTS)
+    # The user's cache_version (part of every ETag) goes up when their sleeps change, so
+    # the browser can reuse the last answer until then. See conditional.py
+    etag = pageEtag('series', since, until, points)
+    return conditionalPage(etag, lambda: jsonify(sleepSeries(current_user, since, until, points)))
+
+# Sleep patterns of every student who consented, as JSON. Only for the people who can
+# export the cohort's sleeps. See analytics.py
+@app.route('/sleeps/analytics')
+@login_required
 
-    ax.scatter(dates, hours, marker='o', c=colors)
+def sleepAnalytics():
+    if not canExportCohort(current_user):
+        abort(403)
+    from app.utils.analytics import cohortAnalytics
+    return jsonify(cohortAnalytics())
 
+@app.route('/sleepgraph.<fmt>')
+@login_required
+
+def sleepgraphImage(fmt):
+    if fmt not in GRAPH_FORMATS:
+        abort(404)
+    image = getSleepGraph(current_user, fmt)
+    response = Response(image, mimetype=GRAPH_FORMATS[fmt])
+    # The picture is different for every user so browsers may keep it but shared caches may not
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+# Download sleeps as a file. ?format= is csv or ndjson. ?scope=cohort gets the sleeps of
+# every student who consented to share them (only for admins). See sleepio.py
+@app.route('/sleeps/export')
+@login_required
 
-    #ax.legend()
-    plt.yticks(hours)
-    plt.xticks(dates, rotation=45)
-    #plt.gcf().set_size_inches(10, 5)
-    fig.savefig("app/static/graphs/sleep.png", bbox_inches="tight")
-    #fig.show()
-    return render_template('sleepgraph.html',images=['sleep.png'])
\ No newline at end of file
+def sleepExport():
+    fmt = request.args.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        abort(404)
+    if request.args.get('scope') == 'cohort':
+        if not canExportCohort(current_user):
+            abort(403)
+        sleeperIds = User.objects(consent=True).scalar('id')
+        filename = f'sleeps-cohort.{fmt}'
+    else:
+        sleeperIds = [current_user.id]
+        filename = f'sleeps.{fmt}'
+    mimetype, lines = EXPORT_FORMATS[fmt]
+    # The lines are made while they are being sent so the whole file is never in memory
+    response = Response(stream_with_context(lines(exportRows(sleeperIds))), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+# Upload a file of sleeps, like one made by /sleeps/export
+@app.route('/sleeps/import', methods=['GET', 'POST'])
+@login_required
+
+def sleepImport():
+    form = SleepImportForm()
+    if form.validate_on_submit():
+        stream = io.TextIOWrapper(form.file.data.stream, encoding='utf-8', newline='')
+        written, errors = importSleeps(stream, form.format.data, user=current_user)
+        flash(f"Imported {written} sleeps.")
+        if errors:
+            # Shown on the page instead of flashed. Flashed messages are kept in the
+            # session cookie, and a long list can be more than a cookie can hold.
+            return render_template("sleepimport.html",form=form,errors=errors)
+        return redirect(url_for('sleeps'))
+    return render_template("sleepimport.html",form=form)
@@ -1,9 +1,12 @@
 from app import app
 from flask_login.utils import login_required
-from flask import render_template, redirect, flash, url_for
+from flask import render_template, redirect, flash, url_for, request, abort, Response
 from app.classes.data import User
 from app.classes.forms import ProfileForm
 from flask_login import current_user
+import mongoengine.errors
+from app.utils.images import processUpload, saveAvatar, pickAvatar, getFS
+from app.utils.usercache import userChanged
 
 # These routes and functions are for accessing and editing user profiles.
 
@@ -27,6 +30,16 @@ def profileEdit():
     form = ProfileForm()
     # This asks if the form was valid when it was submitted
     if form.validate_on_submit():
+        # processUpload() checks that the new profile image really is a picture and makes
+        # the smaller copies. It runs before anything is saved so a bad picture doesn't
+        # leave the profile half changed. See utils/images.py
+        renditions = None
+        if form.image.data:
+            try:
+                renditions = processUpload(form.image.data)
+            except ValueError as error:
+                flash(str(error))
+                return render_template('profileform.html', form=form)
         # if the form was valid then this gets an object that represents the currUser's data
         currUser = User.objects.get(id=current_user.id)
         # This updates the data on the user record that was collected from the form
@@ -34,13 +47,11 @@ def profileEdit():
             lname = form.lname.data,
             fname = form.fname.data,
         )
-        # This updates the profile image
-        if form.image.data:
-            if currUser.image:
-                currUser.image.delete()
-            currUser.image.put(form.image.data, content_type = 'image/jpeg')
-            # This saves all the updates
-            currUser.save()
+        # saveAvatar() stores the picture's copies
+        if renditions:
+            saveAvatar(currUser, renditions)
+        # Let every worker know this user's cached copy is out of date. See utils/usercache.py
+        userChanged(currUser)
         # Then sends the user to their profle page
         return redirect(url_for('myProfile'))
 
@@ -50,3 +61,54 @@ def profileEdit():
     form.lname.data = current_user.lname
 
     return render_template('profileform.html', form=form)
+
+
+# GridFS stores files in chunks (255KB each by default). This hands the chunks to
+# Flask one at a time so the whole picture never has to sit in memory.
+def streamFile(gridOut):
+    chunk = gridOut.readchunk()
+    while chunk:
+        yield chunk
+        chunk = gridOut.readchunk()
+
+# This sends a user's profile picture. Templates get the url for it from avatarUrl()
+# in app/__init__.py. ?s= is the size in pixels the page is going to show it at.
+@app.route('/avatar/<userId>')
+@login_required
+def avatar(userId):
+    # only() gets just the picture fields. For a FileField that is only the id of the 
+    # file in GridFS, not the picture itself.
+    try:
+        user = User.objects(id=userId).only('image', 'avatars').first()
+    except mongoengine.errors.ValidationError:
+        abort(404)
+    if not user or not user.image:
+        abort(404)
+    try:
+        size = int(request.args.get('s', 128))
+    except ValueError:
+        size = 128
+
+    # Pick the smallest saved copy that is big enough. Pictures uploaded before the
+    # copies existed only have the original.
+    # Browsers that can show WebP list it by name in their Accept header
+    acceptWebp = any(mimetype == 'image/webp' and quality > 0 for mimetype, quality in request.accept_mimetypes)
+    gridId = pickAvatar(user.avatars, size, acceptWebp)
+
+    # Every upload gets new GridFS ids so the id makes a good ETag. If the browser
+    # already has this picture we can answer without reading the file.
+    etag = str(gridId or user.image.grid_id)
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        gridOut = getFS().get(gridId) if gridId else user.image.get()
+        response = Response(streamFile(gridOut), mimetype=gridOut.content_type or 'image/jpeg')
+        response.content_length = gridOut.length
+        response.last_modified = gridOut.upload_date
+    response.set_etag(etag)
+    # The same url can send WebP or JPEG depending on what the browser says it accepts
+    response.vary.add('Accept')
+    # The picture is only for logged in users so shared caches shouldn't keep it, but the
+    # browser can keep it for a year because a new picture gets a new url.
+    response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
@@ -0,0 +1,71 @@
+# Helpers for the async views (the routes written with 'async def').
+#
+# Flask runs every async view in a brand new event loop that is thrown away when the
+# request ends. Clients like httpx (HTTP, see login.py) keep open connections that
+# belong to the loop they were made in, so they can't live in those short loops. Instead
+# each worker process has one event loop running in a background thread. The clients
+# live there and keep their connections open between requests, and views hand their
+# calls to it with onLoop():
+#
+#     response = await onLoop(lambda: httpClient().get(url))
+#
+# The database doesn't need this: asyncdb.py runs the normal pymongo queries in worker
+# threads.
+#
+# The view's own thread still waits until its calls are done, so this doesn't free the
+# worker for other requests. It lets the calls inside one view (asyncio.gather) wait at
+# the same time, and lets every request share the same open connections.
+
+import asyncio
+import os
+import threading
+
+_lock = threading.Lock()
+_loop = None
+_loopPid = None
+# Things that belong to the background loop (like the HTTP client), made by
+# loopResource(). They are thrown away if the loop is replaced.
+_resources = {}
+
+
+def backgroundLoop():
+    # The loop is started the first time it is needed, and again in a new process after
+    # gunicorn forks because threads don't survive a fork.
+    global _loop, _loopPid
+    with _lock:
+        if _loop is None or _loopPid != os.getpid():
+            _loop = asyncio.new_event_loop()
+            _loopPid = os.getpid()
+            _resources.clear()
+            threading.Thread(target=_loop.run_forever, name='aio-loop', daemon=True).start()
+        return _loop
+
+
+def loopResource(name, make):
+    # Only call this from code running on the background loop
+    if name not in _resources:
+        _resources[name] = make()
+    return _resources[name]
+
+
+async def _call(function):
+    result = function()
+    if asyncio.isfuture(result) or asyncio.iscoroutine(result):
+        result = await result
+    return result
+
+
+def submit(function):
+    # Starts function() on the background loop and returns a concurrent.futures.Future.
+    # function is called on the loop, so the clients it uses are made there too.
+    return asyncio.run_coroutine_threadsafe(_call(function), backgroundLoop())
+
+
+async def onLoop(function):
+    # Await function() running on the background loop from any other event loop
+    return await asyncio.wrap_future(submit(function))
+
+
+def runSync(function, timeout=None):
+    # For code that isn't async: wait for function() on the background loop
+    return submit(function).result(timeout)
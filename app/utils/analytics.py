@@ -0,0 +1,204 @@
+# Statistics about sleep patterns, worked out with NumPy. Instead of making a mongoengine
+# Sleep object for every night (slow when there are millions) the sleeps are read with a
+# plain pymongo cursor that only asks for the needed fields, and each field is put into
+# one NumPy array (a "column"). The maths then runs on whole columns at once instead of
+# looping over the nights in Python.
+#
+#   userAnalytics(user)   one student's patterns (shown on the sleep graph page)
+#   cohortAnalytics()     every student who consented (the /sleeps/analytics route)
+#
+# What is calculated:
+#   sleep debt          hours short of SLEEP_TARGET_HOURS, added up over the last
+#                       DEBT_DAYS days of logged nights
+#   bedtime consistency how spread out bedtimes are, in minutes. Times go round the clock
+#                       (23:30 and 00:30 are an hour apart, not 23 hours) so this uses a
+#                       circular standard deviation.
+#                       https://en.wikipedia.org/wiki/Directional_statistics
+#   correlation         between how long someone slept and how they rated the sleep
+#                       (-1 to 1, near 0 means no connection)
+#   weekend effect      Friday and Saturday nights compared with school nights
+
+import datetime as dt
+import math
+import os
+
+import numpy as np
+from app.classes.data import Sleep, User
+from app.utils.database import routedCollection
+
+SLEEP_TARGET_HOURS = float(os.environ.get("SLEEP_TARGET_HOURS", 9))
+DEBT_DAYS = int(os.environ.get("SLEEP_DEBT_DAYS", 14))
+# Rows are turned into arrays this many at a time so there are never millions of
+# Python objects in memory at once
+CHUNK_SIZE = 50_000
+NUMBER_FIELDS = ('hours', 'rating', 'feel', 'minstosleep')
+DATE_FIELDS = ('sleep_date', 'start', 'end')
+MINUTES_PER_DAY = 24 * 60
+# Friday and Saturday nights (Monday is 0)
+WEEKEND_NIGHTS = (4, 5)
+
+
+def toColumns(rows):
+    columns = {}
+    # None becomes NaN ("not a number") in a float array and NaT ("not a time") in a
+    # datetime array, so missing values are easy to leave out later
+    for field in NUMBER_FIELDS:
+        columns[field] = np.array([row.get(field) for row in rows], dtype=float)
+    for field in DATE_FIELDS:
+        columns[field] = np.array([row.get(field) for row in rows], dtype='datetime64[m]')
+    columns['sleeper'] = np.array([str(row.get('sleeper')) for row in rows], dtype=object)
+    return columns
+
+
+def loadColumns(sleeperIds, since=None):
+    query = {'sleeper': {'$in': list(sleeperIds)}}
+    if since:
+        query['sleep_date'] = {'$gte': since}
+    projection = dict.fromkeys(('sleeper',) + NUMBER_FIELDS + DATE_FIELDS, 1)
+    projection['_id'] = 0
+    cursor = routedCollection(Sleep).find(query, projection, batch_size=10_000)
+    chunks = []
+    rows = []
+    for row in cursor:
+        rows.append(row)
+        if len(rows) >= CHUNK_SIZE:
+            chunks.append(toColumns(rows))
+            rows = []
+    if rows or not chunks:
+        chunks.append(toColumns(rows))
+    return {name: np.concatenate([chunk[name] for chunk in chunks]) for name in chunks[0]}
+
+
+def number(value, digits=2):
+    # NumPy numbers and NaN don't turn into JSON or show nicely in templates
+    if value is None or not math.isfinite(value):
+        return None
+    return round(float(value), digits)
+
+
+def mean(values):
+    values = values[~np.isnan(values)]
+    return values.mean() if values.size else np.nan
+
+
+def clockTime(minutes):
+    if minutes is None:
+        return None
+    minutes = int(round(minutes)) % MINUTES_PER_DAY
+    return f'{minutes // 60:02d}:{minutes % 60:02d}'
+
+
+def bedtimeMinutes(start):
+    # Minutes after midnight of each start time, NaN where there is no start time
+    minutes = np.full(start.shape, np.nan)
+    valid = ~np.isnat(start)
+    minutes[valid] = (start[valid] - start[valid].astype('datetime64[D]')).astype(int)
+    return minutes
+
+
+def weekdays(dates):
+    # Monday is 0. Day 0 of datetime64 (1 Jan 1970) was a Thursday.
+    return (dates.astype('datetime64[D]').astype(int) + 3) % 7
+
+
+def circularStats(minutes, codes=None, groups=1):
+    # The circular mean and standard deviation of clock times, in minutes. With codes
+    # (a group number for every value) there is one answer per group.
+    valid = ~np.isnan(minutes)
+    codes = np.zeros(minutes.shape, dtype=int) if codes is None else codes
+    angles = minutes[valid] * 2 * np.pi / MINUTES_PER_DAY
+    counts = np.bincount(codes[valid], minlength=groups)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cos = np.bincount(codes[valid], weights=np.cos(angles), minlength=groups) / counts
+        sin = np.bincount(codes[valid], weights=np.sin(angles), minlength=groups) / counts
+        length = np.clip(np.hypot(cos, sin), 1e-12, 1)
+        mean = (np.arctan2(sin, cos) % (2 * np.pi)) * MINUTES_PER_DAY / (2 * np.pi)
+        std = np.sqrt(-2 * np.log(length)) * MINUTES_PER_DAY / (2 * np.pi)
+    return mean, std
+
+
+def sleepDebt(columns, today, codes=None, groups=1):
+    recent = columns['sleep_date'] >= np.datetime64(today - dt.timedelta(days=DEBT_DAYS), 'm')
+    hours = columns['hours']
+    use = recent & ~np.isnan(hours)
+    codes = np.zeros(hours.shape, dtype=int) if codes is None else codes
+    shortBy = np.clip(SLEEP_TARGET_HOURS - hours[use], 0, None)
+    return np.bincount(codes[use], weights=shortBy, minlength=groups)
+
+
+def correlation(x, y):
+    use = ~np.isnan(x) & ~np.isnan(y)
+    if use.sum() < 3 or np.std(x[use]) == 0 or np.std(y[use]) == 0:
+        return None
+    return np.corrcoef(x[use], y[use])[0, 1]
+
+
+def weekendEffect(columns, minutes):
+    weekend = np.isin(weekdays(columns['sleep_date']), WEEKEND_NIGHTS) & ~np.isnat(columns['sleep_date'])
+    school = ~weekend & ~np.isnat(columns['sleep_date'])
+    hours = columns['hours']
+    weekendHours = mean(hours[weekend])
+    schoolHours = mean(hours[school])
+    weekendBedtime = circularStats(minutes[weekend])[0][0]
+    schoolBedtime = circularStats(minutes[school])[0][0]
+    # The shortest way round the clock from school night bedtime to weekend bedtime
+    shift = (weekendBedtime - schoolBedtime + MINUTES_PER_DAY / 2) % MINUTES_PER_DAY - MINUTES_PER_DAY / 2
+    return {
+        'schoolNightHours': number(schoolHours),
+        'weekendNightHours': number(weekendHours),
+        'weekendExtraHours': number(weekendHours - schoolHours),
+        'weekendBedtimeShiftMinutes': number(shift, 0),
+    }
+
+
+def userAnalytics(user, today=None):
+    today = today or dt.datetime.utcnow()
+    columns = loadColumns([user.id])
+    minutes = bedtimeMinutes(columns['start'])
+    bedtime, spread = circularStats(minutes)
+    result = {
+        'nights': int(columns['hours'].size),
+        'targetHours': SLEEP_TARGET_HOURS,
+        'debtDays': DEBT_DAYS,
+        'debtHours': number(sleepDebt(columns, today)[0]),
+        'bedtime': clockTime(number(bedtime[0])),
+        'bedtimeSpreadMinutes': number(spread[0], 0),
+        'ratingHoursCorrelation': number(correlation(columns['hours'], columns['rating'])),
+        'feelHoursCorrelation': number(correlation(columns['hours'], columns['feel'])),
+    }
+    result.update(weekendEffect(columns, minutes))
+    return result
+
+
+def cohortAnalytics(today=None):
+    # The same numbers for every student who consented, as a whole and as the spread
+    # between students (median and the middle half).
+    today = today or dt.datetime.utcnow()
+    sleeperIds = User.objects(consent=True).scalar('id')
+    columns = loadColumns(sleeperIds)
+    students, codes = np.unique(columns['sleeper'], return_inverse=True)
+    groups = len(students)
+    minutes = bedtimeMinutes(columns['start'])
+    debt = sleepDebt(columns, today, codes, groups)
+    spread = circularStats(minutes, codes, groups)[1]
+
+    def quartiles(values):
+        values = values[np.isfinite(values)]
+        if not values.size:
+            return None
+        low, median, high = np.percentile(values, [25, 50, 75])
+        return {'p25': number(low), 'median': number(median), 'p75': number(high)}
+
+    result = {
+        'students': groups,
+        'nights': int(columns['hours'].size),
+        'targetHours': SLEEP_TARGET_HOURS,
+        'debtDays': DEBT_DAYS,
+        'debtHours': quartiles(debt),
+        'bedtimeSpreadMinutes': quartiles(spread),
+        'bedtime': clockTime(number(circularStats(minutes)[0][0])),
+        'ratingHoursCorrelation': number(correlation(columns['hours'], columns['rating'])),
+        'feelHoursCorrelation': number(correlation(columns['hours'], columns['feel'])),
+    }
+    result.update(weekendEffect(columns, minutes))
+    return result
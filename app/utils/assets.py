@@ -0,0 +1,290 @@
+# This file shrinks the files in the static folder and gives them names that change
+# whenever the file changes (like CloudsPNG.3f9a1c2b7e.png). Because the name changes
+# with the contents, browsers can be told to keep these files forever and never ask
+# for them again. This is called fingerprinting.
+#
+# Run 'flask assets' (see commands.py) to build them into static/dist when you deploy,
+# or set ASSETS_BUILD_ON_START=1 to build them when the app starts. With several gunicorn
+# workers only the first one builds (the others wait for it) and nothing is built if the
+# static files haven't changed since the last build. static/dist/manifest.json lists
+# what was built. If it hasn't been built the site uses the normal static files.
+#
+# In templates:
+#     {{ static_url('local.css') }}        the url of the built file
+#     {{ static_picture('homeimg.jpg', class_='d-block w-100', alt='...') }}
+#         an <img> wrapped in a <picture> so browsers that can show AVIF or WebP
+#         (which are much smaller) get those instead.
+#
+# Images are resized with Pillow. Brotli (.br) copies of css/js are only made if the
+# 'brotli' package is installed; gzip (.gz) copies always are.
+
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    # Windows doesn't have it. That's only used for running the site on your own
+    # computer, with one process, so there is nothing to wait for.
+    fcntl = None
+
+from flask import request, send_from_directory, url_for
+from markupsafe import Markup, escape
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'static')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+MANIFEST = os.path.join(DIST_DIR, 'manifest.json')
+# What static/ looked like when dist/ was built (see sourcesVersion())
+BUILT_FROM = os.path.join(DIST_DIR, 'built-from.txt')
+BUILD_LOCK = os.path.join(DIST_DIR, 'build.lock')
+BUILD_ON_START = os.environ.get("ASSETS_BUILD_ON_START", "") not in ("", "0")
+
+IMAGE_TYPES = ('.png', '.jpg', '.jpeg')
+TEXT_TYPES = ('.css', '.js', '.svg')
+# How wide (in pixels) each image is made. Twice the size it's shown at keeps it sharp
+# on high resolution screens. Images not listed are made no wider than DEFAULT_WIDTH.
+IMAGE_WIDTHS = {
+    'CloudsPNG.png': 400,
+    'clouds-png-7.png': 400,
+    'delete.png': 80,
+    'edit.png': 80,
+    'new.png': 80,
+    'bdog.png': 256,
+}
+DEFAULT_WIDTH = 1600
+# Folders inside static that are not built
+SKIP_DIRS = ('dist', 'graphs')
+
+MIME_TYPES = {'avif': 'image/avif', 'webp': 'image/webp'}
+
+_manifest = None
+_version = None
+
+
+def fingerprinted(name, data, extension=None):
+    # Saves data in dist/ with a short hash of the contents in its name
+    stem, ext = os.path.splitext(name)
+    digest = hashlib.sha256(data).hexdigest()[:10]
+    outName = f'{stem}.{digest}{extension or ext}'
+    with open(os.path.join(DIST_DIR, outName), 'wb') as file:
+        file.write(data)
+    return outName
+
+
+def buildImage(name, path):
+    from PIL import Image
+
+    entry = {}
+    with Image.open(path) as img:
+        img.load()
+        width = IMAGE_WIDTHS.get(name, DEFAULT_WIDTH)
+        if img.width > width:
+            img = img.resize((width, round(img.height * width / img.width)), Image.LANCZOS)
+        entry['width'] = img.width
+        entry['height'] = img.height
+
+        # The fallback, in the same format as the original
+        fallback = io.BytesIO()
+        if name.lower().endswith('.png'):
+            img.save(fallback, 'PNG', optimize=True)
+        else:
+            img.convert('RGB').save(fallback, 'JPEG', quality=82, optimize=True, progressive=True)
+        entry['file'] = fingerprinted(name, fallback.getvalue())
+
+        webp = io.BytesIO()
+        img.save(webp, 'WEBP', quality=80, method=6)
+        entry['webp'] = fingerprinted(name, webp.getvalue(), '.webp')
+
+        # AVIF needs a Pillow that was built with it (or the pillow-avif-plugin package)
+        if 'AVIF' in Image.SAVE:
+            avif = io.BytesIO()
+            img.save(avif, 'AVIF', quality=60)
+            entry['avif'] = fingerprinted(name, avif.getvalue(), '.avif')
+    return entry
+
+
+def buildText(name, path):
+    with open(path, 'rb') as file:
+        data = file.read()
+    outName = fingerprinted(name, data)
+    # Compressed copies are sent to browsers that accept them, see servePrecompressed()
+    with open(os.path.join(DIST_DIR, outName + '.gz'), 'wb') as file:
+        file.write(gzip.compress(data, compresslevel=9))
+    try:
+        import brotli
+        with open(os.path.join(DIST_DIR, outName + '.br'), 'wb') as file:
+            file.write(brotli.compress(data, quality=11))
+    except ImportError:
+        pass
+    return {'file': outName}
+
+
+def sourceFiles():
+    # (name like 'css/local.css', full path) of every file in static/ that gets built
+    for root, dirs, files in os.walk(STATIC_DIR):
+        dirs[:] = [d for d in dirs if os.path.relpath(os.path.join(root, d), STATIC_DIR) not in SKIP_DIRS]
+        for filename in files:
+            path = os.path.join(root, filename)
+            yield os.path.relpath(path, STATIC_DIR).replace(os.sep, '/'), path
+
+
+def sourcesVersion():
+    # Changes when a file in static/ is added, removed or changed
+    parts = []
+    for name, path in sourceFiles():
+        stat = os.stat(path)
+        parts.append(f'{name}:{stat.st_size}:{stat.st_mtime_ns}')
+    return hashlib.sha256('\n'.join(sorted(parts)).encode()).hexdigest()[:10]
+
+
+def writeAtomically(path, text):
+    # Write to a temporary file and then swap it in, so another process never reads a
+    # half written file
+    temporary = f'{path}.{os.getpid()}.tmp'
+    with open(temporary, 'w') as file:
+        file.write(text)
+    os.replace(temporary, path)
+
+
+def buildAssets(clean=False):
+    # Build everything in static/ into static/dist/ and write the manifest. clean=True
+    # deletes the old build first. Only do that when the site isn't running, because
+    # the pages it is serving link to those files. Without it the old files are left
+    # alone: the new ones have different names.
+    global _manifest, _version
+    if clean:
+        shutil.rmtree(DIST_DIR, ignore_errors=True)
+    os.makedirs(DIST_DIR, exist_ok=True)
+    sources = sourcesVersion()
+    manifest = {}
+    for name, path in sourceFiles():
+        filename = os.path.basename(path)
+        os.makedirs(os.path.join(DIST_DIR, os.path.dirname(name)), exist_ok=True)
+        if filename.lower().endswith(IMAGE_TYPES):
+            manifest[name] = buildImage(name, path)
+        elif filename.lower().endswith(TEXT_TYPES):
+            manifest[name] = buildText(name, path)
+        else:
+            with open(path, 'rb') as file:
+                manifest[name] = {'file': fingerprinted(name, file.read())}
+    writeAtomically(MANIFEST, json.dumps(manifest, indent=2))
+    writeAtomically(BUILT_FROM, sources)
+    _manifest = manifest
+    _version = None
+    return manifest
+
+
+def builtFrom():
+    try:
+        with open(BUILT_FROM) as file:
+            return file.read().strip()
+    except OSError:
+        return None
+
+
+def buildOnce():
+    # Every gunicorn worker runs this when it starts. They take turns holding the lock:
+    # the first one builds, the rest find the build is already up to date and just
+    # read the manifest.
+    global _manifest, _version
+    os.makedirs(DIST_DIR, exist_ok=True)
+    with open(BUILD_LOCK, 'w') as lockFile:
+        if fcntl:
+            # Released when the file is closed
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+        if builtFrom() != sourcesVersion():
+            return buildAssets()
+    _manifest = None
+    _version = None
+    return loadManifest()
+
+
+def loadManifest():
+    global _manifest
+    if _manifest is None:
+        try:
+            with open(MANIFEST) as file:
+                _manifest = json.load(file)
+        except (OSError, ValueError):
+            _manifest = {}
+    return _manifest
+
+
+def assetsVersion():
+    # A short hash of the manifest. It changes whenever a build changes any file, so
+    # saved copies of pages (see pagecache.py) can tell they link to old files.
+    global _version
+    if _version is None:
+        _version = hashlib.sha256(json.dumps(loadManifest(), sort_keys=True).encode()).hexdigest()[:10]
+    return _version
+
+
+def static_url(filename, fmt='file'):
+    # fmt can be 'file', 'webp' or 'avif'
+    entry = loadManifest().get(filename)
+    if entry and entry.get(fmt):
+        return url_for('static', filename='dist/' + entry[fmt])
+    return url_for('static', filename=filename)
+
+
+def static_picture(filename, **attributes):
+    # Any keyword becomes an attribute of the <img>. Use class_ for class.
+    entry = loadManifest().get(filename, {})
+    attributes = {key.rstrip('_'): value for key, value in attributes.items()}
+    # width and height let the browser save the right amount of space before the picture
+    # arrives, so the page doesn't jump around. If only a width is given the height is
+    # worked out from the picture's shape.
+    if 'width' in entry and 'width' not in attributes:
+        attributes['width'] = entry['width']
+    if entry.get('width') and entry.get('height') and 'height' not in attributes:
+        attributes['height'] = round(int(attributes['width']) * entry['height'] / entry['width'])
+    attributes.setdefault('loading', 'lazy')
+    img = '<img src="{}" {}>'.format(
+        escape(static_url(filename)),
+        ' '.join(f'{key}="{escape(value)}"' for key, value in attributes.items()),
+    )
+    sources = ''.join(
+        f'<source type="{MIME_TYPES[fmt]}" srcset="{escape(static_url(filename, fmt))}">'
+        for fmt in ('avif', 'webp') if entry.get(fmt)
+    )
+    if not sources:
+        return Markup(img)
+    return Markup(f'<picture>{sources}{img}</picture>')
+
+
+def servePrecompressed():
+    # Sends the .br or .gz copy of a built css/js file if the browser accepts it
+    if not request.path.startswith('/static/dist/'):
+        return None
+    name = request.path[len('/static/dist/'):]
+    if not name.endswith(TEXT_TYPES):
+        return None
+    for encoding, extension in (('br', '.br'), ('gzip', '.gz')):
+        if encoding in request.accept_encodings and os.path.exists(os.path.join(DIST_DIR, name + extension)):
+            response = send_from_directory(DIST_DIR, name + extension, max_age=31536000)
+            response.headers['Content-Encoding'] = encoding
+            response.mimetype = mimetypes.guess_type(name)[0]
+            response.vary.add('Accept-Encoding')
+            return response
+    return None
+
+
+def longCache(response):
+    # Built files never change (a change makes a new name) so browsers can keep them
+    if request.path.startswith('/static/dist/') and response.status_code == 200:
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        response.vary.add('Accept-Encoding')
+    return response
+
+
+def registerAssets(app):
+    if BUILD_ON_START:
+        buildOnce()
+    app.jinja_env.globals.update(static_url=static_url, static_picture=static_picture)
+    app.before_request(servePrecompressed)
+    app.after_request(longCache)
@@ -0,0 +1,55 @@
+# Database access for the async views. It reads and writes the same collections as the
+# Documents in data.py (User, Sleep, Blog, Comment...). Pass the Document class to say
+# which one:
+#
+#     user = await findOne(User, {'email': email})          # a User, or None
+#     rows = await aggregate(Sleep, pipeline)                # a list of dicts
+#
+# Documents come back as normal mongoengine objects so templates and login_user() can
+# use them.
+#
+# This isn't an async driver. Each call runs the normal pymongo query in a thread from
+# the pool (asyncio.to_thread), on the same client and connection pool mongoengine uses,
+# so there is only one set of connections to tune (see database.py). The request's own
+# thread still waits for the answer like in a normal view. The only gain is that the
+# queries a view starts together with asyncio.gather run at the same time, each in its
+# own pool thread. The thread gets a copy of the request's context variables,
+# so reads in a route marked @readFromSecondaries go to a secondary like they do with
+# mongoengine, and /metrics still counts the queries for the request.
+# (motor, the async MongoDB driver, would need pymongo 4, which mongoengine 0.20 can't use.)
+
+import asyncio
+
+from pymongo import ReturnDocument
+from app.utils.database import routedCollection
+
+
+def toDocument(document, raw):
+    return document._from_son(raw) if raw is not None else None
+
+
+async def findOne(document, query, projection=None):
+    raw = await asyncio.to_thread(lambda: routedCollection(document).find_one(query, projection))
+    return toDocument(document, raw)
+
+
+async def findRaw(document, query, projection=None, sort=None, limit=0):
+    # A list of plain dictionaries, for when the fields are all that's needed
+    return await asyncio.to_thread(
+        lambda: list(routedCollection(document).find(query, projection, sort=sort, limit=limit)))
+
+
+async def aggregate(document, pipeline):
+    return await asyncio.to_thread(lambda: list(routedCollection(document).aggregate(pipeline)))
+
+
+async def findOneAndUpdate(document, query, update, upsert=False):
+    # Returns the Document as it is after the update. Writes always go to the primary.
+    raw = await asyncio.to_thread(lambda: document._get_collection().find_one_and_update(
+        query, update, upsert=upsert, return_document=ReturnDocument.AFTER))
+    return toDocument(document, raw)
+
+
+async def updateOne(document, query, update, upsert=False):
+    result = await asyncio.to_thread(lambda: document._get_collection().update_one(query, update, upsert=upsert))
+    return result.modified_count
@@ -0,0 +1,77 @@
+# Comments can be replies to other comments (the 'comment' field on Comment points at
+# the comment being replied to). Instead of asking the database for the replies of each
+# comment one level at a time, the blog route gets every comment on the blog in one
+# query and this file puts them together into threads in memory.
+
+MAX_DEPTH = 4            # replies deeper than this are shown at this depth
+THREADS_PER_PAGE = 20    # top level comments per page
+REPLIES_SHOWN = 5        # replies shown under each comment before "show more"
+
+
+class CommentNode:
+    def __init__(self, comment):
+        self.comment = comment
+        self.children = []
+        self.depth = 0
+        # the id of the top level comment this one belongs to
+        self.thread = comment.id
+        # how many replies were left out to keep the page short
+        self.hidden = 0
+
+
+def parentId(comment):
+    # The id of the comment this one replies to, without looking it up in the database
+    parent = comment._data.get('comment')
+    if parent is None:
+        return None
+    return getattr(parent, 'id', parent)
+
+
+def buildThreads(comments):
+    # comments is every comment on one blog, oldest first. Returns the list of top level
+    # CommentNodes with their replies in .children
+    nodes = {comment.id: CommentNode(comment) for comment in comments}
+    threads = []
+    for node in nodes.values():
+        # Walk up to find how deep this comment is. 'seen' stops a loop if the data
+        # is ever broken.
+        parent = nodes.get(parentId(node.comment))
+        ancestors = []
+        seen = {node.comment.id}
+        while parent and parent.comment.id not in seen:
+            ancestors.append(parent)
+            seen.add(parent.comment.id)
+            parent = nodes.get(parentId(parent.comment))
+        if not ancestors:
+            threads.append(node)
+            continue
+        # ancestors[-1] is the top level comment, ancestors[0] the direct parent
+        node.thread = ancestors[-1].comment.id
+        if len(ancestors) > MAX_DEPTH:
+            # Too deep: hang it under the ancestor that sits at the deepest allowed level
+            ancestors = ancestors[len(ancestors) - MAX_DEPTH:]
+        node.depth = len(ancestors)
+        ancestors[0].children.append(node)
+    return threads
+
+
+def trimReplies(nodes, limit=REPLIES_SHOWN):
+    # Keep only the first 'limit' replies under each comment and remember how many
+    # were left out so the template can link to the whole thread.
+    for node in nodes:
+        node.hidden = max(len(node.children) - limit, 0)
+        node.children = node.children[:limit]
+        trimReplies(node.children, limit)
+
+
+def threadPage(threads, page, threadId=None):
+    # Returns (threads to show, the page shown, number of pages). A page past the end
+    # shows the last page, and says so. If threadId is given only that thread is shown
+    # and none of its replies are hidden.
+    if threadId:
+        return [node for node in threads if str(node.comment.id) == threadId], 1, 1
+    pages = max((len(threads) + THREADS_PER_PAGE - 1) // THREADS_PER_PAGE, 1)
+    page = min(max(page, 1), pages)
+    shown = threads[(page - 1) * THREADS_PER_PAGE:page * THREADS_PER_PAGE]
+    trimReplies(shown)
+    return shown, page, pages
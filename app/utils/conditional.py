@@ -0,0 +1,50 @@
+# When the browser already has a page it sends back the ETag (a fingerprint) we gave
+# it last time in an 'If-None-Match' header. If the page hasn't changed since, we can
+# answer '304 Not Modified' with no body and the browser shows its own copy. The routes
+# work out the fingerprint from a few small fields (like a blog's cache_version) so the
+# full document is never loaded and the template is never rendered for a 304.
+#
+# Anything the page shows has to be part of the fingerprint. The fingerprint always
+# includes who is looking (see userKey() in pagecache.py) and the static files version.
+
+import hashlib
+
+from flask import Response, make_response, request, session
+
+from app.utils.assets import assetsVersion
+from app.utils.database import primaryReads
+from app.utils.pagecache import userKey
+
+
+def pageEtag(*parts):
+    text = ':'.join(str(part) for part in (assetsVersion(), userKey()) + parts)
+    return hashlib.sha1(text.encode()).hexdigest()[:20]
+
+
+def conditionalPage(etag, render, lastModified=None):
+    # render is a function that returns the page. It is only called when the browser's
+    # copy is out of date.
+    # The etag has to be worked out from the primary. A secondary that is a little behind
+    # (see database.py) would still give the old etag after an edit, and the browser
+    # would be told its old copy is fine. So routes using this don't use
+    # @readFromSecondaries, and the page itself is always rendered from the primary.
+    def renderPage():
+        with primaryReads():
+            return make_response(render())
+    # A page showing flash() messages is always rendered and never given an ETag, or
+    # the browser would keep showing the message on later visits.
+    if session.get('_flashes'):
+        return renderPage()
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = renderPage()
+    response.set_etag(etag)
+    # Only If-None-Match is used to decide on a 304. Last-Modified is just the date of
+    # the document itself, and things like new comments don't change it.
+    if lastModified:
+        response.last_modified = lastModified
+    # The page is different for every user, and the browser must check with us
+    # (which is cheap) every time before using its copy.
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
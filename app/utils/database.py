@@ -0,0 +1,278 @@
+# Connecting to MongoDB. connect=False means the connection isn't actually opened until
+# the first query, so importing the app doesn't wait on the network.
+#
+# It also matters when gunicorn starts several worker processes from one parent (fork).
+# A MongoClient can't be shared between processes: its connections and background
+# threads belong to the process that opened them. So before every request each worker
+# checks that the client was made in its own process and, if not, makes a new one. With
+# connect=False the parent normally never opened anything, so this is almost free.
+#
+# The connection can be tuned with these environment variables:
+#   MONGO_MAX_POOL_SIZE          most connections each worker keeps to each server (100)
+#   MONGO_MIN_POOL_SIZE          connections kept open even when nothing is happening (0)
+#   MONGO_WAIT_QUEUE_TIMEOUT_MS  how long a query waits for a free connection before it
+#                                fails. Empty means wait as long as it takes.
+#   MONGO_COMPRESSORS            like 'zstd,snappy,zlib'. Shrinks what goes over the network.
+#                                zstd needs the zstandard package and snappy needs
+#                                python-snappy. Any that aren't installed are skipped.
+#   MONGO_WRITE_CONCERN          how many servers must have a write before it counts as done,
+#                                like '1' or 'majority'. Empty uses the server's default.
+#   MONGO_WRITE_TIMEOUT_MS       how long a write waits for those servers
+#   MONGO_SECONDARY_READS        0 turns off @readFromSecondaries (below)
+#   MONGO_MAX_STALENESS          how far behind (seconds, 90 or more) a secondary may be
+#
+# Reads from secondaries: a replica set is a primary server, which takes every write,
+# and secondaries that copy it. Pages that only read can be served by the secondaries so
+# the primary has more time for writes. Put @readFromSecondaries on those routes. Their
+# queries go to a secondary that is at most MONGO_MAX_STALENESS behind, or to the primary
+# if there isn't one (like on a single server). Writes always go to the primary.
+# https://www.mongodb.com/docs/manual/core/read-preference/
+#
+# The connection pools are counted and shown at /metrics (mongo_pool_...) so you can see
+# when requests are waiting for connections. Try it against a local replica set with the
+# steps in benchmarks/readme.txt.
+
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from inspect import iscoroutinefunction
+
+import certifi
+from flask_mongoengine import BaseQuerySet
+from mongoengine import connect, disconnect
+from pymongo import monitoring
+from pymongo.read_preferences import SecondaryPreferred
+from app.utils.metrics import Histogram, extraMetrics, histogramLines
+
+MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", 100))
+MIN_POOL_SIZE = int(os.environ.get("MONGO_MIN_POOL_SIZE", 0))
+WAIT_QUEUE_TIMEOUT_MS = os.environ.get("MONGO_WAIT_QUEUE_TIMEOUT_MS", "")
+COMPRESSORS = os.environ.get("MONGO_COMPRESSORS", "")
+WRITE_CONCERN = os.environ.get("MONGO_WRITE_CONCERN", "")
+WRITE_TIMEOUT_MS = os.environ.get("MONGO_WRITE_TIMEOUT_MS", "")
+SECONDARY_READS = os.environ.get("MONGO_SECONDARY_READS", "1") not in ("", "0")
+# MongoDB won't accept less than 90 seconds
+MAX_STALENESS = max(int(os.environ.get("MONGO_MAX_STALENESS", 90)), 90)
+
+_settings = {}
+_connectedPid = None
+
+
+def poolOptions():
+    # Pool, compression and write settings, for any MongoDB client (the benchmarks use
+    # these too)
+    options = {'maxPoolSize': MAX_POOL_SIZE, 'minPoolSize': MIN_POOL_SIZE}
+    if WAIT_QUEUE_TIMEOUT_MS:
+        options['waitQueueTimeoutMS'] = int(WAIT_QUEUE_TIMEOUT_MS)
+    if COMPRESSORS:
+        options['compressors'] = COMPRESSORS
+    if WRITE_CONCERN:
+        options['w'] = int(WRITE_CONCERN) if WRITE_CONCERN.isdigit() else WRITE_CONCERN
+    if WRITE_TIMEOUT_MS:
+        options['wTimeoutMS'] = int(WRITE_TIMEOUT_MS)
+    return options
+
+
+def clientOptions():
+    # Settings for the MongoDB client. The async views use it too (see asyncdb.py).
+    return {'tlsCAFile': certifi.where(), **poolOptions()}
+
+
+def connectDb(name, host):
+    global _connectedPid
+    _settings.update(name=name, host=host)
+    connect(name, host=host, connect=False, **clientOptions())
+    _connectedPid = os.getpid()
+
+
+def connectionSettings():
+    # The database name and host connectDb() was given
+    return dict(_settings)
+
+
+def checkFork():
+    # Runs before every request. Only does something in the first request of a new process.
+    if _connectedPid != os.getpid():
+        # disconnect() also makes the Documents forget the collections of the old client
+        disconnect()
+        connectDb(**_settings)
+
+
+# Where the current request's reads go. None means the primary. A context variable
+# works for normal routes (one thread each) and async ones (one task each).
+_readPreference = contextvars.ContextVar('readPreference', default=None)
+
+
+def currentReadPreference():
+    return _readPreference.get()
+
+
+def readFromSecondaries(view):
+    # Decorator for routes that only read. Works on normal and async routes.
+    if not SECONDARY_READS:
+        return view
+    preference = SecondaryPreferred(max_staleness=MAX_STALENESS)
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def asyncWrapper(*args, **kwargs):
+            token = _readPreference.set(preference)
+            try:
+                return await view(*args, **kwargs)
+            finally:
+                _readPreference.reset(token)
+        return asyncWrapper
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        token = _readPreference.set(preference)
+        try:
+            return view(*args, **kwargs)
+        finally:
+            _readPreference.reset(token)
+    return wrapper
+
+
+@contextmanager
+def primaryReads():
+    # Reads inside 'with primaryReads():' go to the primary, even in a route that reads
+    # from secondaries. Use it for anything that gets saved, so a copy is never older
+    # than the version number it is saved under.
+    token = _readPreference.set(None)
+    try:
+        yield
+    finally:
+        _readPreference.reset(token)
+
+
+def routedCollection(document):
+    # For code that uses the pymongo collection directly instead of Document.objects
+    collection = document._get_collection()
+    preference = currentReadPreference()
+    return collection.with_options(read_preference=preference) if preference else collection
+
+
+class RoutedQuerySet(BaseQuerySet):
+    # Every Document in data.py uses this instead of the flask_mongoengine one. A new
+    # queryset (Sleep.objects, Blog.objects...) starts with the request's read preference.
+    # .read_preference() on a queryset still overrides it.
+    def __init__(self, document, collection):
+        super().__init__(document, collection)
+        preference = currentReadPreference()
+        if preference is not None:
+            self._read_preference = preference
+
+
+# Connection pool numbers, by server
+_poolLock = threading.Lock()
+_pools = {}
+_waitSeconds = {}
+# When each waiting query asked for a connection, by (server, thread). pymongo doesn't
+# give a checkout an id until it has a connection, but a query waits for its connection
+# in the thread that runs it (async views use worker threads, see asyncdb.py), so the
+# thread tells the waits on one server apart.
+_waitStarts = {}
+
+
+def _pool(address):
+    key = '%s:%s' % address
+    if key not in _pools:
+        _pools[key] = {'open': 0, 'checkedOut': 0, 'waiting': 0, 'checkouts': 0, 'timeouts': 0, 'failures': 0}
+        _waitSeconds[key] = Histogram()
+    return key
+
+
+class PoolListener(monitoring.ConnectionPoolListener):
+    # pymongo calls these as connections are opened, closed, borrowed and given back.
+    # Waiting is timed from when a query asks for a connection until it gets one.
+    def connection_check_out_started(self, event):
+        with _poolLock:
+            _waitStarts[(event.address, threading.get_ident())] = time.perf_counter()
+            _pools[_pool(event.address)]['waiting'] += 1
+
+    def _waited(self, event):
+        started = _waitStarts.pop((event.address, threading.get_ident()), None)
+        key = _pool(event.address)
+        # Nothing to take away for a wait that started before the listener knew about it
+        if started is not None:
+            _pools[key]['waiting'] -= 1
+            _waitSeconds[key].observe(time.perf_counter() - started)
+        return key
+
+    def connection_checked_out(self, event):
+        with _poolLock:
+            key = self._waited(event)
+            _pools[key]['checkedOut'] += 1
+            _pools[key]['checkouts'] += 1
+
+    def connection_check_out_failed(self, event):
+        with _poolLock:
+            key = self._waited(event)
+            if event.reason == monitoring.ConnectionCheckOutFailedReason.TIMEOUT:
+                _pools[key]['timeouts'] += 1
+            else:
+                _pools[key]['failures'] += 1
+
+    def connection_checked_in(self, event):
+        with _poolLock:
+            _pools[_pool(event.address)]['checkedOut'] -= 1
+
+    def connection_created(self, event):
+        with _poolLock:
+            _pools[_pool(event.address)]['open'] += 1
+
+    def connection_closed(self, event):
+        with _poolLock:
+            _pools[_pool(event.address)]['open'] -= 1
+
+    # Nothing to count for these
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+
+def poolMetrics():
+    with _poolLock:
+        lines = [
+            '# HELP mongo_pool_max_size Most connections to each server (MONGO_MAX_POOL_SIZE)',
+            '# TYPE mongo_pool_max_size gauge',
+            f'mongo_pool_max_size {MAX_POOL_SIZE}',
+        ]
+        described = (
+            ('open', 'mongo_pool_open', 'gauge', 'Connections open to the server'),
+            ('checkedOut', 'mongo_pool_checked_out', 'gauge', 'Connections being used by a query'),
+            ('waiting', 'mongo_pool_waiting', 'gauge', 'Queries waiting for a connection'),
+            ('checkouts', 'mongo_pool_checkouts_total', 'counter', 'Connections handed to queries'),
+            ('timeouts', 'mongo_pool_wait_timeouts_total', 'counter', 'Queries that gave up waiting for a connection'),
+            ('failures', 'mongo_pool_checkout_failures_total', 'counter', 'Connections that could not be opened'),
+        )
+        for field, name, kind, text in described:
+            lines.append(f'# HELP {name} {text}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines += [f'{name}{{server="{key}"}} {pool[field]}' for key, pool in sorted(_pools.items())]
+        lines.append('# HELP mongo_pool_wait_seconds Time queries waited for a connection')
+        lines += histogramLines('mongo_pool_wait_seconds', 'server', _waitSeconds)
+    return lines
+
+
+extraMetrics.append(poolMetrics)
+
+
+def registerDatabase(app, secrets):
+    # The listener has to be registered before the client is made
+    monitoring.register(PoolListener())
+    connectDb(secrets['MONGO_DB_NAME'], secrets['MONGO_HOST'])
+    app.before_request(checkFork)
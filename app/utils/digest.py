@@ -0,0 +1,152 @@
+# This file makes and emails the weekly sleep digest: a short summary of a student's
+# week of sleep, sent to the adult they named on the consent form. It only goes to
+# students who said yes to sharing (User.consent).
+#
+# The digests for every consenting student are calculated with one aggregation. They
+# are then split into batches, and each batch is sent as its own job over one SMTP
+# connection, so a mail server problem only makes that batch try again. An email the
+# server refuses (a bad address) is skipped and the rest of the batch still goes out.
+#
+# Mail settings come from secrets.py: SMTP_HOST, SMTP_PORT, SMTP_USER, SMTP_PASSWORD,
+# SMTP_STARTTLS and MAIL_FROM. For testing, point SMTP_HOST/SMTP_PORT at a local test
+# server like aiosmtpd (python -m aiosmtpd -n -l localhost:8025).
+
+import datetime as dt
+import hashlib
+import logging
+import smtplib
+from email.message import EmailMessage
+
+from bson.objectid import ObjectId
+from app.classes.data import Sleep, User
+from app.utils.jobs import jobHandler, enqueue
+from app.utils.secrets import getSecrets
+
+secrets = getSecrets()
+# Parsed like the on/off environment variables: empty, 0 or false is off. A real
+# True/False in secrets.py works too.
+SMTP_STARTTLS = str(secrets.get('SMTP_STARTTLS') or '').lower() not in ('', '0', 'false')
+
+# How many emails are sent over one SMTP connection (and in one job)
+SEND_BATCH_SIZE = 50
+# The mail server turning down one email (like a bad address) instead of the connection
+# failing. Only that email is skipped.
+MESSAGE_ERRORS = (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError)
+
+log = logging.getLogger(__name__)
+
+
+def buildDigests(since, userIds=None):
+    # Returns one dictionary per consenting student who logged sleep since 'since'
+    users = User.objects(consent=True, adult_email__nin=[None, ''])
+    if userIds:
+        users = users.filter(id__in=userIds)
+    users = {user['_id']: user for user in users.only('fname', 'lname', 'adult_fname', 'adult_email').as_pymongo()}
+    if not users:
+        return []
+
+    pipeline = [
+        {'$match': {'sleeper': {'$in': list(users)}, 'sleep_date': {'$gte': since}}},
+        {'$group': {
+            '_id': '$sleeper',
+            'nights': {'$sum': 1},
+            'avgHours': {'$avg': '$hours'},
+            'minHours': {'$min': '$hours'},
+            'maxHours': {'$max': '$hours'},
+            'avgRating': {'$avg': '$rating'},
+            'avgFeel': {'$avg': '$feel'},
+        }},
+    ]
+    digests = []
+    for row in Sleep.objects().aggregate(pipeline):
+        user = users[row.pop('_id')]
+        digests.append({
+            'to': user['adult_email'],
+            'adult': user.get('adult_fname') or '',
+            'student': f"{user.get('fname') or ''} {user.get('lname') or ''}".strip(),
+            **row,
+        })
+    return digests
+
+
+def digestMessage(digest):
+    message = EmailMessage()
+    message['From'] = secrets.get('MAIL_FROM') or secrets.get('MY_EMAIL_ADDRESS')
+    message['To'] = digest['to']
+    message['Subject'] = f"Weekly sleep summary for {digest['student']}"
+    rating = digest.get('avgRating')
+    feel = digest.get('avgFeel')
+    body = [
+        f"Hi {digest['adult']},",
+        "",
+        f"{digest['student']} logged {digest['nights']} nights of sleep this week.",
+        "",
+    ]
+    if digest.get('avgHours') is not None:
+        body.append(f"Average hours: {digest['avgHours']:.1f} (least {digest['minHours']:.1f}, most {digest['maxHours']:.1f})")
+    if rating is not None:
+        body.append(f"Average sleep rating: {rating:.1f} out of 5")
+    if feel is not None:
+        body.append(f"Average 'how I felt when I woke up': {feel:.1f} out of 5")
+    body += ["", "You are getting this because they chose to share their sleep with you."]
+    message.set_content("\n".join(body) + "\n")
+    return message
+
+
+def smtpConnection():
+    smtp = smtplib.SMTP(secrets.get('SMTP_HOST', 'localhost'), int(secrets.get('SMTP_PORT', 25)), timeout=30)
+    if SMTP_STARTTLS:
+        smtp.starttls()
+    if secrets.get('SMTP_USER'):
+        smtp.login(secrets['SMTP_USER'], secrets['SMTP_PASSWORD'])
+    return smtp
+
+
+def batchKey(since, digests):
+    # The job key for one batch: the same people for the same week always get the same
+    # key, so a job that runs again can't queue their emails twice
+    recipients = ','.join(sorted(digest['to'] for digest in digests))
+    return f"send-digests-{since}-{hashlib.sha1(recipients.encode()).hexdigest()}"
+
+
+@jobHandler('weekly-digests')
+def weeklyDigests(weekOf=None, userIds=None):
+    # Work out every digest and queue them to be sent in batches
+    end = dt.datetime.fromisoformat(weekOf) if weekOf else dt.datetime.utcnow()
+    since = dt.datetime.combine((end - dt.timedelta(days=7)).date(), dt.time())
+    if userIds:
+        userIds = [ObjectId(userId) for userId in userIds]
+    digests = buildDigests(since, userIds)
+    for start in range(0, len(digests), SEND_BATCH_SIZE):
+        batch = digests[start:start + SEND_BATCH_SIZE]
+        enqueue('send-digests', {'digests': batch, 'since': f'{since:%Y-%m-%d}'},
+                uniqueKey=batchKey(f'{since:%Y-%m-%d}', batch))
+
+
+@jobHandler('send-digests')
+def sendDigests(digests, since=''):
+    # One connection to the mail server is used for the whole batch
+    smtp = smtpConnection()
+    sent = 0
+    try:
+        for digest in digests:
+            try:
+                smtp.send_message(digestMessage(digest))
+            except MESSAGE_ERRORS as error:
+                # adult_email is whatever the student typed, so one bad address is
+                # likely. Trying it again won't help, so skip it and send the rest.
+                log.warning('Digest to %r was refused: %s', digest['to'], error)
+            sent += 1
+    except (smtplib.SMTPException, OSError):
+        # The connection itself failed
+        if not sent:
+            # Nothing went out, so let the job queue try this whole batch again later
+            raise
+        # Some went out. Queue only the rest so nobody gets the same email twice.
+        rest = digests[sent:]
+        enqueue('send-digests', {'digests': rest, 'since': since}, uniqueKey=batchKey(since, rest))
+    finally:
+        try:
+            smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
@@ -0,0 +1,95 @@
+# This file draws the sleep graphs. Graphs are drawn into memory (not into the static
+# folder) so that each user only ever sees their own graph and two users can't overwrite
+# each other's picture. Finished graphs are kept in a small cache so that refreshing the
+# graph page doesn't redraw the same picture over and over.
+
+from collections import OrderedDict
+from io import BytesIO
+from threading import Lock
+import os
+
+from app.classes.data import User
+from app.utils.sleepstats import rollingMeans
+from app.utils.usercache import forgetUser
+
+# These are the image formats the graph route knows how to send back
+GRAPH_FORMATS = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+}
+
+# How many finished graphs each worker process keeps in memory
+GRAPH_CACHE_SIZE = int(os.environ.get("GRAPH_CACHE_SIZE", 128))
+
+# The cache is an OrderedDict used as an LRU (least recently used) list. The key is
+# (userId, version, format) and the value is the bytes of the picture.
+_graphCache = OrderedDict()
+_graphLock = Lock()
+
+
+def ratingColor(rating):
+    if rating and rating >= 4:
+        return 'green'
+    elif rating == 3:
+        return 'yellow'
+    else:
+        return 'red'
+
+
+def renderSleepGraph(nights, fmt='png'):
+    # nights is a list of rows from rollingMeans() in sleepstats.py.
+    # Figure() is the object oriented way to use matplotlib. Unlike pyplot it doesn't
+    # keep any global state, so the figure is thrown away when this function ends.
+    dates = [night['date'] for night in nights]
+    hours = [night.get('hours') for night in nights]
+    colors = [ratingColor(night.get('rating')) for night in nights]
+
+    # matplotlib takes a long time to import so it is only imported the first time a
+    # graph is drawn, not every time a worker starts.
+    from matplotlib.figure import Figure
+
+    fig = Figure()
+    ax = fig.subplots()
+    ax.scatter(dates, hours, marker='o', c=colors)
+    ax.plot(dates, [night.get('avg7') for night in nights], label='7 day average')
+    ax.plot(dates, [night.get('avg30') for night in nights], label='30 day average')
+    if nights:
+        ax.legend()
+    ax.set_ylabel('Hours')
+    ax.tick_params(axis='x', labelrotation=45)
+
+    buffer = BytesIO()
+    fig.savefig(buffer, format=fmt, bbox_inches="tight")
+    return buffer.getvalue()
+
+
+def getSleepGraph(user, fmt='png'):
+    # The version goes up every time this user's sleeps change so an old graph
+    # will never be found in the cache after a change.
+    key = (str(user.id), user.sleep_version, fmt)
+    with _graphLock:
+        if key in _graphCache:
+            _graphCache.move_to_end(key)
+            return _graphCache[key]
+
+    image = renderSleepGraph(rollingMeans(user), fmt)
+
+    with _graphLock:
+        _graphCache[key] = image
+        _graphCache.move_to_end(key)
+        while len(_graphCache) > GRAPH_CACHE_SIZE:
+            _graphCache.popitem(last=False)
+    return image
+
+
+def sleepsChanged(user):
+    # Call this whenever a user's sleeps are created, edited or deleted. Bumping the
+    # version in the database means every worker process will draw a new graph.
+    # The cached copy of the user (see usercache.py) holds the old version so it has
+    # to be refreshed too.
+    User.objects(id=user.id).update_one(inc__sleep_version=1, inc__cache_version=1)
+    forgetUser(user.id)
+    userId = str(user.id)
+    with _graphLock:
+        for key in [key for key in _graphCache if key[0] == userId]:
+            del _graphCache[key]
@@ -0,0 +1,107 @@
+# This file prepares uploaded profile pictures. A phone photo can be several megabytes
+# but the site never shows it bigger than a few hundred pixels. So when a picture is
+# uploaded we check that it really is an image, throw away the hidden metadata (like
+# the GPS location a phone camera adds) and save a few smaller copies. Pages then ask
+# for the copy that fits, see avatar() in routes/user.py.
+# This uses the Pillow library: https://pillow.readthedocs.io
+
+import io
+
+import gridfs
+from mongoengine.connection import get_db
+
+# The longest side, in pixels, of each copy that gets saved
+AVATAR_SIZES = (64, 128, 512)
+# The biggest copy is also saved as the User's 'image' field
+LARGEST = max(AVATAR_SIZES)
+# Formats to save, best first. Browsers that can't show WebP get the JPEG.
+AVATAR_FORMATS = {
+    'webp': 'image/webp',
+    'jpeg': 'image/jpeg',
+}
+# Refuse anything bigger than this (about a 40 megapixel photo)
+MAX_PIXELS = 40_000_000
+
+
+def processUpload(upload):
+    # upload is the file from the form (form.image.data). Returns a dictionary like
+    # {'128.webp': b'...', '128.jpeg': b'...'}. Raises ValueError if it isn't an image.
+    # Pillow is only imported when someone uploads a picture, so workers start faster.
+    from PIL import Image, ImageOps
+
+    data = upload.read()
+    try:
+        # verify() checks the file without decoding all of it. It can't be used twice so
+        # the file is opened again to actually work with it.
+        Image.open(io.BytesIO(data)).verify()
+        img = Image.open(io.BytesIO(data))
+        if img.width * img.height > MAX_PIXELS:
+            raise ValueError("That picture is too big.")
+        # Phones often save pictures sideways with a note that says "rotate me". This
+        # does the rotation so the note (and the rest of the metadata) can be dropped.
+        img = ImageOps.exif_transpose(img)
+        img.load()
+    except (OSError, SyntaxError, Image.DecompressionBombError) as error:
+        raise ValueError("That file is not a picture we can use.") from error
+
+    # JPEG has no transparency so see-through parts are filled in with white
+    if img.mode in ('RGBA', 'LA', 'P'):
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, 'white')
+        background.paste(img, mask=img.getchannel('A'))
+        img = background
+    elif img.mode != 'RGB':
+        img = img.convert('RGB')
+
+    renditions = {}
+    for size in AVATAR_SIZES:
+        copy = img.copy()
+        # thumbnail() shrinks the picture to fit inside size x size without stretching it.
+        # It never makes a small picture bigger.
+        copy.thumbnail((size, size), Image.LANCZOS)
+        # Saving without passing exif= or icc_profile= leaves the metadata out
+        webp = io.BytesIO()
+        copy.save(webp, 'WEBP', quality=80, method=4)
+        renditions[f'{size}.webp'] = webp.getvalue()
+        jpeg = io.BytesIO()
+        copy.save(jpeg, 'JPEG', quality=85, optimize=True, progressive=True)
+        renditions[f'{size}.jpeg'] = jpeg.getvalue()
+    return renditions
+
+
+def getFS():
+    # The same GridFS bucket ('fs') that mongoengine uses for FileFields
+    return gridfs.GridFS(get_db())
+
+
+def saveAvatar(user, renditions):
+    # Replace the user's pictures with the new renditions from processUpload()
+    fs = getFS()
+    for gridId in (user.avatars or {}).values():
+        fs.delete(gridId)
+    if user.image:
+        user.image.delete()
+
+    avatars = {}
+    for name, data in renditions.items():
+        size, fmt = name.split('.')
+        avatars[name] = fs.put(data, content_type=AVATAR_FORMATS[fmt],
+            metadata={'user': user.id, 'size': int(size)})
+    # The 'image' field keeps working for any code that only knows about it
+    user.image.put(renditions[f'{LARGEST}.jpeg'], content_type='image/jpeg')
+    user.avatars = avatars
+    user.save()
+
+
+def pickAvatar(avatars, size, acceptWebp):
+    # Returns the GridFS id of the smallest saved copy that is at least 'size' pixels,
+    # or None if this user's picture was uploaded before there were copies.
+    if not avatars:
+        return None
+    fmt = 'webp' if acceptWebp else 'jpeg'
+    for candidate in AVATAR_SIZES:
+        if candidate >= size or candidate == LARGEST:
+            gridId = avatars.get(f'{candidate}.{fmt}')
+            if gridId:
+                return gridId
+    return None
@@ -0,0 +1,111 @@
+# This is a small background job queue. A route (or the scheduler) adds a Job document
+# to the database with enqueue() and returns right away. A separate process started with
+# 'flask worker' (see commands.py) picks up jobs and runs them. If a job fails it is tried
+# again later, waiting longer after every failure (backoff).
+#
+# Jobs live in MongoDB so they survive restarts, and more than one worker can run at a
+# time because claiming a job is a single atomic find_one_and_update.
+
+import datetime as dt
+import os
+import time
+import traceback
+
+import mongoengine.errors
+from pymongo import ReturnDocument
+from app.classes.data import Job
+
+# kind -> function that does the work. Add to it with @jobHandler('kind')
+JOB_HANDLERS = {}
+
+# Seconds to wait before the first retry. It doubles every time, up to RETRY_MAX.
+RETRY_BASE = int(os.environ.get("JOB_RETRY_BASE", 60))
+RETRY_MAX = int(os.environ.get("JOB_RETRY_MAX", 6 * 60 * 60))
+# A job 'running' longer than this probably belonged to a worker that crashed
+LOCK_TIMEOUT = int(os.environ.get("JOB_LOCK_TIMEOUT", 15 * 60))
+# How long the worker sleeps when there is nothing to do
+POLL_SECONDS = float(os.environ.get("JOB_POLL_SECONDS", 5))
+
+
+def jobHandler(kind):
+    def register(function):
+        JOB_HANDLERS[kind] = function
+        return function
+    return register
+
+
+def enqueue(kind, payload=None, runAt=None, uniqueKey=None):
+    # Add a job. If uniqueKey is given and a job with that key already exists nothing
+    # is added and None is returned.
+    job = Job(kind=kind, payload=payload or {}, run_at=runAt or dt.datetime.utcnow(), unique_key=uniqueKey)
+    try:
+        job.save()
+    except mongoengine.errors.NotUniqueError:
+        return None
+    return job
+
+
+def claimJob():
+    # Find the next job that is due and mark it 'running' in one step, so two workers
+    # can never get the same job.
+    now = dt.datetime.utcnow()
+    return Job._get_collection().find_one_and_update(
+        {'$or': [
+            {'status': 'queued', 'run_at': {'$lte': now}},
+            {'status': 'running', 'locked_at': {'$lt': now - dt.timedelta(seconds=LOCK_TIMEOUT)}},
+        ]},
+        {'$set': {'status': 'running', 'locked_at': now, 'modify_date': now}, '$inc': {'attempts': 1}},
+        sort=[('run_at', 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def backoff(attempts):
+    return min(RETRY_BASE * 2 ** (attempts - 1), RETRY_MAX)
+
+
+def runJob(job):
+    # job is the raw document from claimJob()
+    collection = Job._get_collection()
+    now = dt.datetime.utcnow()
+    try:
+        handler = JOB_HANDLERS[job['kind']]
+        handler(**job.get('payload', {}))
+    except Exception:
+        error = traceback.format_exc(limit=5)
+        if job['attempts'] < job.get('max_attempts', 5):
+            update = {'status': 'queued', 'run_at': now + dt.timedelta(seconds=backoff(job['attempts']))}
+        else:
+            update = {'status': 'failed'}
+        update.update(last_error=error, locked_at=None, modify_date=now)
+        collection.update_one({'_id': job['_id']}, {'$set': update})
+        return False
+    collection.update_one({'_id': job['_id']}, {'$set': {'status': 'done', 'locked_at': None, 'modify_date': now}})
+    return True
+
+
+def scheduleJobs(now=None):
+    # Jobs that should happen on a timetable. The unique key is what stops the same
+    # week's digests from being added by every worker, every time this runs.
+    now = now or dt.datetime.utcnow()
+    year, week, weekday = now.isocalendar()
+    # Weekly sleep digests go out on Sunday (ISO weekday 7)
+    if weekday == 7:
+        enqueue('weekly-digests', {'weekOf': now.date().isoformat()}, uniqueKey=f'weekly-digests-{year}-W{week:02d}')
+
+
+def workLoop(once=False):
+    # Run jobs until stopped. With once=True, run everything that is due and return.
+    lastScheduled = None
+    while True:
+        # The timetable only needs checking once a minute
+        if lastScheduled is None or time.monotonic() - lastScheduled >= 60:
+            scheduleJobs()
+            lastScheduled = time.monotonic()
+        job = claimJob()
+        if job:
+            runJob(job)
+            continue
+        if once:
+            return
+        time.sleep(POLL_SECONDS)
@@ -0,0 +1,37 @@
+# When a template does {{blog.author.fname}} mongoengine looks up that one User with
+# its own query. On a list of 25 blogs that is 25 extra queries (the "N+1 problem").
+# The functions here look up all of the Users for a whole list in one query and
+# attach them to the documents before the template ever sees them.
+
+from bson.dbref import DBRef
+from app.classes.data import User
+
+# The only User fields the list templates show. Leaving out the rest keeps each
+# User small, and the image is never read. cache_version is part of the key of saved
+# rows that show a user's name (see utils/pagecache.py).
+USER_LIST_FIELDS = ('fname', 'lname', 'username', 'gname', 'cache_version')
+
+
+def refId(value):
+    # A ReferenceField can hold a DBRef, an ObjectId or an already loaded Document
+    if isinstance(value, DBRef):
+        return value.id
+    return getattr(value, 'pk', value)
+
+
+def loadUsers(docs, field, only=USER_LIST_FIELDS):
+    # docs is a list of documents (Blogs, Sleeps, Comments...) and field is the name of
+    # their ReferenceField to a User ('author' or 'sleeper'). Returns docs so it can be
+    # used inline.
+    docs = list(docs)
+    ids = {refId(doc._data.get(field)) for doc in docs if doc._data.get(field) is not None}
+    if not ids:
+        return docs
+    users = {user.pk: user for user in User.objects(id__in=list(ids)).only(*only)}
+    for doc in docs:
+        ref = doc._data.get(field)
+        if ref is not None and refId(ref) in users:
+            # Writing to _data directly puts the User in place without marking the
+            # document as changed.
+            doc._data[field] = users[refId(ref)]
+    return docs
@@ -0,0 +1,182 @@
+# This file measures how long every request takes, how many database queries it made
+# (and how long they took) and how long its template took to render. The numbers are
+# shown at /metrics in the text format that Prometheus (a monitoring tool) reads:
+# https://prometheus.io/docs/instrumenting/exposition_formats/
+#
+# Set METRICS_SERVER_TIMING=1 to also add a Server-Timing header to every response.
+# The browser's developer tools show it in the Network tab under "Timing".
+# /metrics needs METRICS_TOKEN to be set and is read with 'Authorization: Bearer <token>'.
+# Without a token it answers 404, because the numbers show every route and how busy it is.
+#
+# Each worker process keeps its own numbers.
+
+from collections import defaultdict
+from contextvars import ContextVar
+from threading import Lock
+import hmac
+import os
+import time
+
+from flask import g, request, before_render_template, template_rendered
+from pymongo import monitoring
+
+SERVER_TIMING = os.environ.get("METRICS_SERVER_TIMING", "") not in ("", "0")
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+# Upper edges of the histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.count += 1
+        self.sum += seconds
+        for i, edge in enumerate(BUCKETS):
+            if seconds <= edge:
+                self.counts[i] += 1
+                break
+
+
+_lock = Lock()
+requestSeconds = defaultdict(Histogram)      # endpoint -> Histogram
+templateSeconds = defaultdict(Histogram)     # template name -> Histogram
+queryCounts = defaultdict(int)               # endpoint -> number of database commands
+querySeconds = defaultdict(float)            # endpoint -> time spent waiting on the database
+# Other files can add their own lines to /metrics by adding a function here that
+# returns a list of lines
+extraMetrics = []
+
+class RequestStats:
+    # What one request has done so far. The queries of an async view run in worker
+    # threads (see asyncdb.py), sometimes several at once, so adding up is locked.
+    def __init__(self):
+        self.lock = Lock()
+        self.queries = 0
+        self.dbSeconds = 0.0
+        self.templateSeconds = 0.0
+
+    def add(self, queries=0, dbSeconds=0.0, templateSeconds=0.0):
+        with self.lock:
+            self.queries += queries
+            self.dbSeconds += dbSeconds
+            self.templateSeconds += templateSeconds
+
+
+# The current request's RequestStats. A context variable instead of a thread local
+# because async views hand their queries to other threads: asyncio.to_thread and asgiref
+# copy the context into them, so those queries still find the request they belong to.
+_current = ContextVar('requestStats', default=None)
+_templateStart = ContextVar('templateStart', default=None)
+
+
+class QueryListener(monitoring.CommandListener):
+    # pymongo calls these for every database command, in the thread that made the query
+    def started(self, event):
+        stats = _current.get()
+        if stats is not None:
+            stats.add(queries=1)
+
+    def succeeded(self, event):
+        stats = _current.get()
+        if stats is not None:
+            stats.add(dbSeconds=event.duration_micros / 1e6)
+
+    def failed(self, event):
+        self.succeeded(event)
+
+
+def startRequest():
+    _current.set(RequestStats())
+    g.metricsStart = time.perf_counter()
+
+
+def finishRequest(response):
+    stats = _current.get()
+    if stats is None or 'metricsStart' not in g:
+        return response
+    elapsed = time.perf_counter() - g.metricsStart
+    endpoint = request.endpoint or 'none'
+    with _lock:
+        requestSeconds[endpoint].observe(elapsed)
+        queryCounts[endpoint] += stats.queries
+        querySeconds[endpoint] += stats.dbSeconds
+    if SERVER_TIMING:
+        response.headers['Server-Timing'] = (
+            f'db;dur={stats.dbSeconds * 1000:.1f};desc="{stats.queries} queries", '
+            f'tmpl;dur={stats.templateSeconds * 1000:.1f}, '
+            f'total;dur={elapsed * 1000:.1f}'
+        )
+    _current.set(None)
+    return response
+
+
+def templateStarted(sender, template, context, **extra):
+    _templateStart.set(time.perf_counter())
+
+
+def templateFinished(sender, template, context, **extra):
+    started = _templateStart.get()
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    _templateStart.set(None)
+    stats = _current.get()
+    if stats is not None:
+        stats.add(templateSeconds=elapsed)
+    with _lock:
+        templateSeconds[template.name or 'string'].observe(elapsed)
+
+
+def registerMetrics(app):
+    # Call this before connecting to the database. pymongo only tells listeners about
+    # clients that are created after the listener is registered.
+    monitoring.register(QueryListener())
+    app.before_request(startRequest)
+    app.after_request(finishRequest)
+    before_render_template.connect(templateStarted, app)
+    template_rendered.connect(templateFinished, app)
+
+
+def histogramLines(name, label, histograms):
+    lines = [f'# TYPE {name} histogram']
+    for key, histogram in sorted(histograms.items()):
+        running = 0
+        for edge, count in zip(BUCKETS, histogram.counts):
+            running += count
+            lines.append(f'{name}_bucket{{{label}="{key}",le="{edge}"}} {running}')
+        lines.append(f'{name}_bucket{{{label}="{key}",le="+Inf"}} {histogram.count}')
+        lines.append(f'{name}_sum{{{label}="{key}"}} {histogram.sum:.6f}')
+        lines.append(f'{name}_count{{{label}="{key}"}} {histogram.count}')
+    return lines
+
+
+def metricsText():
+    with _lock:
+        lines = ['# HELP http_request_duration_seconds Time to handle a request, by endpoint']
+        lines += histogramLines('http_request_duration_seconds', 'endpoint', requestSeconds)
+        lines.append('# HELP mongo_commands_total Database commands sent, by endpoint')
+        lines.append('# TYPE mongo_commands_total counter')
+        lines += [f'mongo_commands_total{{endpoint="{key}"}} {value}' for key, value in sorted(queryCounts.items())]
+        lines.append('# HELP mongo_command_seconds_total Time spent waiting on the database, by endpoint')
+        lines.append('# TYPE mongo_command_seconds_total counter')
+        lines += [f'mongo_command_seconds_total{{endpoint="{key}"}} {value:.6f}' for key, value in sorted(querySeconds.items())]
+        lines.append('# HELP template_render_seconds Time to render a template')
+        lines += histogramLines('template_render_seconds', 'template', templateSeconds)
+    for extra in extraMetrics:
+        lines += extra()
+    return '\n'.join(lines) + '\n'
+
+
+def metricsEnabled():
+    return bool(METRICS_TOKEN)
+
+
+def metricsAllowed():
+    # compare_digest takes the same time however much of the token is right, so the
+    # token can't be guessed one letter at a time
+    given = request.headers.get('Authorization', '')
+    return hmac.compare_digest(given.encode(), f'Bearer {METRICS_TOKEN}'.encode())
@@ -0,0 +1,181 @@
+# This file saves the html of pages (or parts of pages) after they are rendered so the
+# next request can send the saved copy instead of running the template again.
+#
+# Nothing here is ever "out of date" because the key a copy is saved under includes
+# everything it depends on: the id of the blog and its cache_version, the user looking
+# at it and their cache_version, and so on. When a blog changes its cache_version goes
+# up (see blogChanged()), which makes a new key, and the old copy is never asked for
+# again. Old copies are thrown away when the cache is full or after PAGE_CACHE_TTL.
+#
+#   PAGE_CACHE           set to 0 to turn all of this off
+#   PAGE_CACHE_SIZE      how many copies each worker keeps in memory (default 2048)
+#   PAGE_CACHE_TTL       seconds a copy is kept (default 300)
+#   PAGE_CACHE_REDIS_URL a Redis server like redis://localhost:6379/0 shared by all the
+#                        workers. Copies are still kept in memory too. Needs the 'redis'
+#                        package. If Redis is down the pages are just rendered normally.
+#
+# Whole pages:   put @cachedPage under the @app.route() of a page that is the same every
+#                time for the same user (like the home page).
+# Part of a page, in a template:
+#     {% call cached('blogrow', blog.id, blog.modify_date, blog.cache_version) %}
+#         ... html ...
+#     {% endcall %}
+# Part of a page, in a route: cachedFragment(key, function that renders it)
+
+from collections import OrderedDict
+from functools import wraps
+from threading import Lock
+import os
+import time
+
+from flask import request, session
+from flask_login import current_user
+from markupsafe import Markup
+
+from app.classes.data import Blog
+from app.utils.assets import assetsVersion
+from app.utils.database import primaryReads
+from app.utils.metrics import extraMetrics
+
+PAGE_CACHE = os.environ.get("PAGE_CACHE", "1") not in ("", "0")
+PAGE_CACHE_SIZE = int(os.environ.get("PAGE_CACHE_SIZE", 2048))
+PAGE_CACHE_TTL = float(os.environ.get("PAGE_CACHE_TTL", 300))
+PAGE_CACHE_REDIS_URL = os.environ.get("PAGE_CACHE_REDIS_URL")
+
+
+class MemoryCache:
+    # Keeps the most recently used copies in this worker. key -> (html, time it expires)
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            if item[1] < time.monotonic():
+                del self.items[key]
+                return None
+            self.items.move_to_end(key)
+            return item[0]
+
+    def set(self, key, html, ttl):
+        with self.lock:
+            self.items[key] = (html, time.monotonic() + ttl)
+            self.items.move_to_end(key)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+
+class RedisCache:
+    # Shared by every worker. Redis throws the copies away by itself after ttl seconds.
+    def __init__(self, url):
+        import redis
+        self.errors = redis.RedisError
+        self.client = redis.Redis.from_url(url, socket_timeout=0.25, socket_connect_timeout=0.25)
+
+    def get(self, key):
+        try:
+            value = self.client.get(key)
+        except self.errors:
+            return None
+        return value.decode() if value is not None else None
+
+    def set(self, key, html, ttl):
+        try:
+            self.client.set(key, html.encode(), ex=max(int(ttl), 1))
+        except self.errors:
+            pass
+
+
+_memory = MemoryCache(PAGE_CACHE_SIZE)
+_shared = RedisCache(PAGE_CACHE_REDIS_URL) if PAGE_CACHE_REDIS_URL else None
+_stats = {'hits': 0, 'misses': 0}
+
+
+def makeKey(*parts):
+    # The asset version is in every key so a copy never links to static files that a
+    # newer build replaced (see assets.py)
+    return 'page:' + assetsVersion() + ':' + ':'.join(str(part) for part in parts)
+
+
+def getCached(key):
+    html = _memory.get(key)
+    if html is None and _shared:
+        html = _shared.get(key)
+        if html is not None:
+            _memory.set(key, html, PAGE_CACHE_TTL)
+    _stats['hits' if html is not None else 'misses'] += 1
+    return html
+
+
+def setCached(key, html, ttl=None):
+    ttl = ttl or PAGE_CACHE_TTL
+    _memory.set(key, html, ttl)
+    if _shared:
+        _shared.set(key, html, ttl)
+
+
+def cachedFragment(key, render, ttl=None):
+    # Returns the saved html for key, or calls render() to make it and saves that
+    if not PAGE_CACHE:
+        return Markup(render())
+    html = getCached(key)
+    if html is None:
+        # Saved copies are read from the primary database server so a copy is never older
+        # than the version in its key, even in a route that reads from secondaries
+        with primaryReads():
+            html = str(render())
+        setCached(key, html, ttl)
+    return Markup(html)
+
+
+def cached(*parts, ttl=None, caller=None):
+    # Used in templates with {% call cached(...) %}. Jinja passes the html between
+    # {% call %} and {% endcall %} in as caller.
+    return cachedFragment(makeKey('fragment', *parts), caller, ttl)
+
+
+def userKey():
+    # The navbar shows who is logged in so every user gets their own copy of a page
+    if current_user.is_authenticated:
+        return f'{current_user.id}.{current_user.cache_version}'
+    return 'anon'
+
+
+def cachedPage(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        # A page showing flash() messages must be rendered, and it mustn't be saved
+        if not PAGE_CACHE or request.method != 'GET' or session.get('_flashes'):
+            return view(*args, **kwargs)
+        key = makeKey('page', request.full_path, userKey())
+        html = getCached(key)
+        if html is not None:
+            return html
+        response = view(*args, **kwargs)
+        # Only plain html is saved, not redirects or other responses
+        if isinstance(response, str):
+            setCached(key, response)
+        return response
+    return wrapper
+
+
+def blogChanged(blogId):
+    # Call this after a blog, or any comment on it, is changed. Every worker will use
+    # new keys for this blog because the number is in the database.
+    Blog.objects(pk=blogId).update_one(inc__cache_version=1)
+
+
+def cacheMetrics():
+    return [
+        '# HELP page_cache_requests_total Page cache lookups, by result',
+        '# TYPE page_cache_requests_total counter',
+        f'page_cache_requests_total{{result="hit"}} {_stats["hits"]}',
+        f'page_cache_requests_total{{result="miss"}} {_stats["misses"]}',
+    ]
+
+
+extraMetrics.append(cacheMetrics)
@@ -0,0 +1,90 @@
+# This file splits long lists (like all the sleeps or all the blogs) into pages.
+# Instead of "skip the first 500 and show 25" (which makes the database walk past
+# 500 documents) each page remembers the last document it showed. The next page
+# then asks for documents that come after that one, which is just as fast on page
+# 1000 as it is on page 1. This is called keyset or cursor pagination.
+
+import base64
+import datetime as dt
+import json
+
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from flask import abort, request
+from mongoengine.queryset.visitor import Q
+
+PAGE_SIZE = 25
+MAX_PAGE_SIZE = 100
+
+
+class Page:
+    def __init__(self, items, nextToken=None, prevToken=None, limit=PAGE_SIZE):
+        self.items = items
+        self.nextToken = nextToken
+        self.prevToken = prevToken
+        self.limit = limit
+
+
+def encodeCursor(doc, field):
+    value = doc[field]
+    if isinstance(value, dt.datetime):
+        value = value.isoformat()
+    raw = json.dumps([value, str(doc.id)]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('utf-8')
+
+
+def decodeCursor(token):
+    value, docId = json.loads(base64.urlsafe_b64decode(token.encode('utf-8')))
+    if value is not None:
+        value = dt.datetime.fromisoformat(value)
+    return value, ObjectId(docId)
+
+
+def olderThan(field, value, docId):
+    # Everything that comes after the cursor when the list is sorted newest first.
+    # Documents without a date sort last so they still show up on the final pages.
+    if value is None:
+        return Q(**{field: None, 'id__lt': docId})
+    return Q(**{f'{field}__lt': value}) | Q(**{field: value, 'id__lt': docId}) | Q(**{field: None})
+
+
+def newerThan(field, value, docId):
+    # Everything that comes before the cursor when the list is sorted newest first.
+    if value is None:
+        return Q(**{field: None, 'id__gt': docId}) | Q(**{f'{field}__ne': None})
+    return Q(**{f'{field}__gt': value}) | Q(**{field: value, 'id__gt': docId})
+
+
+def keysetPage(queryset, field):
+    # Reads ?after=<token>, ?before=<token> and ?limit=<n> from the url and returns one
+    # Page of the queryset sorted newest first by field and then by _id.
+    try:
+        limit = min(max(int(request.args.get('limit', PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    except ValueError:
+        limit = PAGE_SIZE
+    after = request.args.get('after')
+    before = request.args.get('before')
+
+    try:
+        if before:
+            value, docId = decodeCursor(before)
+            # Walk backwards (oldest first) from the cursor, then flip the result around
+            docs = list(queryset.filter(newerThan(field, value, docId)).order_by(f'+{field}', '+id').limit(limit + 1))
+            hasMore = len(docs) > limit
+            items = docs[:limit][::-1]
+            prevToken = encodeCursor(items[0], field) if hasMore and items else None
+            nextToken = encodeCursor(items[-1], field) if items else None
+        else:
+            if after:
+                value, docId = decodeCursor(after)
+                queryset = queryset.filter(olderThan(field, value, docId))
+            docs = list(queryset.order_by(f'-{field}', '-id').limit(limit + 1))
+            hasMore = len(docs) > limit
+            items = docs[:limit]
+            nextToken = encodeCursor(items[-1], field) if hasMore else None
+            prevToken = encodeCursor(items[0], field) if after and items else None
+    except (ValueError, TypeError, InvalidId):
+        # The token in the url was not one we made
+        abort(400)
+
+    return Page(items, nextToken, prevToken, limit)
@@ -0,0 +1,153 @@
+# This file can profile live requests: it records which functions a request spent its
+# time in, so you can find out why a page is slow on the real server. It is off unless
+# PROFILE_MODE is set, and when it is off it adds nothing at all to a request.
+#
+#   PROFILE_MODE       'cprofile' records every function call (most detail, slower) or
+#                      'sample' looks at what the request is doing every few milliseconds
+#                      (less detail, very little slowdown). Writes .prof or .collapsed files.
+#   PROFILE_RATE       fraction of requests to profile, like 0.01 for 1 in 100 (default 0)
+#   PROFILE_TOKEN      a request with the header 'X-Profile: <this token>' is always profiled
+#   PROFILE_ENDPOINTS  only profile these routes, like 'sleepgraph,blog,callback' (default all)
+#   PROFILE_DIR        where the files go (default /tmp/capstone-profiles)
+#   PROFILE_KEEP       how many files to keep. The oldest are deleted. (default 50)
+#   PROFILE_INTERVAL   seconds between samples in 'sample' mode (default 0.005)
+#
+# Open .prof files with 'python -m pstats <file>' or snakeviz. .collapsed files are
+# "folded stacks" that speedscope.app or flamegraph.pl turn into a flame graph.
+
+from collections import Counter
+from functools import wraps
+import cProfile
+import hmac
+import inspect
+import os
+import random
+import sys
+import threading
+import time
+
+from flask import request
+
+PROFILE_MODE = os.environ.get("PROFILE_MODE", "")
+PROFILE_RATE = float(os.environ.get("PROFILE_RATE", 0))
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN")
+PROFILE_ENDPOINTS = [name for name in os.environ.get("PROFILE_ENDPOINTS", "").split(",") if name]
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "/tmp/capstone-profiles")
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", 50))
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", 0.005))
+
+_writeLock = threading.Lock()
+
+
+def shouldProfile():
+    # compare_digest so the time taken doesn't give away how much of the token is right
+    if PROFILE_TOKEN and hmac.compare_digest(request.headers.get('X-Profile', '').encode(), PROFILE_TOKEN.encode()):
+        return True
+    return PROFILE_RATE > 0 and random.random() < PROFILE_RATE
+
+
+class Sampler:
+    # Every PROFILE_INTERVAL seconds a helper thread looks at the call stack of the
+    # request's thread and counts it. Stacks that show up a lot are where time goes.
+    def __init__(self, threadId):
+        self.threadId = threadId
+        self.stacks = Counter()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while self.running:
+            frame = sys._current_frames().get(self.threadId)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+            time.sleep(PROFILE_INTERVAL)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+
+def saveProfile(endpoint, write, extension):
+    # Writes one file and deletes the oldest ones so there are never more than PROFILE_KEEP
+    with _writeLock:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        path = os.path.join(PROFILE_DIR, f'{stamp}-{time.perf_counter_ns() % 10**9:09d}-{endpoint}-{os.getpid()}.{extension}')
+        write(path)
+        files = sorted(name for name in os.listdir(PROFILE_DIR) if name.endswith(('.prof', '.collapsed')))
+        for name in files[:-PROFILE_KEEP]:
+            try:
+                os.remove(os.path.join(PROFILE_DIR, name))
+            except OSError:
+                pass
+
+
+def writeCollapsed(stacks):
+    def write(path):
+        with open(path, 'w') as file:
+            for stack, count in stacks.most_common():
+                file.write(f'{stack} {count}\n')
+    return write
+
+
+def startProfile():
+    if PROFILE_MODE == 'sample':
+        profiler = Sampler(threading.get_ident())
+        profiler.start()
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    return profiler
+
+
+def stopProfile(profiler, endpoint):
+    if isinstance(profiler, Sampler):
+        profiler.stop()
+        saveProfile(endpoint, writeCollapsed(profiler.stacks), 'collapsed')
+    else:
+        profiler.disable()
+        saveProfile(endpoint, profiler.dump_stats, 'prof')
+
+
+def profiled(view, endpoint):
+    # Wraps one view function. Requests that aren't picked run the view directly.
+    if inspect.iscoroutinefunction(view):
+        @wraps(view)
+        async def asyncWrapper(*args, **kwargs):
+            if not shouldProfile():
+                return await view(*args, **kwargs)
+            profiler = startProfile()
+            try:
+                return await view(*args, **kwargs)
+            finally:
+                stopProfile(profiler, endpoint)
+        return asyncWrapper
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not shouldProfile():
+            return view(*args, **kwargs)
+        profiler = startProfile()
+        try:
+            return view(*args, **kwargs)
+        finally:
+            stopProfile(profiler, endpoint)
+    return wrapper
+
+
+def registerProfiler(app):
+    # Call this after all the routes are imported. Does nothing if PROFILE_MODE isn't set.
+    if PROFILE_MODE not in ('cprofile', 'sample'):
+        return
+    for endpoint, view in list(app.view_functions.items()):
+        if endpoint == 'static' or (PROFILE_ENDPOINTS and endpoint not in PROFILE_ENDPOINTS):
+            continue
+        app.view_functions[endpoint] = profiled(view, endpoint)
@@ -0,0 +1,325 @@
+# Each user has one SleepRollup document (see data.py) that holds the totals of all
+# their sleeps: for all time, for each day and for each week. Showing someone's averages
+# is then one small read no matter how many nights they have logged.
+#
+# The routes keep it up to date as sleeps change:
+#     sleep added:    rollupAdd(sleep)
+#     sleep changed:  rollupChange(sleep, changes)
+#     sleep deleted:  rollupRemove(sleep)
+# These use $inc so the database adds the numbers itself and two changes at the same
+# time can't overwrite each other. If a rollup ever gets out of step (or a lot of sleeps
+# were imported at once) rebuildRollup() works it out again from the sleeps.
+# 'flask rebuild-rollups' does that for everybody (see commands.py).
+#
+# The 'days' map grows by one entry for every night ever logged, so nothing reads all of
+# it except a rebuild. Summaries read the totals, the streaks and this week, and updates
+# only read back the days that changed and the days right next to them.
+
+import asyncio
+import datetime as dt
+
+from pymongo import ReadPreference, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from app.classes.data import Sleep, SleepRollup
+from app.utils.asyncdb import findRaw
+from app.utils.database import routedCollection
+from app.utils.loaders import refId
+
+# Sleep field -> name used in the rollup (name_total and name_count)
+ROLLUP_FIELDS = {
+    'hours': 'hours',
+    'rating': 'rating',
+    'feel': 'feel',
+    'minstosleep': 'mins',
+}
+STREAK_FIELDS = ('current_streak', 'longest_streak', 'streak_end')
+# How many days next to a changed day are read at once when moving the streaks along
+RUN_WINDOW = 31
+
+
+def weekKey(date):
+    year, week, weekday = date.isocalendar()
+    return f'{year}-W{week:02d}'
+
+
+def sleepValues(sleep, changes=None):
+    # The fields of a sleep that the rollup uses, with any changes applied. Values from
+    # a form can still be text (like '4') until they are saved, so each field converts
+    # them the same way it does when saving.
+    values = {field: getattr(sleep, field) for field in ('sleep_date', *ROLLUP_FIELDS)}
+    values.update((field, value) for field, value in (changes or {}).items() if field in values)
+    return {field: Sleep._fields[field].to_python(value) if value is not None else None
+            for field, value in values.items()}
+
+
+def increments(values, sign):
+    # The $inc for adding (sign=1) or taking away (sign=-1) one sleep. It is added to the
+    # all time totals and to the totals of its day and its week.
+    prefixes = ['']
+    sleepDate = values['sleep_date']
+    if sleepDate:
+        prefixes += [f'days.{sleepDate:%Y-%m-%d}.', f'weeks.{weekKey(sleepDate)}.']
+    inc = {}
+    for prefix in prefixes:
+        inc[prefix + 'nights'] = inc.get(prefix + 'nights', 0) + sign
+        for field, name in ROLLUP_FIELDS.items():
+            value = values[field]
+            if value is not None:
+                inc[f'{prefix}{name}_total'] = inc.get(f'{prefix}{name}_total', 0) + value * sign
+                inc[f'{prefix}{name}_count'] = inc.get(f'{prefix}{name}_count', 0) + sign
+    return inc
+
+
+def combine(*incs):
+    total = {}
+    for inc in incs:
+        for key, value in inc.items():
+            total[key] = total.get(key, 0) + value
+    # Leave out anything that didn't change
+    return {key: value for key, value in total.items() if value}
+
+
+def streaks(dayKeys):
+    # Counts the nights in a row in a list of dates like '2022-11-28'
+    longest = current = 0
+    previous = None
+    for date in sorted(dt.date.fromisoformat(key) for key in dayKeys):
+        if previous and date - previous == dt.timedelta(days=1):
+            current += 1
+        else:
+            current = 1
+        longest = max(longest, current)
+        previous = date
+    return {
+        'current_streak': current,
+        'longest_streak': longest,
+        'streak_end': dt.datetime.combine(previous, dt.time()) if previous else None,
+    }
+
+
+def changedNights(inc, group):
+    # The days (or weeks) in an $inc whose number of nights changes, and by how much
+    return {key.split('.')[1]: value for key, value in inc.items()
+            if key.startswith(group + '.') and key.endswith('.nights')}
+
+
+def nightsOn(rollup, group, key):
+    return rollup.get(group, {}).get(key, {}).get('nights', 0)
+
+
+def runsAround(rollupId, day, pending):
+    # How many days in a row have sleeps just before 'day' and just after it. Only the
+    # days next to it are read, RUN_WINDOW at a time, never the whole 'days' map.
+    # pending is days to count as having sleeps (True) or not (False) whatever the
+    # database says, because their change hasn't been counted into the streaks yet.
+    runs = {-1: 0, 1: 0}
+    going = [-1, 1]
+    while going:
+        dates = {step: [day + dt.timedelta(days=step * (runs[step] + i)) for i in range(1, RUN_WINDOW + 1)]
+                 for step in going}
+        projection = {f'days.{date:%Y-%m-%d}.nights': 1 for step in going for date in dates[step]}
+        days = (SleepRollup._get_collection().find_one({'_id': rollupId}, projection) or {}).get('days', {})
+        for step in list(going):
+            for date in dates[step]:
+                key = f'{date:%Y-%m-%d}'
+                if not pending.get(key, days.get(key, {}).get('nights', 0) > 0):
+                    going.remove(step)
+                    break
+                runs[step] += 1
+    return runs[-1], runs[1]
+
+
+def dayAdded(rollupId, streak, day, pending):
+    # The streaks after 'day' got its first sleep
+    before, after = runsAround(rollupId, day, pending)
+    streak['longest_streak'] = max(streak['longest_streak'], before + 1 + after)
+    end = streak['streak_end'].date() if streak['streak_end'] else None
+    if end is None or day > end:
+        streak['current_streak'] = before + 1
+        streak['streak_end'] = dt.datetime.combine(day, dt.time())
+    elif day + dt.timedelta(days=after) == end:
+        # It joined up with the run that ends on the latest day
+        streak['current_streak'] = before + 1 + after
+    return streak
+
+
+def dayRemoved(rollupId, streak, day, pending):
+    # The streaks after 'day' lost its last sleep. None means they have to be counted
+    # again from every day.
+    before, after = runsAround(rollupId, day, pending)
+    if before + 1 + after >= streak['longest_streak']:
+        # The longest run was split and there's no telling if another one is as long
+        return None
+    end = streak['streak_end'].date() if streak['streak_end'] else None
+    if day == end:
+        if not before:
+            # The latest day left could be any time before
+            return None
+        streak['current_streak'] = before
+        streak['streak_end'] = dt.datetime.combine(day - dt.timedelta(days=1), dt.time())
+    elif end and day < end and day + dt.timedelta(days=after) == end:
+        streak['current_streak'] = after
+    return streak
+
+
+def recountStreaks(rollupId):
+    # Reads every day, so it's only for when dayRemoved() can't tell
+    rollup = SleepRollup._get_collection().find_one({'_id': rollupId}, {'days': 1}) or {}
+    return streaks(key for key, entry in rollup.get('days', {}).items() if entry.get('nights', 0) > 0)
+
+
+def tidyRollup(rollup, inc):
+    # After an update: forget days and weeks that have no sleeps left and move the
+    # streaks along. Streaks depend on which days have sleeps, so they can't be $inc'd,
+    # but only the days that gained their first sleep or lost their last one change them.
+    collection = SleepRollup._get_collection()
+    days = changedNights(inc, 'days')
+    for group, changed in (('days', days), ('weeks', changedNights(inc, 'weeks'))):
+        for key in changed:
+            if nightsOn(rollup, group, key) <= 0:
+                # Only if it is still empty. A sleep added since the $inc keeps it.
+                collection.update_one({'_id': rollup['_id'], f'{group}.{key}.nights': {'$lte': 0}},
+                                      {'$unset': {f'{group}.{key}': ''}})
+    started = [key for key, change in days.items() if nightsOn(rollup, 'days', key) > 0 >= nightsOn(rollup, 'days', key) - change]
+    ended = [key for key, change in days.items() if nightsOn(rollup, 'days', key) <= 0 < nightsOn(rollup, 'days', key) - change]
+    if not started and not ended:
+        return rollup
+
+    streak = {
+        'current_streak': rollup.get('current_streak') or 0,
+        'longest_streak': rollup.get('longest_streak') or 0,
+        'streak_end': rollup.get('streak_end'),
+    }
+    # One day at a time, so the days still to do look like they did before this update
+    pending = {**dict.fromkeys(ended, True), **dict.fromkeys(started, False)}
+    for key in ended + started:
+        del pending[key]
+        change = dayRemoved if key in ended else dayAdded
+        streak = change(rollup['_id'], streak, dt.date.fromisoformat(key), pending)
+        if streak is None:
+            streak = recountStreaks(rollup['_id'])
+            break
+    collection.update_one({'_id': rollup['_id']}, {'$set': streak})
+    rollup.update(streak)
+    return rollup
+
+
+def updateRollup(userId, inc):
+    update = {'$set': {'modify_date': dt.datetime.utcnow()}}
+    if inc:
+        update['$inc'] = inc
+    # Only the streaks and the nights of the days and weeks that changed come back
+    projection = dict.fromkeys(STREAK_FIELDS, 1)
+    for group in ('days', 'weeks'):
+        projection.update({f'{group}.{key}.nights': 1 for key in changedNights(inc, group)})
+    rollup = SleepRollup._get_collection().find_one_and_update(
+        {'user': userId}, update, projection=projection, return_document=ReturnDocument.AFTER,
+    )
+    if rollup is None:
+        # This user has no rollup yet (their sleeps are older than rollups) so adding
+        # one sleep to nothing would be wrong. Work it out from all of their sleeps.
+        return rebuildRollup(userId)
+    return tidyRollup(rollup, inc)
+
+
+def rollupAdd(sleep):
+    # Call after the new sleep is saved
+    return updateRollup(refId(sleep._data.get('sleeper')), increments(sleepValues(sleep), 1))
+
+
+def rollupChange(sleep, changes):
+    # Call after sleep.update(**changes). sleep still has the values from before.
+    inc = combine(increments(sleepValues(sleep), -1), increments(sleepValues(sleep, changes), 1))
+    return updateRollup(refId(sleep._data.get('sleeper')), inc)
+
+
+def rollupRemove(sleep):
+    # Call after the sleep is deleted
+    return updateRollup(refId(sleep._data.get('sleeper')), increments(sleepValues(sleep), -1))
+
+
+def rebuildRollup(userId):
+    # Works out a user's rollup from scratch. The database adds up each day and Python
+    # adds the days into weeks and the all time totals.
+    group = {'_id': {'$dateToString': {'format': '%Y-%m-%d', 'date': '$sleep_date'}}, 'nights': {'$sum': 1}}
+    for field, name in ROLLUP_FIELDS.items():
+        group[f'{name}_total'] = {'$sum': f'${field}'}
+        # Every number is greater than null, and a missing field is less than null
+        group[f'{name}_count'] = {'$sum': {'$cond': [{'$gt': [f'${field}', None]}, 1, 0]}}
+    rollup = {'user': userId, 'nights': 0, 'days': {}, 'weeks': {}}
+    for field, name in ROLLUP_FIELDS.items():
+        rollup[f'{name}_total'] = 0
+        rollup[f'{name}_count'] = 0
+
+    # Always from the primary: the rollup is saved, so it mustn't miss any recent sleeps
+    sleeps = Sleep.objects(sleeper=userId).read_preference(ReadPreference.PRIMARY)
+    for row in sleeps.aggregate([{'$group': group}]):
+        day = row.pop('_id')
+        totals = [rollup]
+        if day:
+            rollup['days'][day] = dict(row)
+            totals.append(rollup['weeks'].setdefault(weekKey(dt.date.fromisoformat(day)), {}))
+        for target in totals:
+            for key, value in row.items():
+                target[key] = target.get(key, 0) + value
+
+    rollup.update(streaks(rollup['days']))
+    rollup['modify_date'] = dt.datetime.utcnow()
+    collection = SleepRollup._get_collection()
+    try:
+        collection.replace_one({'user': userId}, rollup, upsert=True)
+    except DuplicateKeyError:
+        # Another request made this user's rollup at the same moment
+        collection.replace_one({'user': userId}, rollup)
+    return rollup
+
+
+def average(entry, name):
+    count = entry.get(f'{name}_count', 0)
+    return entry.get(f'{name}_total', 0) / count if count > 0 else None
+
+
+def summaryFields(today):
+    # What summaryOf() needs. The days and the other weeks can be years of entries, so
+    # they are left in the database.
+    fields = ['nights', *STREAK_FIELDS, f'weeks.{weekKey(today)}']
+    fields += [f'{name}_{part}' for name in ROLLUP_FIELDS.values() for part in ('total', 'count')]
+    return dict.fromkeys(fields, 1)
+
+
+def rollupSummary(user):
+    # Everything _sleepstats.html shows, from one read of the user's rollup
+    rollup = routedCollection(SleepRollup).find_one({'user': user.id}, summaryFields(dt.datetime.utcnow().date()))
+    if rollup is None:
+        rollup = rebuildRollup(user.id)
+    return summaryOf(rollup)
+
+
+async def rollupSummaryAsync(user):
+    # The same for async views, see asyncdb.py
+    rollups = await findRaw(SleepRollup, {'user': user.id}, summaryFields(dt.datetime.utcnow().date()), limit=1)
+    if rollups:
+        return summaryOf(rollups[0])
+    # Rebuilding is rare so it stays the normal code, in a thread so the loop isn't blocked
+    return summaryOf(await asyncio.to_thread(rebuildRollup, user.id))
+
+
+def summaryOf(rollup):
+    today = dt.datetime.utcnow().date()
+    summary = {
+        'nights': rollup.get('nights', 0),
+        'avgHours': average(rollup, 'hours'),
+        'avgRating': average(rollup, 'rating'),
+        'avgFeel': average(rollup, 'feel'),
+        'avgMinsToSleep': average(rollup, 'mins'),
+        'longestStreak': rollup.get('longest_streak', 0),
+        # A streak that ended before last night isn't going any more
+        'currentStreak': 0,
+    }
+    streakEnd = rollup.get('streak_end')
+    if streakEnd and streakEnd.date() >= today - dt.timedelta(days=1):
+        summary['currentStreak'] = rollup.get('current_streak', 0)
+    thisWeek = rollup.get('weeks', {}).get(weekKey(today), {})
+    summary['weekNights'] = thisWeek.get('nights', 0)
+    summary['weekAvgHours'] = average(thisWeek, 'hours')
+    return summary
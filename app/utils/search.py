@@ -0,0 +1,168 @@
+# This file searches the blogs (and the comments on them) for words. There are two ways
+# it can work, picked with the SEARCH_MODE environment variable:
+#
+#   'text'   (default) uses the MongoDB text indexes declared on Blog and Comment in
+#            data.py. The database finds and ranks the matches.
+#   'memory' builds an "inverted index" inside this worker: a dictionary from every word
+#            to the blogs that use it. Use this if your database doesn't support text
+#            indexes. When it is out of date one background thread builds a new one and
+#            searches keep using the old one until it's ready.
+#
+# Either way a blog's score is how well its subject, tag and content match, plus a bit
+# for every matching comment.
+
+from collections import defaultdict
+from threading import Lock, Thread
+import math
+import os
+import re
+import time
+
+from app.classes.data import Blog, Comment
+
+SEARCH_MODE = os.environ.get("SEARCH_MODE", "text")
+RESULTS_PER_PAGE = 20
+# Only this many of the best matches are ranked and paged through
+MAX_RESULTS = 200
+# A matching comment counts for this much of a matching blog
+COMMENT_WEIGHT = 0.5
+# These should match the weights of the Blog text index in data.py
+FIELD_WEIGHTS = {'subject': 10, 'tag': 5, 'content': 1}
+# In 'memory' mode other workers' changes are picked up by rebuilding this often (seconds)
+SEARCH_INDEX_TTL = float(os.environ.get("SEARCH_INDEX_TTL", 60))
+
+STOP_WORDS = {'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'i', 'in',
+    'is', 'it', 'of', 'on', 'or', 'that', 'the', 'this', 'to', 'was', 'with', 'you'}
+
+
+def words(text):
+    return [word for word in re.findall(r'\w+', (text or '').lower()) if word not in STOP_WORDS]
+
+
+def textScores(query, tag=None, limit=MAX_RESULTS):
+    # Ask MongoDB for the best matching blogs and comments. Returns {blogId: score}
+    # The tag is part of the search itself so the best matches with that tag are found,
+    # not the best matches overall that happen to have it.
+    scores = defaultdict(float)
+    blogFilter = {'$text': {'$search': query}}
+    commentFilter = {'$text': {'$search': query}}
+    if tag:
+        blogFilter['tag'] = tag
+        # Comments don't have a tag, only the blog they are on does
+        commentFilter['blog'] = {'$in': list(Blog.objects(tag=tag).scalar('id'))}
+    blogs = Blog._get_collection().find(
+        blogFilter,
+        {'score': {'$meta': 'textScore'}},
+    ).sort([('score', {'$meta': 'textScore'})]).limit(limit)
+    for blog in blogs:
+        scores[blog['_id']] += blog['score']
+    comments = Comment._get_collection().find(
+        commentFilter,
+        {'blog': 1, 'score': {'$meta': 'textScore'}},
+    ).sort([('score', {'$meta': 'textScore'})]).limit(limit)
+    for comment in comments:
+        if comment.get('blog'):
+            scores[comment['blog']] += comment['score'] * COMMENT_WEIGHT
+    return scores
+
+
+class InvertedIndex:
+    # word -> {blogId: weighted number of times the word appears}
+    def __init__(self):
+        self.postings = defaultdict(lambda: defaultdict(float))
+        self.tags = {}
+        self.builtAt = 0
+        # Goes up every time a blog or comment changes. An index built before the last
+        # change is out of date.
+        self.changes = 0
+        self.builtChanges = None
+        self.lock = Lock()
+        # Held while an index is being built so only one is built at a time
+        self.buildLock = Lock()
+
+    def build(self):
+        changes = self.changes
+        postings = defaultdict(lambda: defaultdict(float))
+        tags = {}
+        # as_pymongo() skips making mongoengine objects which is much faster for this
+        for blog in Blog.objects().only('subject', 'content', 'tag').as_pymongo():
+            tags[blog['_id']] = blog.get('tag')
+            for field, weight in FIELD_WEIGHTS.items():
+                for word in words(blog.get(field)):
+                    postings[word][blog['_id']] += weight
+        for comment in Comment.objects().only('blog', 'content').as_pymongo():
+            if comment.get('blog') in tags:
+                for word in words(comment.get('content')):
+                    postings[word][comment['blog']] += COMMENT_WEIGHT
+        with self.lock:
+            self.postings = postings
+            self.tags = tags
+            self.builtAt = time.monotonic()
+            self.builtChanges = changes
+
+    def buildInBackground(self):
+        # buildLock was taken by the request that started this thread
+        try:
+            self.build()
+        finally:
+            self.buildLock.release()
+
+    def refresh(self):
+        if self.builtAt and self.builtChanges == self.changes and time.monotonic() - self.builtAt <= SEARCH_INDEX_TTL:
+            return
+        if self.builtAt:
+            # Keep searching the old index while one thread builds a new one
+            if self.buildLock.acquire(blocking=False):
+                Thread(target=self.buildInBackground, daemon=True).start()
+            return
+        # There is nothing to search yet. The first request builds it and the others
+        # wait for that instead of each building their own.
+        with self.buildLock:
+            if not self.builtAt:
+                self.build()
+
+    def scores(self, query, tag=None):
+        self.refresh()
+        scores = defaultdict(float)
+        with self.lock:
+            total = max(len(self.tags), 1)
+            for word in set(words(query)):
+                matches = self.postings.get(word, {})
+                if not matches:
+                    continue
+                # Rare words count for more than words that are in every blog (idf)
+                idf = math.log(1 + total / len(matches))
+                for blogId, count in matches.items():
+                    if tag and self.tags.get(blogId) != tag:
+                        continue
+                    scores[blogId] += (1 + math.log(count)) * idf
+        return scores
+
+
+memoryIndex = InvertedIndex()
+
+
+def searchChanged():
+    # Call this after a blog or comment is created, edited or deleted
+    if SEARCH_MODE == 'memory':
+        memoryIndex.changes += 1
+
+
+def searchBlogs(query, tag=None, page=1):
+    # Returns (list of (blog, score) on this page, number of pages)
+    if SEARCH_MODE == 'memory':
+        scores = memoryIndex.scores(query, tag)
+    else:
+        scores = textScores(query, tag)
+
+    ranked = sorted(scores, key=scores.get, reverse=True)[:MAX_RESULTS]
+
+    pages = max((len(ranked) + RESULTS_PER_PAGE - 1) // RESULTS_PER_PAGE, 1)
+    page = min(max(page, 1), pages)
+    pageIds = ranked[(page - 1) * RESULTS_PER_PAGE:page * RESULTS_PER_PAGE]
+    blogs = {blog.id: blog for blog in Blog.objects(id__in=pageIds).exclude('content')}
+    results = []
+    for blogId in pageIds:
+        if blogId in blogs:
+            results.append((blogs[blogId], scores[blogId]))
+    return results, pages
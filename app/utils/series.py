@@ -0,0 +1,78 @@
+# The data for the interactive sleep chart on the sleep graph page. The browser draws the
+# chart itself (with Chart.js) so the server only sends numbers, not a picture.
+#
+# Someone who has logged sleep for years has more nights than the chart is pixels wide.
+# Sending all of them would make a big download and a slow chart that looks the same,
+# so they are cut down to a number of points with LTTB ("largest triangle three
+# buckets"). It keeps the points that change the shape of the line the most, so peaks and
+# dips survive, unlike taking every 10th night.
+# https://skemman.is/handle/1946/15343 (Steinarsson, 2013)
+
+import datetime as dt
+
+from app.utils.sleepstats import rollingMeans
+
+DEFAULT_POINTS = 500
+MIN_POINTS = 10
+MAX_POINTS = 2000
+SERIES_FIELDS = ('hours', 'rating', 'avg7', 'avg30')
+
+
+def lttb(xs, ys, threshold):
+    # Returns the positions of the threshold points to keep. The first and last points
+    # are always kept. The rest are split into buckets and from each bucket the point
+    # making the biggest triangle with the point kept before it and the average of the
+    # next bucket is kept.
+    count = len(xs)
+    if threshold >= count or threshold < 3:
+        return list(range(count))
+    every = (count - 2) / (threshold - 2)
+    kept = [0]
+    previous = 0
+    for bucket in range(threshold - 2):
+        nextStart = int((bucket + 1) * every) + 1
+        nextEnd = min(int((bucket + 2) * every) + 1, count)
+        avgX = sum(xs[nextStart:nextEnd]) / (nextEnd - nextStart)
+        avgY = sum(ys[nextStart:nextEnd]) / (nextEnd - nextStart)
+
+        best = start = int(bucket * every) + 1
+        bestArea = -1
+        for i in range(start, nextStart):
+            # Twice the area of the triangle, which is enough to compare them
+            area = abs((xs[previous] - avgX) * (ys[i] - ys[previous]) - (xs[previous] - xs[i]) * (avgY - ys[previous]))
+            if area > bestArea:
+                best, bestArea = i, area
+        kept.append(best)
+        previous = best
+    kept.append(count - 1)
+    return kept
+
+
+def roundOrNone(value):
+    return round(value, 2) if value is not None else None
+
+
+def sleepSeries(user, since=None, until=None, points=DEFAULT_POINTS):
+    # Columns instead of a list of objects: {"date": [...], "hours": [...], ...} is
+    # much smaller than repeating every field name for every night.
+    rows = [row for row in rollingMeans(user, since, until) if row.get('hours') is not None]
+    xs = [row['date'].toordinal() for row in rows]
+    ys = [row['hours'] for row in rows]
+    kept = [rows[i] for i in lttb(xs, ys, points)]
+    series = {
+        'from': since.date().isoformat() if since else None,
+        'to': until.date().isoformat() if until else None,
+        'total': len(rows),
+        'points': len(kept),
+        'date': [row['date'].date().isoformat() for row in kept],
+    }
+    for field in SERIES_FIELDS:
+        series[field] = [roundOrNone(row.get(field)) for row in kept]
+    return series
+
+
+def parseDay(text):
+    # '2022-11-28' -> datetime, or None if it's missing. Raises ValueError if it's wrong.
+    if not text:
+        return None
+    return dt.datetime.strptime(text, '%Y-%m-%d')
@@ -0,0 +1,207 @@
+# This file moves lots of sleeps in and out of the database at once.
+#
+# Export: the sleeps are read from the database in batches and turned into lines of CSV
+# or NDJSON (one JSON object per line) as they are sent, so even a huge export only ever
+# has one batch in memory.
+#
+# Import: each row is checked, then rows are written in batches with one bulk_write per
+# batch instead of one save() per sleep. A row for a night that is already in the
+# database (same sleeper and sleep_date) replaces it instead of making a copy.
+
+import csv
+import datetime as dt
+import io
+import json
+
+from pymongo import UpdateOne
+from app.classes.data import Sleep, User
+from app.utils.graphs import sleepsChanged
+from app.utils.rollups import rebuildRollup
+from app.utils.secrets import getSecrets
+
+EXPORT_FIELDS = ['sleep_date', 'start', 'end', 'hours', 'rating', 'feel', 'minstosleep']
+BATCH_SIZE = 1000
+# Only this many bad rows are reported back
+MAX_ERRORS = 50
+
+secrets = getSecrets()
+
+
+def adminEmails():
+    # ADMIN_EMAILS in secrets.py can be a list or one string like 'a@ousd.org, b@ousd.org'.
+    # It becomes a set of whole addresses so 'a@b.c' can't match inside 'xa@b.com'.
+    admins = secrets.get('ADMIN_EMAILS') or [secrets.get('MY_EMAIL_ADDRESS')]
+    if isinstance(admins, str):
+        admins = admins.replace(';', ',').split(',')
+    return {email.strip().lower() for email in admins if email and email.strip()}
+
+
+def canExportCohort(user):
+    # Teachers/admins listed in secrets.py can export the sleeps of every student who
+    # has consented to share them.
+    return bool(user.email) and user.email.strip().lower() in adminEmails()
+
+
+def exportRows(sleeperIds):
+    # Yields one dictionary per sleep using the raw pymongo cursor, which skips building
+    # mongoengine objects. batch_size is how many sleeps come back per trip to the database.
+    projection = {field: 1 for field in EXPORT_FIELDS}
+    projection['sleeper'] = 1
+    cursor = Sleep._get_collection().find(
+        {'sleeper': {'$in': list(sleeperIds)}}, projection
+    ).sort([('sleeper', 1), ('sleep_date', 1)]).batch_size(BATCH_SIZE)
+    for row in cursor:
+        yield {
+            'sleeper': str(row.get('sleeper')),
+            **{field: row.get(field) for field in EXPORT_FIELDS},
+        }
+
+
+def toText(value):
+    if isinstance(value, dt.datetime):
+        return value.isoformat()
+    return value
+
+
+def csvLines(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['sleeper'] + EXPORT_FIELDS)
+    for row in rows:
+        writer.writerow([toText(value) for value in row.values()])
+        # Hand over what has been written so far and empty the buffer
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+    yield buffer.getvalue()
+
+
+def ndjsonLines(rows):
+    for row in rows:
+        yield json.dumps({key: toText(value) for key, value in row.items()}) + '\n'
+
+
+EXPORT_FORMATS = {
+    'csv': ('text/csv', csvLines),
+    'ndjson': ('application/x-ndjson', ndjsonLines),
+}
+
+
+def readRows(stream, fmt):
+    # stream is a text file. Yields (line number, row). NDJSON rows are still text here
+    # so that a broken line is reported as a bad row instead of stopping the import.
+    # A file that isn't UTF-8 text or isn't really CSV can't be read past the problem,
+    # so the problem is yielded as a ValueError in place of a row and reading stops.
+    if fmt == 'ndjson':
+        rows = ((number, line) for number, line in enumerate(stream, start=1) if line.strip())
+    else:
+        rows = enumerate(csv.DictReader(stream), start=2)
+    number = 0
+    try:
+        for number, row in rows:
+            yield number, row
+    except UnicodeDecodeError:
+        yield number + 1, ValueError("the file isn't UTF-8 text, nothing after this was read")
+    except csv.Error as error:
+        yield number + 1, ValueError(f"can't be read as CSV ({error}), nothing after this was read")
+
+
+def parseDate(value):
+    value = toText(value)
+    if not value:
+        return None
+    return dt.datetime.fromisoformat(str(value))
+
+
+def parseScore(value, low, high, name):
+    if value in (None, ''):
+        return None
+    number = int(value)
+    if not low <= number <= high:
+        raise ValueError(f"{name} must be between {low} and {high}")
+    return number
+
+
+def cleanRow(row):
+    # Turns one imported row into the fields of a Sleep. Raises ValueError if it's bad.
+    if not isinstance(row, dict):
+        raise ValueError("each line must be a JSON object")
+    start = parseDate(row.get('start'))
+    end = parseDate(row.get('end'))
+    if not start or not end:
+        raise ValueError("start and end are required")
+    if end <= start:
+        raise ValueError("end must be after start")
+    sleepDate = parseDate(row.get('sleep_date')) or start
+    hours = row.get('hours')
+    hours = float(hours) if hours not in (None, '') else (end - start).seconds / 60 / 60
+    return {
+        'sleep_date': dt.datetime.combine(sleepDate.date(), dt.time()),
+        'start': start,
+        'end': end,
+        'hours': hours,
+        'rating': parseScore(row.get('rating'), 1, 5, 'rating'),
+        'feel': parseScore(row.get('feel'), 1, 5, 'feel'),
+        'minstosleep': parseScore(row.get('minstosleep'), 0, 180, 'minstosleep'),
+    }
+
+
+def importSleeps(stream, fmt, user=None, allowEmails=False):
+    # Writes the rows in stream to the database. Rows go to 'user' unless allowEmails is
+    # True and the row has an 'email' column, then they go to the User with that email.
+    # Returns (number of rows written, list of (line number, problem)), at most MAX_ERRORS.
+    written = 0
+    errors = []
+    changed = {}
+    batch = []
+
+    def skip(number, problem):
+        # Only the first MAX_ERRORS are kept, a whole file of junk could be millions
+        if len(errors) < MAX_ERRORS:
+            errors.append((number, problem))
+
+    def flush(batch):
+        emails = {email for number, email, fields in batch if email}
+        users = {}
+        if emails:
+            users = {found.email: found for found in User.objects(email__in=list(emails)).only('email')}
+        operations = []
+        for number, email, fields in batch:
+            sleeper = users.get(email) if email else user
+            if not sleeper:
+                skip(number, f"no user with email {email}" if email else "no user for this row")
+                continue
+            changed[sleeper.id] = sleeper
+            operations.append(UpdateOne(
+                {'sleeper': sleeper.id, 'sleep_date': fields['sleep_date']},
+                {'$set': dict(fields, modify_date=dt.datetime.utcnow())},
+                upsert=True,
+            ))
+        if operations:
+            Sleep._get_collection().bulk_write(operations, ordered=False)
+        return len(operations)
+
+    for number, row in readRows(stream, fmt):
+        if isinstance(row, ValueError):
+            skip(number, str(row))
+            continue
+        try:
+            if isinstance(row, str):
+                row = json.loads(row)
+            fields = cleanRow(row)
+        except (ValueError, TypeError) as error:
+            skip(number, str(error))
+            continue
+        email = row.get('email') if allowEmails else None
+        batch.append((number, email, fields))
+        if len(batch) >= BATCH_SIZE:
+            written += flush(batch)
+            batch = []
+    if batch:
+        written += flush(batch)
+
+    for sleeper in changed.values():
+        sleepsChanged(sleeper)
+        # Imported rows can replace existing nights, so the totals are worked out again
+        rebuildRollup(sleeper.id)
+    return written, errors
@@ -0,0 +1,83 @@
+# This file calculates sleep statistics inside MongoDB using aggregation pipelines.
+# A pipeline is a list of steps (stages) that the database runs on the documents before
+# sending anything back. That means only the small answer travels over the network, not
+# every Sleep a student has ever logged.
+# https://www.mongodb.com/docs/manual/core/aggregation-pipeline/
+#
+# A user's overall averages don't need a pipeline at all, they are kept in their
+# SleepRollup, see rollups.py
+#
+# ratingDistributions() and minsToSleepPercentiles() are async (see asyncdb.py) so the
+# sleep graph page can run them at the same time with asyncio.gather.
+
+import datetime as dt
+
+from app.classes.data import Sleep
+from app.utils.asyncdb import aggregate
+
+# Which percentiles of "minutes to fall asleep" to calculate
+MINS_PERCENTILES = (50, 75, 90, 95)
+
+
+def rollingMeans(user, since=None, until=None):
+    # One row per night with that night's hours plus the average hours over the
+    # 7 and 30 days that end on that night. $setWindowFields needs MongoDB 5.0+.
+    # since and until (datetimes) only return the nights between them. The 29 nights
+    # before 'since' are still read so the first averages cover a full 30 days.
+    match = {'$ne': None}
+    if since:
+        match['$gte'] = since - dt.timedelta(days=29)
+    if until:
+        match['$lte'] = until
+    pipeline = [
+        {'$match': {'sleep_date': match}},
+        {'$setWindowFields': {
+            'sortBy': {'sleep_date': 1},
+            'output': {
+                'avg7': {'$avg': '$hours', 'window': {'range': [-6, 0], 'unit': 'day'}},
+                'avg30': {'$avg': '$hours', 'window': {'range': [-29, 0], 'unit': 'day'}},
+            },
+        }},
+    ]
+    if since:
+        pipeline.append({'$match': {'sleep_date': {'$gte': since}}})
+    pipeline.append({'$project': {'_id': 0, 'date': '$sleep_date', 'hours': 1, 'rating': 1, 'avg7': 1, 'avg30': 1}})
+    return list(Sleep.objects(sleeper=user).aggregate(pipeline))
+
+
+async def ratingDistributions(user):
+    # How many nights got each rating (1-5) and each "how did you feel" score (1-5)
+    pipeline = [
+        {'$match': {'sleeper': user.id}},
+        {'$facet': {
+            'rating': [{'$group': {'_id': '$rating', 'count': {'$sum': 1}}}],
+            'feel': [{'$group': {'_id': '$feel', 'count': {'$sum': 1}}}],
+        }},
+    ]
+    results = await aggregate(Sleep, pipeline)
+    distributions = {'rating': {}, 'feel': {}}
+    if results:
+        for name in distributions:
+            for row in results[0][name]:
+                if row['_id'] is not None:
+                    distributions[name][row['_id']] = row['count']
+    return distributions
+
+
+async def minsToSleepPercentiles(user, percentiles=MINS_PERCENTILES):
+    # Sort the minutes in the database, then pick the value at each percentile's
+    # position. Only the picked values are sent back.
+    picks = {}
+    for p in percentiles:
+        position = {'$toInt': {'$floor': {'$multiply': [p / 100, {'$subtract': ['$count', 1]}]}}}
+        picks[f'p{p}'] = {'$arrayElemAt': ['$mins', position]}
+    pipeline = [
+        {'$match': {'sleeper': user.id, 'minstosleep': {'$ne': None}}},
+        {'$sort': {'minstosleep': 1}},
+        {'$group': {'_id': None, 'mins': {'$push': '$minstosleep'}, 'count': {'$sum': 1}}},
+        {'$project': dict(_id=0, **picks)},
+    ]
+    results = await aggregate(Sleep, pipeline)
+    if results:
+        return results[0]
+    return {}
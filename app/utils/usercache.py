@@ -0,0 +1,71 @@
+# Flask-Login looks up the logged in User on every single request (every page, every
+# picture). This keeps recently used Users in memory so most requests don't need to ask
+# the database at all.
+#
+# Each worker process has its own copy of this cache. When a user is changed, their
+# 'cache_version' in the database goes up. Every USER_CACHE_CHECK seconds a cached user
+# is checked against the database by reading just that one number, so a change made in
+# one worker shows up in the others within a few seconds. Set USER_CACHE_CHECK to 0 to
+# skip the check and rely on USER_CACHE_TTL only.
+
+from collections import OrderedDict
+from threading import Lock
+import os
+import time
+
+from app.classes.data import User
+
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 1024))
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", 300))
+USER_CACHE_CHECK = float(os.environ.get("USER_CACHE_CHECK", 5))
+
+# userId -> [user, time it was loaded, time its version was last checked]
+_users = OrderedDict()
+_usersLock = Lock()
+
+
+def _loadUser(userId):
+    # avatars is only needed by the /avatar route, which looks it up itself
+    return User.objects.exclude('avatars').get(pk=userId)
+
+
+def getUser(userId):
+    # Same as User.objects.get(pk=userId) but usually without a trip to the database.
+    # Raises mongoengine.errors.DoesNotExist just like get() does.
+    userId = str(userId)
+    now = time.monotonic()
+    with _usersLock:
+        entry = _users.get(userId)
+        if entry:
+            _users.move_to_end(userId)
+
+    if entry and now - entry[1] < USER_CACHE_TTL:
+        user, loadedAt, checkedAt = entry
+        if not USER_CACHE_CHECK or now - checkedAt < USER_CACHE_CHECK:
+            return user
+        # Read only the version number to see if another worker changed this user
+        current = User.objects(pk=userId).only('cache_version').as_pymongo().first()
+        if current and current.get('cache_version', 0) == user.cache_version:
+            entry[2] = now
+            return user
+
+    user = _loadUser(userId)
+    with _usersLock:
+        _users[userId] = [user, now, now]
+        _users.move_to_end(userId)
+        while len(_users) > USER_CACHE_SIZE:
+            _users.popitem(last=False)
+    return user
+
+
+def forgetUser(userId):
+    # Drop a user from this worker's cache only
+    with _usersLock:
+        _users.pop(str(userId), None)
+
+
+def userChanged(user):
+    # Call this after changing a User in the database. It tells every worker that
+    # their cached copy is out of date.
+    User.objects(pk=user.pk).update_one(inc__cache_version=1)
+    forgetUser(user.pk)
@@ -0,0 +1,19 @@
+# Serves the site through ASGI instead of WSGI, for example with uvicorn:
+#
+#     uvicorn asgi:app --workers 4
+#
+# Flask 2.0 isn't an async framework: WsgiToAsgi runs each request in a thread, and an
+# 'async def' route (login, the login callback and the sleep graph) keeps that thread
+# until it is done, exactly like a normal route. So this doesn't let a worker take more
+# requests at once. What the async routes get is running their independent calls at the
+# same time, see app/utils/aio.py and app/utils/asyncdb.py.
+# main.py (and gunicorn main:app) still work the same way.
+
+import os
+
+from asgiref.wsgi import WsgiToAsgi
+from app import app as flaskApp
+
+os.environ.setdefault('OAUTHLIB_RELAX_TOKEN_SCOPE', '1')
+
+app = WsgiToAsgi(flaskApp)
@@ -0,0 +1,119 @@
+# Measures how long 'import app' takes and how much memory it uses. This is what every
+# gunicorn worker (and every restart of the debug reloader) pays before it can answer
+# a single request. See readme.txt in this folder for how to run it.
+#
+# It runs python -X importtime in a fresh process and adds up the time by package, so
+# a change that suddenly imports something big at startup (like matplotlib) shows up.
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+from collections import defaultdict
+
+# A line of -X importtime output looks like:
+# import time:      1051 |       4810 |   app.utils.graphs
+LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+# Prints the peak memory of a process that did nothing but import the app
+RSS_SCRIPT = '''
+import resource, sys
+import app
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024)
+'''
+
+
+def runImportTime(module):
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True, text=True, env=dict(os.environ, PYTHONDONTWRITEBYTECODE='1'),
+    )
+    if result.returncode != 0:
+        sys.exit(result.stderr[-2000:])
+    modules = []
+    for line in result.stderr.splitlines():
+        match = LINE.match(line)
+        if match:
+            selfUs, cumulativeUs, indent, name = match.groups()
+            modules.append({
+                'module': name,
+                'self_ms': int(selfUs) / 1000,
+                'cumulative_ms': int(cumulativeUs) / 1000,
+                # Modules imported directly by 'import app' have the smallest indent
+                'depth': len(indent) // 2,
+            })
+    return modules
+
+
+def peakRssMb():
+    result = subprocess.run([sys.executable, '-c', RSS_SCRIPT], capture_output=True, text=True)
+    if result.returncode != 0:
+        sys.exit(result.stderr[-2000:])
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def summarize(modules, module, top):
+    total = next((row['cumulative_ms'] for row in modules if row['module'] == module), None)
+    packages = defaultdict(float)
+    for row in modules:
+        packages[row['module'].split('.')[0]] += row['self_ms']
+    return {
+        'module': module,
+        'total_ms': total,
+        'modules_imported': len(modules),
+        'packages_ms': dict(sorted(packages.items(), key=lambda item: -item[1])[:top]),
+        'slowest_modules': sorted(modules, key=lambda row: -row['self_ms'])[:top],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report how long 'import app' takes.")
+    parser.add_argument('--module', default='app')
+    parser.add_argument('--runs', type=int, default=5, help='imports to time. The fastest one is kept.')
+    parser.add_argument('--top', type=int, default=15, help='how many packages and modules to list')
+    parser.add_argument('--out', default='importtime_output.json')
+    parser.add_argument('--compare', help='an earlier --out file to compare with')
+    parser.add_argument('--max-ms', type=float, help='fail (exit code 1) if the import is slower than this')
+    args = parser.parse_args()
+
+    # The first run also warms the disk cache, so the fastest of a few runs is the
+    # fairest number to compare.
+    runs = [runImportTime(args.module) for _ in range(args.runs)]
+    best = min(runs, key=lambda modules: summarize(modules, args.module, 1)['total_ms'] or 0)
+    report = summarize(best, args.module, args.top)
+    report['peak_rss_mb'] = peakRssMb()
+
+    print(f"import {args.module}: {report['total_ms']:.0f}ms, {report['modules_imported']} modules, "
+          f"{report['peak_rss_mb']:.0f}MB peak memory\n")
+    print(f"{'package':<30}{'ms':>10}")
+    for package, ms in report['packages_ms'].items():
+        print(f'{package:<30}{ms:>10.1f}')
+    print(f"\n{'module':<50}{'self ms':>10}{'total ms':>10}")
+    for row in report['slowest_modules']:
+        print(f"{row['module']:<50}{row['self_ms']:>10.1f}{row['cumulative_ms']:>10.1f}")
+
+    with open(args.out, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f'\nSaved {args.out}')
+
+    if args.compare:
+        with open(args.compare) as file:
+            old = json.load(file)
+        print(f"\nbefore {old['total_ms']:.0f}ms {old['peak_rss_mb']:.0f}MB -> "
+              f"after {report['total_ms']:.0f}ms {report['peak_rss_mb']:.0f}MB")
+        for package in report['packages_ms'].keys() | old['packages_ms'].keys():
+            before = old['packages_ms'].get(package, 0)
+            after = report['packages_ms'].get(package, 0)
+            if abs(after - before) >= 5:
+                print(f'{package:<30}{before:>10.1f}{after:>10.1f}')
+
+    if args.max_ms and report['total_ms'] > args.max_ms:
+        print(f"\nimport {args.module} took {report['total_ms']:.0f}ms, more than --max-ms {args.max_ms:.0f}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
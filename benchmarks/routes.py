@@ -0,0 +1,287 @@
+# Times the main routes of the app against a database full of fake data.
+# See readme.txt in this folder for how to run it.
+
+import argparse
+import contextvars
+import datetime as dt
+import json
+import platform
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bson.objectid import ObjectId
+from mongoengine import connect, disconnect
+from pymongo import monitoring
+
+from app import app
+from app.classes.data import User, Sleep, SleepRollup, Blog, Comment
+from app.utils.database import poolOptions
+
+SCALES = {'1k': 1_000, '100k': 100_000, '1m': 1_000_000}
+INSERT_BATCH = 5_000
+WORDS = ('sleep tired morning school late night homework phone dream nap alarm bed early '
+         'rest class teacher weekend caffeine focus energy schedule').split()
+
+
+class QueryCounter(monitoring.CommandListener):
+    # Counts the database commands (and the time they took) for each request, so the
+    # queries of one request can be told apart from the others. It's kept in a context
+    # variable so the queries an async view runs in worker threads (see asyncdb.py) are
+    # counted for the request too.
+    def __init__(self):
+        self.current = contextvars.ContextVar('benchmarkQueries', default=None)
+
+    def reset(self):
+        # Returns the numbers for the requests made after this, in this thread
+        numbers = {'count': 0, 'seconds': 0.0, 'lock': threading.Lock()}
+        self.current.set(numbers)
+        return numbers
+
+    def add(self, count, seconds):
+        numbers = self.current.get()
+        if numbers is not None:
+            with numbers['lock']:
+                numbers['count'] += count
+                numbers['seconds'] += seconds
+
+    def started(self, event):
+        self.add(1, 0.0)
+
+    def succeeded(self, event):
+        self.add(0, event.duration_micros / 1e6)
+
+    def failed(self, event):
+        self.succeeded(event)
+
+
+def parseScale(text):
+    return SCALES.get(text.lower()) or int(text)
+
+
+def sentence(n):
+    return ' '.join(random.choice(WORDS) for _ in range(n))
+
+
+def insertMany(collection, docs):
+    batch = []
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) >= INSERT_BATCH:
+            collection.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        collection.insert_many(batch, ordered=False)
+
+
+def seed(scale):
+    # Split the documents roughly like a real class would: most of them are sleeps
+    random.seed(42)
+    for document in (User, Sleep, SleepRollup, Blog, Comment):
+        document.drop_collection()
+        document.ensure_indexes()
+
+    userCount = max(scale // 100, 10)
+    sleepCount = int(scale * 0.6)
+    blogCount = max(int(scale * 0.1), 1)
+    commentCount = scale - userCount - sleepCount - blogCount
+    userIds = [ObjectId() for _ in range(userCount)]
+    blogIds = [ObjectId() for _ in range(blogCount)]
+    now = dt.datetime.utcnow().replace(microsecond=0)
+
+    insertMany(User._get_collection(), ({
+        '_id': userId, 'email': f'student{i}@ousd.org', 'fname': f'First{i}', 'lname': f'Last{i}',
+        'gname': f'Student {i}', 'username': f'student{i}', 'consent': i % 3 == 0,
+        'adult_email': f'adult{i}@example.com', 'sleep_version': 0, 'cache_version': 0,
+    } for i, userId in enumerate(userIds)))
+
+    def sleeps():
+        for i in range(sleepCount):
+            # Each user gets a run of consecutive nights
+            userId = userIds[i % userCount]
+            night = now - dt.timedelta(days=i // userCount)
+            start = night.replace(hour=22) + dt.timedelta(minutes=random.randint(0, 180))
+            hours = random.uniform(4, 10)
+            yield {
+                'sleeper': userId, 'sleep_date': dt.datetime.combine(night.date(), dt.time()),
+                'start': start, 'end': start + dt.timedelta(hours=hours), 'hours': hours,
+                'rating': random.randint(1, 5), 'feel': random.randint(1, 5),
+                'minstosleep': random.randint(0, 90),
+            }
+    insertMany(Sleep._get_collection(), sleeps())
+
+    insertMany(Blog._get_collection(), ({
+        '_id': blogId, 'author': random.choice(userIds), 'subject': sentence(5),
+        'content': sentence(80), 'tag': random.choice(WORDS),
+        'create_date': now - dt.timedelta(minutes=i), 'modify_date': now - dt.timedelta(minutes=i),
+    } for i, blogId in enumerate(blogIds)))
+
+    insertMany(Comment._get_collection(), ({
+        'author': random.choice(userIds), 'blog': random.choice(blogIds), 'content': sentence(20),
+        'create_date': now - dt.timedelta(seconds=i),
+    } for i in range(commentCount)))
+    return userIds[0]
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    index = min(int(round(p / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def peakRssMb():
+    # ru_maxrss is kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def loggedInClient(userId):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        # This is what Flask-Login stores in the session when someone logs in
+        session['_user_id'] = str(userId)
+        session['_fresh'] = True
+    return client
+
+
+def timeRoute(url, userId, counter, requests, threads, warmup=3):
+    clients = threading.local()
+
+    def one(_):
+        if not hasattr(clients, 'client'):
+            clients.client = loggedInClient(userId)
+        numbers = counter.reset()
+        started = time.perf_counter()
+        response = clients.client.get(url)
+        response.get_data()
+        elapsed = time.perf_counter() - started
+        return elapsed, response.status_code, numbers['count'], numbers['seconds']
+
+    for _ in range(warmup):
+        one(None)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        results = list(pool.map(one, range(requests)))
+    wall = time.perf_counter() - started
+
+    latencies = [result[0] * 1000 for result in results]
+    statuses = {}
+    for result in results:
+        statuses[str(result[1])] = statuses.get(str(result[1]), 0) + 1
+    return {
+        'url': url,
+        'requests': requests,
+        'threads': threads,
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'mean_ms': sum(latencies) / len(latencies),
+        'throughput_rps': requests / wall,
+        'queries_per_request': sum(result[2] for result in results) / len(results),
+        'db_ms_per_request': sum(result[3] for result in results) / len(results) * 1000,
+        'peak_rss_mb': peakRssMb(),
+        'status_codes': statuses,
+    }
+
+
+def benchRoutes(userId):
+    # The routes to time. Ids are picked from the seeded data.
+    blog = Blog.objects().order_by('-create_date').only('id').first()
+    sleep = Sleep.objects(sleeper=userId).only('id').first()
+    return {
+        'sleeps': '/sleeps',
+        'blogList': '/blogs',
+        'blog': f'/blog/{blog.id}',
+        'sleep': f'/sleep/{sleep.id}',
+        'sleepgraph': '/sleepgraph',
+        'sleepgraphImage': '/sleepgraph.png',
+        'sleepSeries': '/api/sleeps/series?points=500',
+        'blogSearch': '/blogs/search?q=sleep+homework',
+    }
+
+
+def gitCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, old):
+    print(f"\n{'route':<18}{'p50 before':>12}{'p50 after':>12}{'p95 before':>12}{'p95 after':>12}{'queries':>10}")
+    for name, after in results['routes'].items():
+        before = old.get('routes', {}).get(name)
+        if not before:
+            continue
+        print(f"{name:<18}{before['p50_ms']:>12.1f}{after['p50_ms']:>12.1f}"
+              f"{before['p95_ms']:>12.1f}{after['p95_ms']:>12.1f}"
+              f"{before['queries_per_request']:>5.0f}->{after['queries_per_request']:<4.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the main routes against fake data.')
+    parser.add_argument('--scale', default='1k', help='1k, 100k, 1M or a number of documents')
+    parser.add_argument('--mongo', default='mongodb://localhost:27017/capstone_bench',
+                        help='database to fill with fake data (it is wiped first)')
+    parser.add_argument('--requests', type=int, default=100, help='requests per route')
+    parser.add_argument('--threads', type=int, default=1, help='requests sent at the same time')
+    parser.add_argument('--routes', help='comma separated route names (default: all)')
+    parser.add_argument('--no-seed', action='store_true', help='reuse the data from the last run')
+    parser.add_argument('--out', default='bench_output.json')
+    parser.add_argument('--compare', help='an earlier --out file to compare with')
+    args = parser.parse_args()
+
+    # Swap the app's database for the benchmark one, with the query counter attached.
+    counter = QueryCounter()
+    disconnect()
+    connect(host=args.mongo, event_listeners=[counter], **poolOptions())
+
+    scale = parseScale(args.scale)
+    if args.no_seed:
+        userId = User.objects().order_by('email').only('id').first().id
+    else:
+        print(f'Seeding {scale} documents...')
+        userId = seed(scale)
+
+    routes = benchRoutes(userId)
+    if args.routes:
+        routes = {name: routes[name] for name in args.routes.split(',')}
+
+    results = {
+        'meta': {
+            'scale': scale,
+            'commit': gitCommit(),
+            'python': platform.python_version(),
+            'date': dt.datetime.utcnow().isoformat(),
+            'requests': args.requests,
+            'threads': args.threads,
+            # The MONGO_... settings from database.py this run used
+            'pool': poolOptions(),
+        },
+        'routes': {},
+    }
+    for name, url in routes.items():
+        results['routes'][name] = timeRoute(url, userId, counter, args.requests, args.threads)
+        row = results['routes'][name]
+        print(f"{name:<18} p50 {row['p50_ms']:7.1f}ms  p95 {row['p95_ms']:7.1f}ms  p99 {row['p99_ms']:7.1f}ms  "
+              f"{row['throughput_rps']:7.1f} req/s  {row['queries_per_request']:5.1f} queries  "
+              f"{row['peak_rss_mb']:6.0f}MB  {row['status_codes']}")
+
+    with open(args.out, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f'Saved {args.out}')
+
+    if args.compare:
+        with open(args.compare) as file:
+            compare(results, json.load(file))
+
+
+if __name__ == '__main__':
+    main()
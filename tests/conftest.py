@@ -0,0 +1,95 @@
+# The tests run the app against mongomock, a MongoDB that lives in memory, so they don't
+# need a database server. Install what they need and run them from the top folder:
+#
+#     pip install -r requirements.txt pytest mongomock
+#     python -m pytest -q
+#
+# utils/secrets.py isn't in the repository (everyone makes their own), so the tests use
+# these settings instead.
+
+import os
+import sys
+import types
+
+import pytest
+
+TEST_SECRETS = {
+    'MONGO_DB_NAME': 'capstone_test',
+    'MONGO_HOST': 'mongomock://localhost',
+    'GOOGLE_CLIENT_ID': 'test-client-id',
+    'GOOGLE_CLIENT_SECRET': 'test-client-secret',
+    'GOOGLE_DISCOVERY_URL': 'https://accounts.google.com/.well-known/openid-configuration',
+}
+
+# Saved pages would hide the queries a route makes, so the tests render everything
+os.environ['PAGE_CACHE'] = '0'
+if 'app.utils.secrets' not in sys.modules:
+    secretsModule = types.ModuleType('app.utils.secrets')
+    secretsModule.getSecrets = lambda: dict(TEST_SECRETS)
+    sys.modules['app.utils.secrets'] = secretsModule
+
+from app import app as flaskApp  # noqa: E402
+from app.classes.data import User  # noqa: E402
+from app.utils import usercache  # noqa: E402
+
+
+@pytest.fixture
+def app():
+    flaskApp.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+    yield flaskApp
+
+
+@pytest.fixture
+def db():
+    # An empty database for every test
+    database = User._get_db()
+    for name in database.list_collection_names():
+        database.drop_collection(name)
+    with usercache._usersLock:
+        usercache._users.clear()
+    yield database
+
+
+def loginAs(client, user):
+    # What Flask-Login saves in the session when someone logs in
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+        session['_fresh'] = True
+
+
+class QueryCounter:
+    # Counts the reads the app sends to mongomock. mongomock doesn't report commands to
+    # pymongo's CommandListeners like a real server does, so its Collection methods are
+    # wrapped instead. Reads made inside another read (mongomock's find_one() uses
+    # find()) only count once.
+    READS = ('find', 'find_one', 'aggregate', 'count_documents', 'distinct',
+             'find_one_and_update', 'find_one_and_replace', 'find_one_and_delete')
+
+    def __init__(self, monkeypatch):
+        import mongomock.collection
+        self.count = 0
+        self.depth = 0
+        for name in self.READS:
+            monkeypatch.setattr(mongomock.collection.Collection, name,
+                                self.counted(getattr(mongomock.collection.Collection, name)))
+
+    def counted(self, method):
+        counter = self
+
+        def wrapper(*args, **kwargs):
+            if counter.depth == 0:
+                counter.count += 1
+            counter.depth += 1
+            try:
+                return method(*args, **kwargs)
+            finally:
+                counter.depth -= 1
+        return wrapper
+
+    def reset(self):
+        self.count = 0
+
+
+@pytest.fixture
+def queries(monkeypatch):
+    return QueryCounter(monkeypatch)
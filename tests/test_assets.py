@@ -0,0 +1,60 @@
+# Building the static files, see utils/assets.py
+
+import os
+import threading
+
+from PIL import Image
+
+from app.utils import assets
+
+
+def useFolders(monkeypatch, tmp_path):
+    static = tmp_path / 'static'
+    dist = static / 'dist'
+    static.mkdir()
+    Image.new('RGB', (800, 400), 'blue').save(static / 'picture.png')
+    (static / 'site.css').write_text('body { color: black; }')
+    monkeypatch.setattr(assets, 'STATIC_DIR', str(static))
+    monkeypatch.setattr(assets, 'DIST_DIR', str(dist))
+    monkeypatch.setattr(assets, 'MANIFEST', str(dist / 'manifest.json'))
+    monkeypatch.setattr(assets, 'BUILT_FROM', str(dist / 'built-from.txt'))
+    monkeypatch.setattr(assets, 'BUILD_LOCK', str(dist / 'build.lock'))
+    monkeypatch.setattr(assets, '_manifest', None)
+    monkeypatch.setattr(assets, '_version', None)
+    return static
+
+
+def test_workers_starting_together_build_once(monkeypatch, tmp_path):
+    static = useFolders(monkeypatch, tmp_path)
+    builds = []
+    realBuild = assets.buildAssets
+
+    def countedBuild(*args, **kwargs):
+        builds.append(1)
+        return realBuild(*args, **kwargs)
+    monkeypatch.setattr(assets, 'buildAssets', countedBuild)
+
+    workers = [threading.Thread(target=assets.buildOnce) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert len(builds) == 1
+    assert 'picture.png' in assets.loadManifest()
+
+    # A changed file is built again, and the files the old manifest used are still there
+    oldCss = assets.loadManifest()['site.css']['file']
+    (static / 'site.css').write_text('body { color: red; }')
+    assets.buildOnce()
+    assert len(builds) == 2
+    assert os.path.exists(os.path.join(assets.DIST_DIR, oldCss))
+
+
+def test_picture_gets_width_and_height(app, monkeypatch, tmp_path):
+    useFolders(monkeypatch, tmp_path)
+    assets.buildOnce()
+    with app.test_request_context():
+        html = str(assets.static_picture('picture.png', width=200))
+        assert 'width="200"' in html and 'height="100"' in html
+        html = str(assets.static_picture('picture.png', width=400, height=500))
+        assert 'width="400"' in html and 'height="500"' in html
@@ -0,0 +1,32 @@
+# The async views run their queries in worker threads, see utils/asyncdb.py. They have
+# to use the app's own database connection and still be counted for the request at
+# /metrics (utils/metrics.py).
+
+import asyncio
+
+from app.classes.data import User
+from app.utils import metrics
+from app.utils.asyncdb import findOne, findRaw
+
+
+def test_async_queries_use_the_app_database(db):
+    User(email='student@ousd.org', fname='Sam').save()
+    found = asyncio.run(findOne(User, {'email': 'student@ousd.org'}))
+    assert found.fname == 'Sam'
+    rows = asyncio.run(findRaw(User, {}, {'email': 1}))
+    assert [row['email'] for row in rows] == ['student@ousd.org']
+
+
+def test_queries_in_worker_threads_count_for_the_request(app):
+    listener = metrics.QueryListener()
+
+    async def view():
+        # Like asyncio.gather on two asyncdb calls
+        await asyncio.gather(asyncio.to_thread(listener.started, None),
+                             asyncio.to_thread(listener.started, None))
+
+    with app.test_request_context('/sleepgraph'):
+        metrics.startRequest()
+        asyncio.run(view())
+        assert metrics._current.get().queries == 2
+        metrics.finishRequest(app.response_class())
@@ -0,0 +1,23 @@
+# The terminal commands in commands.py
+
+import datetime as dt
+
+from app.classes.data import Sleep, SleepRollup, User
+from app.utils.rollups import rebuildRollup
+
+
+def test_backfill_gives_old_sleeps_a_date(app, db):
+    user = User(email='student@ousd.org').save()
+    start = dt.datetime(2022, 11, 28, 22, 30)
+    # Saved the way sleeps were before sleep_date was filled in
+    Sleep._get_collection().insert_one({'sleeper': user.id, 'start': start,
+                                        'end': start + dt.timedelta(hours=8), 'hours': 8})
+    rebuildRollup(user.id)
+    result = app.test_cli_runner().invoke(args=['backfill-sleep-dates'])
+    assert result.exit_code == 0, result.output
+    assert Sleep.objects.get().sleep_date == dt.datetime(2022, 11, 28)
+    rollup = SleepRollup._get_collection().find_one({'user': user.id})
+    assert list(rollup['days']) == ['2022-11-28']
+    # Nothing left to do the second time
+    result = app.test_cli_runner().invoke(args=['backfill-sleep-dates'])
+    assert 'on 0 sleeps' in result.output
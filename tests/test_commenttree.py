@@ -0,0 +1,14 @@
+# Pages of comment threads, see utils/commenttree.py
+
+from bson.objectid import ObjectId
+
+from app.classes.data import Comment
+from app.utils.commenttree import THREADS_PER_PAGE, buildThreads, threadPage
+
+
+def test_a_page_past_the_end_shows_and_says_the_last_page():
+    threads = buildThreads([Comment(id=ObjectId(), content=str(i)) for i in range(THREADS_PER_PAGE + 5)])
+    shown, page, pages = threadPage(threads, 999)
+    assert (page, pages) == (2, 2)
+    assert [node.comment.content for node in shown] == [str(i) for i in range(THREADS_PER_PAGE, THREADS_PER_PAGE + 5)]
+    assert threadPage(threads, -3)[1] == 1
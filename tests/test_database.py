@@ -0,0 +1,52 @@
+# The connection pool numbers at /metrics, see utils/database.py. Queries waiting for a
+# connection at the same time, in different threads, must each be timed from their own
+# start.
+
+import threading
+import time
+
+from pymongo import monitoring
+from app.utils import database
+
+ADDRESS = ('pooltest', 27017)
+
+
+def test_waits_are_timed_per_thread():
+    listener = database.PoolListener()
+    key = database._pool(ADDRESS)
+    before = database._waitSeconds[key].count
+    started = threading.Event()
+    gotConnection = threading.Event()
+
+    def slowQuery():
+        listener.connection_check_out_started(monitoring.ConnectionCheckOutStartedEvent(ADDRESS))
+        started.set()
+        gotConnection.wait()
+        listener.connection_checked_out(monitoring.ConnectionCheckedOutEvent(ADDRESS, 1))
+
+    thread = threading.Thread(target=slowQuery)
+    thread.start()
+    started.wait()
+    time.sleep(0.05)
+    # Another query on this thread waits and fails while the first one is still waiting
+    listener.connection_check_out_started(monitoring.ConnectionCheckOutStartedEvent(ADDRESS))
+    listener.connection_check_out_failed(monitoring.ConnectionCheckOutFailedEvent(
+        ADDRESS, monitoring.ConnectionCheckOutFailedReason.TIMEOUT))
+    assert database._pools[key]['waiting'] == 1
+    gotConnection.set()
+    thread.join()
+
+    waits = database._waitSeconds[key]
+    assert waits.count - before == 2
+    assert database._pools[key]['waiting'] == 0
+    assert database._pools[key]['timeouts'] == 1
+    # The failed wait was short, the other one waited at least 50ms
+    assert waits.sum >= 0.05
+
+
+def test_checkout_without_a_start_is_ignored():
+    listener = database.PoolListener()
+    key = database._pool(ADDRESS)
+    waiting = database._pools[key]['waiting']
+    listener.connection_checked_out(monitoring.ConnectionCheckedOutEvent(ADDRESS, 2))
+    assert database._pools[key]['waiting'] == waiting
@@ -0,0 +1,57 @@
+# The "Send Sleep Info" button, see routes/sleep.py and utils/digest.py
+
+import smtplib
+
+from app.classes.data import Job, User
+from app.utils import digest
+from conftest import loginAs
+
+
+def test_send_button_queues_one_digest_a_day(app, db):
+    user = User(email='student@ousd.org', consent=True, adult_email='adult@example.com').save()
+    Job.ensure_indexes()
+    client = app.test_client()
+    loginAs(client, user)
+    for click in range(3):
+        assert client.get('/consent/send').status_code == 302
+    assert Job.objects(kind='weekly-digests').count() == 1
+
+
+class FakeSmtp:
+    # Refuses the addresses in 'refused' and drops the connection after 'dropAfter' emails
+    def __init__(self, refused=(), dropAfter=None):
+        self.refused = refused
+        self.dropAfter = dropAfter
+        self.sent = []
+
+    def send_message(self, message):
+        if self.dropAfter is not None and len(self.sent) >= self.dropAfter:
+            raise smtplib.SMTPServerDisconnected('gone')
+        if message['To'] in self.refused:
+            raise smtplib.SMTPRecipientsRefused({message['To']: (550, b'No such user')})
+        self.sent.append(message['To'])
+
+    def quit(self):
+        pass
+
+
+def someDigests(count):
+    return [{'to': f'adult{i}@example.com', 'adult': 'Pat', 'student': 'Sam', 'nights': 3}
+            for i in range(count)]
+
+
+def test_a_refused_address_doesnt_stop_the_batch(db, monkeypatch):
+    smtp = FakeSmtp(refused={'adult0@example.com'})
+    monkeypatch.setattr(digest, 'smtpConnection', lambda: smtp)
+    digest.sendDigests(someDigests(3), since='2022-11-21')
+    assert smtp.sent == ['adult1@example.com', 'adult2@example.com']
+    assert Job.objects.count() == 0
+
+
+def test_the_rest_of_a_batch_is_queued_once(db, monkeypatch):
+    Job.ensure_indexes()
+    for run in range(2):
+        monkeypatch.setattr(digest, 'smtpConnection', lambda: FakeSmtp(dropAfter=1))
+        digest.sendDigests(someDigests(3), since='2022-11-21')
+    rest = Job.objects.get(kind='send-digests')
+    assert [entry['to'] for entry in rest.payload['digests']] == ['adult1@example.com', 'adult2@example.com']
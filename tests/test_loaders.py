@@ -0,0 +1,61 @@
+# The list pages look up every author (or sleeper) on the page with one query, see
+# utils/loaders.py. If a template starts loading Users one at a time again, the number
+# of queries grows with the number of rows and these tests fail.
+
+import datetime as dt
+
+from app.classes.data import Blog, Sleep, User
+from conftest import loginAs
+
+SMALL = 2
+LARGE = 20
+
+
+def makeUsers(count):
+    return [User(email=f'student{i}@ousd.org', fname=f'First{i}', lname=f'Last{i}').save()
+            for i in range(count)]
+
+
+def seedBlogs(count):
+    authors = makeUsers(count)
+    now = dt.datetime.utcnow()
+    for i, author in enumerate(authors):
+        Blog(author=author, subject=f'Blog {i}', content='Some words', tag='test',
+             create_date=now - dt.timedelta(minutes=i)).save()
+    return authors[0]
+
+
+def seedSleeps(count):
+    sleepers = makeUsers(count)
+    today = dt.datetime.combine(dt.date.today(), dt.time())
+    for i, sleeper in enumerate(sleepers):
+        Sleep(sleeper=sleeper, sleep_date=today - dt.timedelta(days=i), hours=8, rating=4,
+              feel=4, minstosleep=10).save()
+    return sleepers[0]
+
+
+def queriesFor(app, queries, path, seed, rows):
+    client = app.test_client()
+    loginAs(client, seed(rows))
+    queries.reset()
+    response = client.get(path)
+    assert response.status_code == 200
+    return queries.count
+
+
+def test_blog_list_queries_dont_grow_with_rows(app, db, queries):
+    small = queriesFor(app, queries, '/blogs', seedBlogs, SMALL)
+    db.drop_collection('blog')
+    db.drop_collection('user')
+    large = queriesFor(app, queries, '/blogs', seedBlogs, LARGE)
+    assert Blog.objects.count() == LARGE
+    assert small == large
+
+
+def test_sleep_list_queries_dont_grow_with_rows(app, db, queries):
+    small = queriesFor(app, queries, '/sleeps', seedSleeps, SMALL)
+    for name in ('sleep', 'sleep_rollup', 'user'):
+        db.drop_collection(name)
+    large = queriesFor(app, queries, '/sleeps', seedSleeps, LARGE)
+    assert Sleep.objects.count() == LARGE
+    assert small == large
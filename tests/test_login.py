@@ -0,0 +1,73 @@
+# The Google discovery document is cached and fetched by one request at a time, see
+# routes/login.py. Google is played by a small local server that counts its requests.
+
+import importlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# 'from app.routes import login' would get the login() route, not the file
+login = importlib.import_module('app.routes.login')
+
+DISCOVERY = {
+    'authorization_endpoint': 'https://accounts.google.com/o/oauth2/v2/auth',
+    'token_endpoint': 'https://oauth2.googleapis.com/token',
+    'userinfo_endpoint': 'https://openidconnect.googleapis.com/v1/userinfo',
+}
+
+
+class FakeGoogle(BaseHTTPRequestHandler):
+    requests = 0
+
+    def do_GET(self):
+        FakeGoogle.requests += 1
+        # Slow enough for the logins in the test to overlap
+        time.sleep(0.2)
+        body = json.dumps(DISCOVERY).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Cache-Control', 'public, max-age=3600')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def google(monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeGoogle)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    FakeGoogle.requests = 0
+    monkeypatch.setitem(login.secrets, 'GOOGLE_DISCOVERY_URL', f'http://127.0.0.1:{server.server_port}/')
+    monkeypatch.setattr(login, 'providerCache', {'cfg': None, 'freshUntil': 0, 'staleUntil': 0, 'fetching': None})
+    yield FakeGoogle
+    server.shutdown()
+
+
+def test_second_login_uses_the_cached_discovery_document(app, google):
+    client = app.test_client()
+    for attempt in range(2):
+        response = client.get('/login')
+        assert response.status_code == 302
+        assert response.location.startswith(DISCOVERY['authorization_endpoint'])
+    assert google.requests == 1
+
+
+def test_logins_at_the_same_time_share_one_fetch(app, google):
+    statuses = []
+
+    def oneLogin():
+        statuses.append(app.test_client().get('/login').status_code)
+
+    threads = [threading.Thread(target=oneLogin) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert statuses == [302] * 5
+    assert google.requests == 1
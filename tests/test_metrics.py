@@ -0,0 +1,15 @@
+# /metrics is only there when METRICS_TOKEN is set, see utils/metrics.py
+
+from app.utils import metrics
+
+
+def test_metrics_are_hidden_without_a_token(app, monkeypatch):
+    client = app.test_client()
+    monkeypatch.setattr(metrics, 'METRICS_TOKEN', None)
+    assert client.get('/metrics').status_code == 404
+    monkeypatch.setattr(metrics, 'METRICS_TOKEN', 'secret')
+    assert client.get('/metrics').status_code == 403
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 403
+    response = client.get('/metrics', headers={'Authorization': 'Bearer secret'})
+    assert response.status_code == 200
+    assert b'http_request_duration_seconds' in response.data
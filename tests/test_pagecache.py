@@ -0,0 +1,23 @@
+# Saved copies of rendered html, see utils/pagecache.py
+
+import datetime as dt
+
+from app.classes.data import Blog, User
+from app.utils import pagecache
+from app.utils.usercache import userChanged
+from conftest import loginAs
+
+
+def test_blog_list_shows_a_renamed_author(app, db, monkeypatch):
+    monkeypatch.setattr(pagecache, 'PAGE_CACHE', True)
+    monkeypatch.setattr(pagecache, '_memory', pagecache.MemoryCache(100))
+    author = User(email='author@ousd.org', fname='Old', lname='Name').save()
+    Blog(author=author, subject='Hello', content='Hi', tag='test', create_date=dt.datetime.utcnow()).save()
+    client = app.test_client()
+    loginAs(client, author)
+    assert b'Old Name' in client.get('/blogs').data
+
+    author.update(fname='New')
+    userChanged(author)
+    page = client.get('/blogs').data
+    assert b'New Name' in page and b'Old Name' not in page
@@ -0,0 +1,30 @@
+# Editing a profile saves the name and picture together, see routes/user.py
+
+import io
+
+from app.classes.data import User
+from app.utils.usercache import getUser
+from conftest import loginAs
+
+
+def test_bad_picture_changes_nothing(app, db):
+    user = User(email='student@ousd.org', fname='Old', lname='Name').save()
+    client = app.test_client()
+    loginAs(client, user)
+    response = client.post('/myprofile/edit', data={
+        'fname': 'New', 'lname': 'Name', 'image': (io.BytesIO(b'not a picture'), 'me.png'),
+    }, content_type='multipart/form-data')
+    assert response.status_code == 200
+    user.reload()
+    assert user.fname == 'Old'
+    assert user.cache_version == 0
+
+
+def test_new_name_reaches_the_user_cache(app, db):
+    user = User(email='student@ousd.org', fname='Old', lname='Name').save()
+    client = app.test_client()
+    loginAs(client, user)
+    assert getUser(user.id).fname == 'Old'
+    response = client.post('/myprofile/edit', data={'fname': 'New', 'lname': 'Name'})
+    assert response.status_code == 302
+    assert getUser(user.id).fname == 'New'
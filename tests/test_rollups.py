@@ -0,0 +1,45 @@
+# The streaks in a SleepRollup are moved along from the days that change instead of
+# being counted again from every day, see utils/rollups.py. After any mix of adding,
+# moving and deleting sleeps they have to match what a rebuild counts.
+
+import datetime as dt
+import random
+
+from app.classes.data import Sleep, SleepRollup, User
+from app.utils.rollups import rebuildRollup, rollupAdd, rollupChange, rollupRemove, streaks, weekKey
+
+STREAK_FIELDS = ('current_streak', 'longest_streak', 'streak_end')
+START = dt.datetime(2022, 9, 1)
+
+
+def stored(user):
+    return SleepRollup._get_collection().find_one({'user': user.id})
+
+
+def test_streaks_match_a_rebuild(db):
+    user = User(email='student@ousd.org').save()
+    rebuildRollup(user.id)
+    picker = random.Random(4)
+    sleeps = []
+    for step in range(150):
+        day = START + dt.timedelta(days=picker.randrange(40))
+        action = picker.random()
+        if sleeps and action < 0.3:
+            sleep = sleeps.pop(picker.randrange(len(sleeps)))
+            sleep.delete()
+            rollupRemove(sleep)
+        elif sleeps and action < 0.5:
+            sleep = sleeps[picker.randrange(len(sleeps))]
+            sleep.update(sleep_date=day)
+            rollupChange(sleep, {'sleep_date': day})
+            sleep.reload()
+        else:
+            sleep = Sleep(sleeper=user, sleep_date=day, hours=8).save()
+            sleeps.append(sleep)
+            rollupAdd(sleep)
+        kept = stored(user)
+        days = {f'{sleep.sleep_date:%Y-%m-%d}' for sleep in sleeps}
+        assert {field: kept.get(field) for field in STREAK_FIELDS} == streaks(days), step
+        # Days and weeks without sleeps are taken out
+        assert set(kept['days']) == days, step
+        assert set(kept['weeks']) == {weekKey(sleep.sleep_date) for sleep in sleeps}, step
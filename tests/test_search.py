@@ -0,0 +1,36 @@
+# Searching with a tag finds that tag's best matches, see utils/search.py
+
+import datetime as dt
+
+from app.classes.data import Blog, User
+from app.utils import search
+
+
+def test_tag_search_finds_matches_below_the_overall_best(db, monkeypatch):
+    monkeypatch.setattr(search, 'SEARCH_MODE', 'memory')
+    monkeypatch.setattr(search, 'MAX_RESULTS', 5)
+    monkeypatch.setattr(search, 'memoryIndex', search.InvertedIndex())
+    author = User(email='student@ousd.org').save()
+    now = dt.datetime.utcnow()
+    # Ten blogs with 'sleep' in the subject rank above the tagged one that only has
+    # it in the content
+    for i in range(10):
+        Blog(author=author, subject='sleep sleep', content='sleep', tag='other', create_date=now).save()
+    tagged = Blog(author=author, subject='Naps', content='sleep', tag='naps', create_date=now).save()
+
+    results, pages = search.searchBlogs('sleep', tag='naps')
+    assert [blog.id for blog, score in results] == [tagged.id]
+
+
+def test_changes_are_searchable_after_a_rebuild(db, monkeypatch):
+    monkeypatch.setattr(search, 'SEARCH_MODE', 'memory')
+    monkeypatch.setattr(search, 'memoryIndex', search.InvertedIndex())
+    author = User(email='student@ousd.org').save()
+    assert search.searchBlogs('dreams')[0] == []
+    blog = Blog(author=author, subject='Dreams', content='', tag='', create_date=dt.datetime.utcnow()).save()
+    search.searchChanged()
+    # The search that notices the change starts the rebuild and uses the old index
+    search.searchBlogs('dreams')
+    with search.memoryIndex.buildLock:
+        pass
+    assert [found.id for found, score in search.searchBlogs('dreams')[0]] == [blog.id]
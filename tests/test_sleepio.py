@@ -0,0 +1,55 @@
+# Cohort export permissions and sleep file imports, see utils/sleepio.py
+
+import io
+
+from app.classes.data import User
+from app.utils import sleepio
+from conftest import loginAs
+
+
+def test_admin_emails_are_whole_addresses(monkeypatch):
+    monkeypatch.setattr(sleepio, 'secrets', {'ADMIN_EMAILS': 'xa@b.com, Teacher@ousd.org'})
+    assert sleepio.canExportCohort(User(email='teacher@ousd.org'))
+    assert sleepio.canExportCohort(User(email='xa@b.com'))
+    assert not sleepio.canExportCohort(User(email='a@b.c'))
+    assert not sleepio.canExportCohort(User(email='b.com'))
+
+
+def test_import_errors_are_shown_on_the_page(app, db):
+    user = User(email='student@ousd.org').save()
+    client = app.test_client()
+    loginAs(client, user)
+    lines = ['sleep_date,hours'] + [f'not a date {i},8' for i in range(60)]
+    response = client.post('/sleeps/import', data={
+        'file': (io.BytesIO('\n'.join(lines).encode()), 'sleeps.csv'), 'format': 'csv',
+    }, content_type='multipart/form-data')
+    assert response.status_code == 200
+    assert b'lines were skipped' in response.data
+    assert b'Imported 0 sleeps.' in response.data
+    with client.session_transaction() as session:
+        # Nothing is left waiting in the session cookie
+        assert not session.get('_flashes')
+
+
+def test_unreadable_files_are_reported_not_crashed_on(app, db):
+    user = User(email='student@ousd.org').save()
+    client = app.test_client()
+    loginAs(client, user)
+    files = {
+        'csv': 'sleep_date,start,end\n2022-11-28,2022-11-28T22:00,2022-11-29T06:00\n'.encode('utf-16'),
+        'ndjson': b'\xff\xfe\x00bad',
+    }
+    for fmt, data in files.items():
+        response = client.post('/sleeps/import', data={
+            'file': (io.BytesIO(data), 'sleeps.txt'), 'format': fmt,
+        }, content_type='multipart/form-data')
+        assert response.status_code == 200
+        assert b"isn&#39;t UTF-8 text" in response.data
+
+
+def test_bad_csv_is_a_line_error():
+    # A field bigger than the csv module allows
+    text = 'sleep_date,start\n2022-11-28,x\n' + 'x' * 200_000 + '\n2022-11-29,x\n'
+    rows = list(sleepio.readRows(io.StringIO(text), 'csv'))
+    assert rows[0][1]['sleep_date'] == '2022-11-28'
+    assert rows[1][0] == 3 and isinstance(rows[1][1], ValueError)